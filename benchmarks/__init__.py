@@ -0,0 +1,13 @@
+"""
+Load tests of the API, run from the repository root so that config.json (and so the DB) is the app's own:
+
+    python -m benchmarks seed --users 1000 --listings 100000      # Fills the configured DB with seeded data
+    uvicorn main:app --port 8000                                   # In another shell
+    python -m benchmarks run --base-url http://localhost:8000 --duration 30 --concurrency 16
+    python -m benchmarks compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+    python -m benchmarks matcher --searches 1000000 --listings 1000 # The saved search matcher alone, in memory
+    python -m benchmarks serialization --limit 256                  # Read paths of the list endpoints, against the DB
+
+Seeding with the same --seed produces the same data, so runs on different commits can be compared.
+Needs httpx (and Pillow for the image upload scenario) on top of the app's own dependencies.
+"""
@@ -0,0 +1,115 @@
+from datetime import date, datetime, timedelta, timezone
+import json
+import os
+import random
+import uuid
+
+from sqlmodel import SQLModel, insert
+
+from src.database import create_db_tables
+from src.dependencies import open_db_session
+from src.models import User, Listing, ListingCategory
+from src.utils.users import _hash_password
+import src.utils.search  # Registers the full-text search DDL, so it's created with the tables
+
+# Every seeded user has this password, it's hashed only once
+BENCHMARK_PASSWORD = "Benchmark1!"
+# One seller owns this share of all listings, for the heavy seller profile scenario
+HEAVY_SELLER_SHARE = 0.05
+BATCH_SIZE = 1000
+
+TITLE_WORDS = [
+    "vintage", "new", "used", "mint", "broken", "rare", "cheap", "premium", "classic", "compact", "wireless", "gaming",
+    "leather", "wooden", "electric", "portable", "original", "limited", "handmade", "refurbished",
+]
+ITEM_WORDS = [
+    "laptop", "chair", "bike", "camera", "guitar", "phone", "table", "jacket", "lamp", "console", "watch", "book",
+    "drone", "speaker", "monitor", "tent", "boots", "puzzle", "keyboard", "mirror",
+]
+
+DATASET_PATH = os.path.join(os.path.dirname(__file__), "results", "dataset.json")
+
+
+def generate_users(rng: random.Random, count: int, hashed_password: str) -> list[dict]:
+    signup = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "id": uuid.UUID(int=rng.getrandbits(128), version=4),
+            "email": f"bench_user_{index}@example.com",
+            "username": f"bench_user_{index}",
+            "full_name": None,
+            "birth_date": date(1970, 1, 1) + timedelta(days=rng.randrange(15000)),
+            "postal_code": f"{rng.randrange(10000, 99999)}",
+            "city": "Benchmark City",
+            "profile_picture_link": None,
+            "hashed_password": hashed_password,
+            "session_token": None,
+            "signup_timestamp": signup,
+            "updated_at": signup,
+        }
+        for index in range(count)
+    ]
+
+def generate_listings(rng: random.Random, count: int, author_ids: list[uuid.UUID], heavy_seller_id: uuid.UUID):
+    # Yields batches, created over the past year so the newest first orderings have something to sort
+    categories = list(ListingCategory)
+    newest = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    batch = []
+    for index in range(count):
+        created_at = newest - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        author_id = heavy_seller_id if rng.random() < HEAVY_SELLER_SHARE else rng.choice(author_ids)
+        batch.append({
+            "id": uuid.UUID(int=rng.getrandbits(128), version=4),
+            "author_id": author_id,
+            "title": f"{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {rng.choice(ITEM_WORDS)} {index}",
+            "description": " ".join(rng.choice(TITLE_WORDS + ITEM_WORDS) for _ in range(rng.randrange(5, 40))),
+            "category": categories[index % len(categories)],  # Every category gets the same number of listings
+            "price": round(rng.uniform(0, 5000), 2),
+            "created_at": created_at,
+            "updated_at": created_at,
+        })
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def seed(users: int, listings: int, seed: int = 0) -> dict:
+    """
+    Inserts users and listings into the DB from config.json (creating the tables if needed) and writes
+    the dataset description the scenarios need to benchmarks/results/dataset.json
+    """
+    if users < 2:
+        raise ValueError("At least 2 users are needed, one of them is reserved for the upload scenario")
+
+    rng = random.Random(seed)
+    await create_db_tables(SQLModel.metadata)
+
+    user_rows = generate_users(rng, users, _hash_password(BENCHMARK_PASSWORD))
+    heavy_seller = user_rows[1]  # user 0 is reserved for the upload scenario, so logins don't invalidate its token
+
+    async with open_db_session() as session:
+        for start in range(0, len(user_rows), BATCH_SIZE):
+            await session.exec(insert(User), params=user_rows[start:start + BATCH_SIZE])
+        for batch in generate_listings(rng, listings, [user["id"] for user in user_rows], heavy_seller["id"]):
+            await session.exec(insert(Listing), params=batch)
+        await session.commit()
+
+    dataset = {
+        "seed": seed,
+        "users": users,
+        "listings": listings,
+        "password": BENCHMARK_PASSWORD,
+        "usernames": [user["username"] for user in user_rows],
+        "heavy_seller_id": str(heavy_seller["id"]),
+        "categories": [category.value for category in ListingCategory],
+    }
+    os.makedirs(os.path.dirname(DATASET_PATH), exist_ok=True)
+    with open(DATASET_PATH, "w") as dataset_file:
+        json.dump(dataset, dataset_file)
+
+    return dataset
+
+def load_dataset(path: str = DATASET_PATH) -> dict:
+    with open(path) as dataset_file:
+        return json.load(dataset_file)
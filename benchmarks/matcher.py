@@ -0,0 +1,137 @@
+import math
+import random
+import resource
+import time
+import uuid
+
+from src.models import ListingCategory
+from src.utils.saved_searches import SavedSearchEntry, SavedSearchIndex, tokenize
+
+# An in-memory benchmark of the saved search matcher, no server or DB involved. Words are drawn from a Zipf-like
+# distribution over a synthetic vocabulary, so a few are common and most are rare, like in real listings.
+VOCABULARY_SIZE = 5000
+# The most common words are the listings' stop words, searches use the others
+COMMON_WORDS = 50
+CITIES = ["Prague", "Brno", "Ostrava", "Plzen", "Liberec", "Olomouc"]
+# Listings checked against every search by brute force, to verify the index and to compare with it
+LINEAR_SCAN_LISTINGS = 20
+
+
+def zipf_cumulative_weights(size: int) -> list[float]:
+    weights, total = [], 0.0
+    for rank in range(1, size + 1):
+        total += 1 / rank
+        weights.append(total)
+    return weights
+
+def draw_word(rng: random.Random, vocabulary: list[str], weights: list[float]) -> str:
+    return rng.choices(vocabulary, cum_weights=weights)[0]
+
+def generate_searches(rng: random.Random, count: int, vocabulary: list[str], weights: list[float]) -> list[SavedSearchEntry]:
+    categories = list(ListingCategory)
+    searches = []
+    for _ in range(count):
+        min_price = max_price = None
+        if rng.random() < 0.6:
+            min_price = round(rng.uniform(0, 2000), 2) if rng.random() < 0.5 else None
+            max_price = round((min_price or 0) + rng.uniform(10, 3000), 2)
+        keywords = " ".join(sorted({draw_word(rng, vocabulary, weights) for _ in range(rng.randint(1, 3))})) if rng.random() < 0.85 else None
+        searches.append(SavedSearchEntry.from_row(
+            uuid.UUID(int=rng.getrandbits(128), version=4),
+            uuid.UUID(int=rng.getrandbits(128), version=4),
+            rng.choice(categories) if rng.random() < 0.8 else None,
+            min_price,
+            max_price,
+            keywords,
+            rng.choice(CITIES) if rng.random() < 0.2 else None,
+        ))
+    return searches
+
+def generate_listings(rng: random.Random, count: int, vocabulary: list[str], weights: list[float]) -> list[tuple]:
+    categories = list(ListingCategory)
+    return [
+        (
+            rng.choice(categories),
+            round(rng.uniform(0, 5000), 2),
+            tokenize(" ".join(draw_word(rng, vocabulary, weights) for _ in range(rng.randint(5, 40)))),
+            rng.choice(CITIES),
+        )
+        for _ in range(count)
+    ]
+
+def linear_match(searches: list[SavedSearchEntry], category, price, words, city) -> list[SavedSearchEntry]:
+    # What the index must return, by evaluating every search
+    city = city.lower()
+    return [
+        search for search in searches
+        if search.category in (None, category) and search.min_price <= price <= search.max_price
+        and (search.city is None or search.city == city) and words.issuperset(search.keywords)
+    ]
+
+def run_matcher_benchmark(searches: int, listings: int, seed_value: int) -> dict:
+    from .runner import percentile, current_commit
+
+    rng = random.Random(seed_value)
+    vocabulary = [f"word{index}" for index in range(VOCABULARY_SIZE)]
+    weights = zipf_cumulative_weights(VOCABULARY_SIZE)
+
+    search_weights = [weight - weights[COMMON_WORDS - 1] for weight in weights[COMMON_WORDS:]]
+    saved_searches = generate_searches(rng, searches, vocabulary[COMMON_WORDS:], search_weights)
+    new_listings = generate_listings(rng, listings, vocabulary, weights)
+
+    started = time.perf_counter()
+    index = SavedSearchIndex()
+    for search in saved_searches:
+        index.add(search)
+    index.rebuild()
+    build_seconds = time.perf_counter() - started
+
+    latencies, match_counts = [], []
+    for listing in new_listings:
+        started = time.perf_counter()
+        matches = index.match(*listing)
+        latencies.append(time.perf_counter() - started)
+        match_counts.append(len(matches))
+
+    linear_latencies = []
+    for listing in new_listings[:LINEAR_SCAN_LISTINGS]:
+        started = time.perf_counter()
+        expected = linear_match(saved_searches, *listing)
+        linear_latencies.append(time.perf_counter() - started)
+        if {search.id for search in expected} != {search.id for search in index.match(*listing)}:
+            raise AssertionError("The index and the linear scan disagree")
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    linear_ms = sorted(latency * 1000 for latency in linear_latencies)
+    return {
+        "commit": current_commit(),
+        "settings": {"searches": searches, "listings": listings, "seed": seed_value},
+        "index_build_seconds": build_seconds,
+        "groups": len(index.groups),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "match_latency_ms": {
+            "p50": percentile(latencies_ms, 0.50),
+            "p95": percentile(latencies_ms, 0.95),
+            "p99": percentile(latencies_ms, 0.99),
+            "mean": sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0.0,
+        },
+        "linear_scan_latency_ms": {
+            "p50": percentile(linear_ms, 0.50),
+            "mean": sum(linear_ms) / len(linear_ms) if linear_ms else 0.0,
+        },
+        "matches_per_listing": {
+            "mean": sum(match_counts) / len(match_counts) if match_counts else 0.0,
+            "max": max(match_counts, default=0),
+        },
+    }
+
+def print_matcher_summary(results: dict):
+    latency, linear = results["match_latency_ms"], results["linear_scan_latency_ms"]
+    print(
+        f"{results['settings']['searches']} searches in {results['groups']} groups, index built in "
+        f"{results['index_build_seconds']:.1f}s, max RSS {results['max_rss_mb']:.0f}MB\n"
+        f"index        p50 {latency['p50']:.3f}ms  p95 {latency['p95']:.3f}ms  p99 {latency['p99']:.3f}ms  mean {latency['mean']:.3f}ms\n"
+        f"linear scan  p50 {linear['p50']:.1f}ms  mean {linear['mean']:.1f}ms "
+        f"({linear['mean'] / latency['mean'] if latency['mean'] else math.inf:.0f}x slower)\n"
+        f"matches per listing: mean {results['matches_per_listing']['mean']:.1f}, max {results['matches_per_listing']['max']}"
+    )
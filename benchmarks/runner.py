@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import os
+import random
+import subprocess
+import time
+
+import httpx
+
+from .data_generator import load_dataset, seed, DATASET_PATH
+from .scenarios import SCENARIOS, Recorder
+from .matcher import run_matcher_benchmark, print_matcher_summary
+from .serialization import run_serialization_benchmark, print_serialization_summary
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(sorted_values: list[float], share: float) -> float:
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(share * len(sorted_values)) - 1))]
+
+def summarize(samples: list[tuple[float, int]], duration: float) -> dict:
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    status_codes = {}
+    for _, status in samples:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    errors = sum(count for status, count in status_codes.items() if not 200 <= int(status) < 400)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "status_codes": status_codes,
+        "requests_per_second": len(samples) / duration if duration else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max": latencies[-1] if latencies else 0.0,
+        },
+    }
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def default_output_path(prefix: str, commit: str | None) -> str:
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return os.path.join(RESULTS_DIRECTORY, f"{prefix}{timestamp}_{(commit or 'unknown')[:12]}.json")
+
+async def run_scenario(name: str, base_url: str, dataset: dict, duration: float, concurrency: int, seed_value: int) -> dict:
+    setup, step = SCENARIOS[name]
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        state = await setup(client, dataset)
+        deadline = time.perf_counter() + duration
+
+        async def worker(worker_index: int):
+            # Each worker has its own seeded generator, so the request mix is the same on every run
+            rng = random.Random(f"{seed_value}-{name}-{worker_index}")
+            while time.perf_counter() < deadline:
+                await step(client, dataset, state, rng, recorder)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(index) for index in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(recorder.samples.get(name, []), elapsed)
+
+async def run(base_url: str, scenarios: list[str], duration: float, concurrency: int, seed_value: int, output: str | None) -> dict:
+    dataset = load_dataset()
+    results = {
+        "commit": current_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "base_url": base_url,
+        "settings": {"duration": duration, "concurrency": concurrency, "seed": seed_value},
+        "dataset": {key: dataset[key] for key in ("seed", "users", "listings")},
+        "scenarios": {},
+    }
+
+    # One scenario at a time, so that their latencies don't affect each other
+    for name in scenarios:
+        results["scenarios"][name] = await run_scenario(name, base_url, dataset, duration, concurrency, seed_value)
+        print_summary(name, results["scenarios"][name])
+
+    if output is None:
+        output = default_output_path("", results["commit"])
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Results saved to {output}")
+
+    return results
+
+def print_summary(name: str, summary: dict):
+    latency = summary["latency_ms"]
+    print(
+        f"{name:<22} {summary['requests_per_second']:>9.1f} req/s  p50 {latency['p50']:>8.1f}ms  p95 {latency['p95']:>8.1f}ms  "
+        f"p99 {latency['p99']:>8.1f}ms  errors {summary['errors']}/{summary['requests']}"
+    )
+
+def compare(baseline_path: str, candidate_path: str):
+    with open(baseline_path) as baseline_file, open(candidate_path) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    print(f"baseline  {baseline['commit']}\ncandidate {candidate['commit']}")
+    for name, result in candidate["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        before = baseline["scenarios"][name]
+        changes = [("req/s", before["requests_per_second"], result["requests_per_second"])]
+        changes += [(key, before["latency_ms"][key], result["latency_ms"][key]) for key in ("p50", "p95", "p99")]
+        print(f"{name:<22} " + "  ".join(
+            f"{label} {old:.1f} -> {new:.1f} ({(new - old) / old * 100:+.1f}%)" if old else f"{label} {old:.1f} -> {new:.1f}"
+            for label, old, new in changes
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_command = commands.add_parser("seed", help="Fill the DB from config.json with generated users and listings")
+    seed_command.add_argument("--users", type=int, default=1000)
+    seed_command.add_argument("--listings", type=int, default=100000)
+    seed_command.add_argument("--seed", type=int, default=0)
+
+    run_command = commands.add_parser("run", help="Run scenarios against a running server")
+    run_command.add_argument("--base-url", default="http://localhost:8000")
+    run_command.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Repeatable, all by default")
+    run_command.add_argument("--duration", type=float, default=30, help="Seconds per scenario")
+    run_command.add_argument("--concurrency", type=int, default=16)
+    run_command.add_argument("--seed", type=int, default=0)
+    run_command.add_argument("--output", help=f"Defaults to {RESULTS_DIRECTORY}/<time>_<commit>.json")
+
+    matcher_command = commands.add_parser("matcher", help="Benchmark the saved search matcher in memory")
+    matcher_command.add_argument("--searches", type=int, default=1000000)
+    matcher_command.add_argument("--listings", type=int, default=1000, help="New listings matched against them")
+    matcher_command.add_argument("--seed", type=int, default=0)
+    matcher_command.add_argument("--output", help=f"Defaults to {RESULTS_DIRECTORY}/matcher_<time>_<commit>.json")
+
+    serialization_command = commands.add_parser("serialization", help="Compare the read paths of the list endpoints in process")
+    serialization_command.add_argument("--pages", type=int, default=20, help="Pages followed by cursor per round")
+    serialization_command.add_argument("--limit", type=int, default=256)
+    serialization_command.add_argument("--rounds", type=int, default=3)
+    serialization_command.add_argument("--output", help=f"Defaults to {RESULTS_DIRECTORY}/serialization_<time>_<commit>.json")
+
+    compare_command = commands.add_parser("compare", help="Compare two saved runs")
+    compare_command.add_argument("baseline")
+    compare_command.add_argument("candidate")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "seed":
+        dataset = asyncio.run(seed(arguments.users, arguments.listings, arguments.seed))
+        print(f"Seeded {dataset['users']} users and {dataset['listings']} listings, dataset saved to {DATASET_PATH}")
+    elif arguments.command == "run":
+        asyncio.run(run(
+            arguments.base_url, arguments.scenario or list(SCENARIOS), arguments.duration,
+            arguments.concurrency, arguments.seed, arguments.output,
+        ))
+    elif arguments.command == "matcher":
+        results = run_matcher_benchmark(arguments.searches, arguments.listings, arguments.seed)
+        print_matcher_summary(results)
+        output = arguments.output or default_output_path("matcher_", results["commit"])
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+        print(f"Results saved to {output}")
+    elif arguments.command == "serialization":
+        results = asyncio.run(run_serialization_benchmark(arguments.pages, arguments.limit, arguments.rounds))
+        print_serialization_summary(results)
+        output = arguments.output or default_output_path("serialization_", results["commit"])
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+        print(f"Results saved to {output}")
+    else:
+        compare(arguments.baseline, arguments.candidate)
@@ -0,0 +1,93 @@
+import io
+import random
+import time
+
+import httpx
+
+# Every scenario is (setup, step). setup(client, dataset) runs once before the measurement and returns the
+# scenario's state, step(client, dataset, state, rng, recorder) is repeated by every worker until the run ends.
+# A step may send several requests, each of them is timed separately.
+
+DEEP_PAGINATION_PAGES = 20
+UPLOAD_IMAGES = 32  # Distinct images, so the uploads are a mix of new files and deduplicated ones
+
+
+class Recorder:
+    """Collects (latency in seconds, status code) samples per scenario"""
+
+    def __init__(self):
+        self.samples: dict[str, list[tuple[float, int]]] = {}
+
+    async def request(self, scenario: str, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response | None:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response = None
+            status = 0  # Connection errors and timeouts
+        self.samples.setdefault(scenario, []).append((time.perf_counter() - started, status))
+        return response
+
+
+async def no_setup(client: httpx.AsyncClient, dataset: dict):
+    return None
+
+async def login(client: httpx.AsyncClient, username: str, password: str) -> dict:
+    response = await client.post("/tokens/", data={"username": username, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def browse_by_category(client, dataset, state, rng: random.Random, recorder: Recorder):
+    # The first page of a random category, the bulk of the real read traffic
+    category = rng.choice(dataset["categories"])
+    await recorder.request("browse_by_category", client, "GET", "/listings/", params={"category": category, "limit": 32})
+
+async def deep_pagination(client, dataset, state, rng: random.Random, recorder: Recorder):
+    # Follows the cursor through many pages of the unfiltered newest first listing
+    params = {"limit": 32}
+    for _ in range(DEEP_PAGINATION_PAGES):
+        response = await recorder.request("deep_pagination", client, "GET", "/listings/", params=params)
+        if response is None or response.status_code != 200 or response.json()["next_cursor"] is None:
+            return
+        params["cursor"] = response.json()["next_cursor"]
+
+async def login_storm(client, dataset, state, rng: random.Random, recorder: Recorder):
+    # Random users other than user 0, whose session the upload scenario uses
+    username = rng.choice(dataset["usernames"][1:])
+    await recorder.request(
+        "login_storm", client, "POST", "/tokens/", data={"username": username, "password": dataset["password"]}
+    )
+
+async def heavy_seller_profile(client, dataset, state, rng: random.Random, recorder: Recorder):
+    await recorder.request("heavy_seller_profile", client, "GET", f"/users/{dataset['heavy_seller_id']}")
+
+async def setup_image_upload(client: httpx.AsyncClient, dataset: dict):
+    from PIL import Image  # Only needed by this scenario
+
+    rng = random.Random(dataset["seed"])
+    images = []
+    for _ in range(UPLOAD_IMAGES):
+        buffer = io.BytesIO()
+        Image.frombytes("RGB", (256, 256), rng.randbytes(256 * 256 * 3)).save(buffer, "PNG")
+        images.append(buffer.getvalue())
+
+    headers = await login(client, dataset["usernames"][0], dataset["password"])
+    return {"images": images, "headers": headers}
+
+async def image_upload(client, dataset, state, rng: random.Random, recorder: Recorder):
+    await recorder.request(
+        "image_upload", client, "PUT", "/users/me/picture",
+        files={"uploaded_file": ("picture.png", rng.choice(state["images"]), "image/png")},
+        headers=state["headers"],
+    )
+
+
+SCENARIOS = {
+    "browse_by_category": (no_setup, browse_by_category),
+    "deep_pagination": (no_setup, deep_pagination),
+    "login_storm": (no_setup, login_storm),
+    "heavy_seller_profile": (no_setup, heavy_seller_profile),
+    "image_upload": (setup_image_upload, image_upload),
+}
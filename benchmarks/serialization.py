@@ -0,0 +1,130 @@
+import json
+import time
+import tracemalloc
+
+from sqlalchemy.orm import selectinload
+from sqlmodel import select, func
+
+from src.dependencies import open_db_session
+from src.models import Listing, ListingPage, UserListingPage
+from src.utils.fast_json import dump_json
+from src.utils.listings import get_listings_page, listing_with_owner_projection, listing_page_entry_dicts
+from src.utils.listings import listing_get_projection, listing_get_dict
+
+# The read path of the list endpoints against the DB from config.json (seed it first), in process, no server involved.
+# "orm" is the previous path: Listing instances, response model validation and pydantic's encoder. "projection" is
+# the current one: only the response's columns as rows, turned into dicts and encoded by orjson (or json without it).
+
+
+async def orm_listing_page(session, filters, cursor, limit) -> tuple[bytes, str | None, int]:
+    listings, next_cursor = await get_listings_page(session, filters, cursor, limit, options=(selectinload(Listing.author),))
+    body = ListingPage.model_validate({"listings": listings, "next_cursor": next_cursor}).model_dump_json().encode()
+    return body, next_cursor, len(listings)
+
+async def projection_listing_page(session, filters, cursor, limit) -> tuple[bytes, str | None, int]:
+    rows, next_cursor = await get_listings_page(session, filters, cursor, limit, projection=listing_with_owner_projection)
+    body = dump_json({"listings": listing_page_entry_dicts(rows), "next_cursor": next_cursor})
+    return body, next_cursor, len(rows)
+
+async def orm_user_listing_page(session, filters, cursor, limit) -> tuple[bytes, str | None, int]:
+    listings, next_cursor = await get_listings_page(session, filters, cursor, limit)
+    body = UserListingPage.model_validate({"listings": listings, "next_cursor": next_cursor}).model_dump_json().encode()
+    return body, next_cursor, len(listings)
+
+async def projection_user_listing_page(session, filters, cursor, limit) -> tuple[bytes, str | None, int]:
+    rows, next_cursor = await get_listings_page(session, filters, cursor, limit, projection=listing_get_projection)
+    body = dump_json({"listings": [listing_get_dict(row) for row in rows], "next_cursor": next_cursor})
+    return body, next_cursor, len(rows)
+
+# GET /listings/ (with the authors) and the listings of GET /users/{user_id} and /users/{user_id}/listings
+PAGE_SHAPES = {
+    "listings": (orm_listing_page, projection_listing_page),
+    "user_listings": (orm_user_listing_page, projection_user_listing_page),
+}
+
+async def walk_pages(render, filters, pages: int, limit: int, measure_allocations: bool) -> tuple[int, float, list[int]]:
+    # Follows the cursor for up to pages pages, a new session per page like separate requests
+    rows, elapsed, allocations = 0, 0.0, []
+    cursor = None
+    for _ in range(pages):
+        if measure_allocations:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        async with open_db_session() as session:
+            _, cursor, page_rows = await render(session, filters, cursor, limit)
+        elapsed += time.perf_counter() - started
+        if measure_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+        rows += page_rows
+        if cursor is None:
+            break
+    return rows, elapsed, allocations
+
+async def heaviest_author_filters() -> list:
+    async with open_db_session() as session:
+        author_id = (await session.exec(
+            select(Listing.author_id).group_by(Listing.author_id).order_by(func.count().desc()).limit(1)
+        )).first()
+    if author_id is None:
+        raise RuntimeError("The DB has no listings, run python -m benchmarks seed first")
+    return [Listing.author_id == author_id]
+
+async def verify_same_output(filters_by_shape: dict, limit: int):
+    for shape, (orm_render, projection_render) in PAGE_SHAPES.items():
+        async with open_db_session() as session:
+            expected, _, _ = await orm_render(session, filters_by_shape[shape], None, limit)
+        async with open_db_session() as session:
+            actual, _, _ = await projection_render(session, filters_by_shape[shape], None, limit)
+        if json.loads(expected) != json.loads(actual):
+            raise AssertionError(f"The {shape} pages of both paths differ")
+
+async def run_serialization_benchmark(pages: int, limit: int, rounds: int) -> dict:
+    from .runner import current_commit
+
+    filters_by_shape = {"listings": [], "user_listings": await heaviest_author_filters()}
+    await verify_same_output(filters_by_shape, limit)
+
+    results = {"commit": current_commit(), "settings": {"pages": pages, "limit": limit, "rounds": rounds}, "shapes": {}}
+    for shape, renders in PAGE_SHAPES.items():
+        results["shapes"][shape] = {}
+        for path, render in zip(("orm", "projection"), renders):
+            filters = filters_by_shape[shape]
+            await walk_pages(render, filters, 1, limit, False)  # Warm up the connection pool and the statement caches
+
+            # Timed without tracemalloc, which slows allocations down
+            rows, elapsed = 0, 0.0
+            for _ in range(rounds):
+                round_rows, round_elapsed, _ = await walk_pages(render, filters, pages, limit, False)
+                rows += round_rows
+                elapsed += round_elapsed
+
+            tracemalloc.start()
+            try:
+                _, _, allocations = await walk_pages(render, filters, pages, limit, True)
+            finally:
+                tracemalloc.stop()
+
+            results["shapes"][shape][path] = {
+                "rows": rows,
+                "rows_per_second": rows / elapsed if elapsed else 0.0,
+                "ms_per_page": elapsed / (rows / limit) * 1000 if rows else 0.0,
+                # Peak of the memory allocated while rendering a page, over what was allocated before it
+                "peak_allocated_bytes_per_page": sum(allocations) / len(allocations) if allocations else 0.0,
+            }
+    return results
+
+def print_serialization_summary(results: dict):
+    print(f"limit={results['settings']['limit']}, {results['settings']['pages']} pages x {results['settings']['rounds']} rounds")
+    for shape, paths in results["shapes"].items():
+        for path, summary in paths.items():
+            print(
+                f"{shape:<14} {path:<11} {summary['rows_per_second']:>10.0f} rows/s  {summary['ms_per_page']:>7.2f}ms/page  "
+                f"{summary['peak_allocated_bytes_per_page'] / 1024:>8.0f}KiB allocated/page"
+            )
+        orm, projection = paths["orm"], paths["projection"]
+        if orm["rows_per_second"] and projection["peak_allocated_bytes_per_page"]:
+            print(
+                f"{shape:<14} projection: {projection['rows_per_second'] / orm['rows_per_second']:.1f}x rows/s, "
+                f"{orm['peak_allocated_bytes_per_page'] / projection['peak_allocated_bytes_per_page']:.1f}x less allocated"
+            )
@@ -1,31 +1,54 @@
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 
 from src.logging_config import logger
 from src.app_config import IMAGES_ENDPOINT, IMAGES_FOLDER_PATH
-from src.database import engine
+from src.database import create_db_tables, replica_engines
+from src.dependencies import session_token_cache
 from src.models import SQLModel  # So we can then .create_all() DB objects
 from src.routes.router_aggregate import router
+from src.utils.workers import password_hashing_pool, image_processing_pool
+from src.utils.image_variants import ImageFiles
+from src.utils.response_cache import listing_page_cache
+from src.utils.bookmarks import bookmark_counter
+from src.utils.saved_searches import saved_search_matcher
+from src.utils.request_ids import RequestIdMiddleware
+from src.utils.metrics import MetricsMiddleware
+from src.utils.replicas import ReadYourWritesMiddleware
 
 # Manage startup and shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        SQLModel.metadata.create_all(engine)
+        await create_db_tables(SQLModel.metadata)
     except Exception as e:
         logger.exception("Unexpected exception when creating DB tables: %s", e)
         raise
+    bookmark_counter.start()
+    saved_search_matcher.start()
     logger.info("Application startup successful")
     
     yield
 
+    await saved_search_matcher.stop()
+    await bookmark_counter.stop()
+
+    password_hashing_pool.shutdown()
+    image_processing_pool.shutdown()
+    logger.info("Session token cache stats: %s", session_token_cache.stats())
+    logger.info("Listing page cache stats: %s", listing_page_cache.stats())
     logger.info("Application shutdown successful")
 
 app = FastAPI(lifespan=lifespan)
 
-# Mounting the images directory ensures that GET requests are handled automatically (among other things)
-app.mount(IMAGES_ENDPOINT, StaticFiles(directory=IMAGES_FOLDER_PATH), name="images")
+if replica_engines:
+    app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)  # Added last so it runs first, the slow request log then has the request id
+
+# Mounting the images directory ensures that GET requests are handled automatically (among other things),
+# missing image variants are generated on their first request
+app.mount(IMAGES_ENDPOINT, ImageFiles(directory=IMAGES_FOLDER_PATH), name="images")
 
 app.include_router(router)
\ No newline at end of file
@@ -27,11 +27,41 @@ DB_PASSWORD = config.get("database", {}).get("db_password", "password123")
 DB_HOST = config.get("database", {}).get("db_host", "localhost")
 DB_PORT = config.get("database", {}).get("db_port", 5432)
 DB_NAME = config.get("database", {}).get("db_name", "marketplace")
+# A full SQLAlchemy URL takes precedence over the fields above (e.g. "sqlite:///./marketplace.db" for tests)
+DB_URL_OVERRIDE = config.get("database", {}).get("url")
+# The sync engine is only kept as an opt-in fallback, its blocking calls are run in the threadpool
+DB_USE_ASYNC = config.get("database", {}).get("use_async", True)
+# Full SQLAlchemy URLs of read replicas, the read-only endpoints are spread over them (none: everything uses the primary)
+DB_REPLICA_URLS = config.get("database", {}).get("replica_urls", [])
+# Per engine and per worker process, so the DB must accept workers * (1 + replicas on it) * (pool_size + max_overflow)
+DB_POOL_SIZE = config.get("database", {}).get("pool", {}).get("pool_size", 5)
+DB_POOL_MAX_OVERFLOW = config.get("database", {}).get("pool", {}).get("max_overflow", 10)
+DB_POOL_TIMEOUT = config.get("database", {}).get("pool", {}).get("pool_timeout", 30)  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = config.get("database", {}).get("pool", {}).get("pool_recycle", 1800)  # Seconds, -1 never recycles
+DB_POOL_PRE_PING = config.get("database", {}).get("pool", {}).get("pool_pre_ping", True)  # Replaces dropped connections
+# After a write, the client's reads stay on the primary this long (in seconds), so they see it despite replication lag
+DB_READ_YOUR_WRITES_WINDOW = config.get("database", {}).get("read_your_writes_seconds", 5)
 
 log_file_directory_path = get_abs_or_rel_path(config.get("log_file_directory_path", "."))
 os.makedirs(log_file_directory_path, exist_ok=True)  # Create the directory if it doesn't already exist
 LOG_FILE_PATH = os.path.join(log_file_directory_path, "log.log")
 
+# Requests slower than this (in milliseconds) are logged with the SQL they issued, null disables the slow request log
+SLOW_REQUEST_THRESHOLD = config.get("metrics", {}).get("slow_request_threshold_ms")
+SLOW_REQUEST_MAX_STATEMENTS = config.get("metrics", {}).get("slow_request_max_statements", 50)
+
+# Records are written by a background thread, the request path only puts them on a queue
+LOG_LEVEL = config.get("logging", {}).get("level", "DEBUG")
+LOG_FILE_LEVEL = config.get("logging", {}).get("file_level", "DEBUG")
+LOG_CONSOLE_LEVEL = config.get("logging", {}).get("console_level", "WARNING")
+LOG_JSON_FORMAT = config.get("logging", {}).get("json_format", False)  # One JSON object per line instead of plain text
+LOG_SQL_ECHO = config.get("logging", {}).get("sql_echo", False)  # Logs every SQL statement, at INFO level
+# "size" rotates log.log once it reaches max_size(MB), "time" at every rotate_when (see TimedRotatingFileHandler)
+LOG_ROTATION = config.get("logging", {}).get("rotation", "size")
+LOG_MAX_SIZE = config.get("logging", {}).get("max_size(MB)", 10)
+LOG_ROTATE_WHEN = config.get("logging", {}).get("rotate_when", "midnight")
+LOG_BACKUP_COUNT = config.get("logging", {}).get("backup_count", 5)
+
 IMAGES_FOLDER_PATH = get_abs_or_rel_path(config.get("images_folder_path", "./images"))
 os.makedirs(IMAGES_FOLDER_PATH, exist_ok=True)
 
@@ -39,4 +69,54 @@ IMAGES_ENDPOINT = "/images"
 
 PROFILE_PICTURE_MAX_SIZE = config.get("profile_picture_max_size(MB)", 3)
 LISTING_PICTURE_MAX_SIZE = config.get("listing_picture_max_size(MB)", 10)
-LISTING_PICTURES_MAX_NUMBER = config.get("listing_pictures_max_number", 10)
\ No newline at end of file
+LISTING_PICTURES_MAX_NUMBER = config.get("listing_pictures_max_number", 10)
+
+# How many of a user's newest listings are embedded in their public profile
+USER_PROFILE_LISTINGS_LIMIT = config.get("user_profile_listings_limit", 16)
+
+# Caches the user behind each session token so that authentication doesn't hit the DB on every request.
+# The cache is per worker process and a logout or login only evicts the token on the worker handling it, so the
+# other workers keep accepting a revoked token (and serving stale user data) for up to ttl_seconds: keep it short
+SESSION_TOKEN_CACHE_MAX_SIZE = config.get("session_token_cache", {}).get("max_size", 10000)
+SESSION_TOKEN_CACHE_TTL = config.get("session_token_cache", {}).get("ttl_seconds", 5)
+
+# Bookmark counts are summed up in memory and written to the listings this often (in seconds), in one UPDATE
+BOOKMARK_COUNT_FLUSH_INTERVAL = config.get("bookmarks", {}).get("count_flush_interval_seconds", 5)
+
+# A GeoNames postal code dump (e.g. CZ.txt from https://download.geonames.org/export/zip/), tab separated.
+# Listings are placed at their author's postal code, or city if the postal code isn't in it
+POSTAL_CODES_PATH = get_abs_or_rel_path(config.get("geocoding", {}).get("postal_codes_path", "./postal_codes.txt"))
+POSTAL_CODES_COUNTRY = config.get("geocoding", {}).get("country")  # Only this country's rows are loaded, null loads all
+GEO_MAX_RADIUS = config.get("geocoding", {}).get("max_radius_km", 200)
+
+# New listings are matched against every saved search by a background task, see src/utils/saved_searches.py
+SAVED_SEARCHES_MAX_PER_USER = config.get("saved_searches", {}).get("max_per_user", 50)
+# How often (in seconds) each worker loads the searches saved through the other workers
+SAVED_SEARCHES_REFRESH_INTERVAL = config.get("saved_searches", {}).get("refresh_interval_seconds", 5)
+# New listings waiting to be matched, beyond that they're skipped (and logged) rather than slowing down their creation
+SAVED_SEARCHES_QUEUE_SIZE = config.get("saved_searches", {}).get("queue_size", 10000)
+
+# Rendered pages of GET /listings. backend is "memory" (per process), "redis" (shared, needs redis_url and the
+# redis package) or "local_redis" (the Redis code path against an in-process stand-in, for development)
+LISTING_PAGE_CACHE_BACKEND = config.get("listing_page_cache", {}).get("backend", "memory")
+LISTING_PAGE_CACHE_REDIS_URL = config.get("listing_page_cache", {}).get("redis_url", "redis://localhost:6379/0")
+LISTING_PAGE_CACHE_MAX_SIZE = config.get("listing_page_cache", {}).get("max_size", 1024)
+LISTING_PAGE_CACHE_TTL = config.get("listing_page_cache", {}).get("ttl_seconds", 30)
+
+# GET /listings/export reads this many rows per round trip from a server-side cursor
+LISTING_EXPORT_BATCH_SIZE = config.get("listing_export", {}).get("batch_size", 1000)
+
+# Limits of the bulk listing endpoints (POST/PATCH/DELETE /listings/bulk)
+BULK_MAX_ROWS = config.get("listing_bulk", {}).get("max_rows", 5000)
+BULK_MAX_BODY_SIZE = config.get("listing_bulk", {}).get("max_body_size(MB)", 10)
+
+# bcrypt runs on a bounded worker pool so that bursts of logins can't freeze the event loop
+BCRYPT_ROUNDS = config.get("password_hashing", {}).get("bcrypt_rounds", 12)
+PASSWORD_HASHING_WORKERS = config.get("password_hashing", {}).get("workers", 4)
+PASSWORD_HASHING_MAX_QUEUED = config.get("password_hashing", {}).get("max_queued", 64)  # Beyond this requests get a 503
+PASSWORD_HASHING_USE_PROCESSES = config.get("password_hashing", {}).get("use_processes", False)
+
+# Resized copies of uploaded images, generated on a pool of worker processes; variant name -> max width/height in pixels
+IMAGE_VARIANTS = config.get("image_processing", {}).get("variants", {"thumb": 200, "medium": 800, "full": 2048})
+IMAGE_PROCESSING_WORKERS = config.get("image_processing", {}).get("workers", 2)
+IMAGE_PROCESSING_MAX_QUEUED = config.get("image_processing", {}).get("max_queued", 32)
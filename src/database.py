@@ -1,12 +1,204 @@
-from sqlmodel import create_engine
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
+from sqlmodel import create_engine, Session
+from starlette.concurrency import run_in_threadpool
 
 from .logging_config import logger
-from .app_config import DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME
+from .utils.metrics import Gauge, record_query, record_pool_checkout_wait
+from .app_config import (
+    DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME, DB_URL_OVERRIDE, DB_USE_ASYNC, DB_REPLICA_URLS,
+    DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+)
+
+# Driver used for each backend depending on whether the async or the sync engine is in use
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+SYNC_DRIVERS = {"postgresql": "postgresql+psycopg2", "sqlite": "sqlite"}
+
+DB_URL = DB_URL_OVERRIDE or f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+DB_BACKEND = make_url(DB_URL).get_backend_name()  # "postgresql" or "sqlite", for the few dialect specific features
+
+def with_driver(db_url: str, drivers: dict[str, str]):
+    url = make_url(db_url)
+    return url.set(drivername=drivers[url.get_backend_name()])
+
+def with_checkout_timing(pool_class):
+    # _do_get is where a pool hands out a connection, blocking while none is free
+    class TimedPool(pool_class):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                record_pool_checkout_wait(time.perf_counter() - started)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+def pool_class_for(db_url):
+    # The pool the dialect would use by default, with its checkout wait measured
+    return with_checkout_timing(db_url.get_dialect().get_pool_class(db_url))
+
+def pool_options(pool_class) -> dict:
+    options = {"pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": DB_POOL_PRE_PING}
+    # Only queue pools have a size, SQLite's file and in-memory pools reject these arguments
+    if issubclass(pool_class, QueuePool):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+def create_db_engine(db_url: str):
+    # No echo, SQL statements are logged through the queued handlers of logging_config when logging.sql_echo is set
+    if DB_USE_ASYNC:
+        async_db_url = with_driver(db_url, ASYNC_DRIVERS)
+        pool_class = pool_class_for(async_db_url)
+        return create_async_engine(async_db_url, poolclass=pool_class, **pool_options(pool_class))
+    sync_db_url = with_driver(db_url, SYNC_DRIVERS)
+    pool_class = pool_class_for(sync_db_url)
+    return create_engine(sync_db_url, poolclass=pool_class, **pool_options(pool_class))
 
-DB_URL = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+engine = None
+async_engine = None
 
 try:
-    engine = create_engine(DB_URL, echo=True)
+    if DB_USE_ASYNC:
+        async_engine = create_db_engine(DB_URL)
+    else:
+        engine = create_db_engine(DB_URL)
+    # Same kind of engine as the primary, read-only endpoints take turns between them (see dependencies.py)
+    replica_engines = [create_db_engine(replica_url) for replica_url in DB_REPLICA_URLS]
 except Exception as e:
     logger.exception("Unexpected exception when creating DB engine: %s", e)
-    raise
\ No newline at end of file
+    raise
+
+def underlying_sync_engine(db_engine):
+    # The async engine runs on a sync engine underneath, that's where the events fire
+    return db_engine.sync_engine if isinstance(db_engine, AsyncEngine) else db_engine
+
+sync_engine = underlying_sync_engine(async_engine if async_engine is not None else engine)
+
+# Name used in the pool metrics' "engine" label
+sync_engines = {"primary": sync_engine}
+sync_engines.update(
+    (f"replica_{index}", underlying_sync_engine(replica_engine)) for index, replica_engine in enumerate(replica_engines)
+)
+
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+    record_query(statement, time.perf_counter() - connection.info["query_started"].pop())
+
+def discard_query_timer(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get("query_started"):
+        exception_context.connection.info["query_started"].pop()
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and so only runs ON DELETE CASCADE, on connections that turn them on
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+for timed_engine in sync_engines.values():
+    if timed_engine.dialect.name == "sqlite":
+        event.listen(timed_engine, "connect", enable_sqlite_foreign_keys)
+    event.listen(timed_engine, "before_cursor_execute", start_query_timer)
+    event.listen(timed_engine, "after_cursor_execute", stop_query_timer)
+    event.listen(timed_engine, "handle_error", discard_query_timer)
+
+def pool_status(db_engine=sync_engine) -> dict[str, float]:
+    # Not every pool class has a size (e.g. the StaticPool of in-memory SQLite)
+    pool = db_engine.pool
+    if not hasattr(pool, "checkedout"):
+        return {}
+    capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),  # Negative while the pool itself isn't full yet
+        "saturation": pool.checkedout() / capacity if capacity else 0.0,
+    }
+
+def pool_metric(key: str):
+    def collect():
+        statuses = {name: pool_status(db_engine) for name, db_engine in sync_engines.items()}
+        return {(name,): status[key] for name, status in statuses.items() if status}
+    return collect
+
+Gauge("db_pool_size", "Connections kept open by the pool", ("engine",), callback=pool_metric("size"))
+Gauge("db_pool_checked_out", "Connections currently in use", ("engine",), callback=pool_metric("checked_out"))
+Gauge("db_pool_overflow", "Connections open beyond the pool size", ("engine",), callback=pool_metric("overflow"))
+Gauge(
+    "db_pool_saturation", "Share of the pool's capacity (size plus max overflow) in use", ("engine",),
+    callback=pool_metric("saturation"),
+)
+
+async def create_db_tables(metadata):
+    if async_engine is not None:
+        async with async_engine.begin() as connection:
+            await connection.run_sync(metadata.create_all)
+    else:
+        await run_in_threadpool(metadata.create_all, engine)
+
+class ThreadedSession:
+    """
+    Wraps a sync Session behind the AsyncSession methods the app uses, so the same handlers work
+    with the sync fallback engine. Every call that may hit the DB is run in the threadpool.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def exec(self, statement, **kwargs):
+        return await run_in_threadpool(self.sync_session.exec, statement, **kwargs)
+
+    async def execute(self, statement, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, statement, **kwargs)
+
+    async def stream(self, statement, **kwargs):
+        # Like AsyncSession.stream, rows are fetched in partitions as they're consumed
+        return ThreadedResult(await run_in_threadpool(self.sync_session.execute, statement, **kwargs))
+
+    async def scalar(self, statement, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, statement, **kwargs)
+
+    async def get(self, entity, ident, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, entity, ident, **kwargs)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance, **kwargs):
+        await run_in_threadpool(self.sync_session.refresh, instance, **kwargs)
+
+
+class ThreadedResult:
+    """The part of AsyncResult used for streaming, over a sync Result"""
+
+    def __init__(self, result):
+        self.sync_result = result
+
+    async def partitions(self, size: int | None = None):
+        while True:
+            partition = await run_in_threadpool(self.sync_result.fetchmany, size)
+            if not partition:
+                return
+            yield partition
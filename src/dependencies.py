@@ -1,23 +1,81 @@
+from contextlib import asynccontextmanager
+import itertools
 from typing import Annotated
 
-from fastapi import Depends
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import Session
+from sqlalchemy.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import make_transient_to_detached
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from .app_config import SESSION_TOKEN_CACHE_MAX_SIZE, SESSION_TOKEN_CACHE_TTL
 from .logging_config import logger
-from .database import engine
+from .database import engine, async_engine, replica_engines, ThreadedSession
 from .models import User
+from .utils.cache import LRUCache
+from .utils.replicas import reads_from_primary
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="tokens")
+# For endpoints that also serve anonymous requests
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="tokens", auto_error=False)
 
-def get_db_session():
-    with Session(engine) as session:
+# session_token -> column values of the User it belongs to. Per worker process, evictions don't reach the other
+# workers, which keep their entries until the (short) TTL runs out
+session_token_cache = LRUCache(SESSION_TOKEN_CACHE_MAX_SIZE, SESSION_TOKEN_CACHE_TTL)
+
+@asynccontextmanager
+async def open_engine_session(db_engine):
+    if isinstance(db_engine, AsyncEngine):
+        # expire_on_commit=False so attributes can still be read after commit without an implicit (blocking) reload
+        async with AsyncSession(db_engine, expire_on_commit=False) as session:
+            yield session
+    else:
+        with Session(db_engine, expire_on_commit=False) as session:
+            yield ThreadedSession(session)
+
+async def get_db_session():
+    async with open_engine_session(async_engine if async_engine is not None else engine) as session:
         yield session
 
-def get_user_by_token(token: str, session: Annotated[Session, Depends(get_db_session)]) -> User:
+# For work that outlives the request's own session, e.g. the body of a streamed response
+open_db_session = asynccontextmanager(get_db_session)
+
+# Round robin over the replicas, per worker process
+replica_rotation = itertools.cycle(replica_engines)
+
+async def get_read_db_session(request: Request, primary_session: Annotated[AsyncSession, Depends(get_db_session)]):
+    """
+    For read-only endpoints, a session on the next read replica. Clients that wrote recently (see
+    ReadYourWritesMiddleware) and setups without replicas get the request's primary session instead, the same one
+    the user is authenticated with, so that the request doesn't hold two pooled connections.
+    """
+    # A session only checks out a connection once it runs a query, so the unused primary session costs nothing
+    if not replica_engines or reads_from_primary(request):
+        yield primary_session
+        return
+    async with open_engine_session(next(replica_rotation)) as session:
+        yield session
+
+def invalidate_cached_user(token: str | None):
+    # Must be called after every commit that changes a user or their session_token, only evicts this worker's entry
+    if token is not None:
+        session_token_cache.delete(token)
+
+async def get_user_by_token(token: str, session: AsyncSession) -> User:
+    cached_user_data = session_token_cache.get(token)
+    if cached_user_data is not None:
+        # Rebuild a fresh instance for each request and attach it to the session without a SELECT,
+        # so the handlers can modify and commit it just like a loaded user
+        user = User(**cached_user_data)
+        make_transient_to_detached(user)
+        session.add(user)
+        return user
+
     try:
-        user: User = session.exec(select(User).where(User.session_token == token)).one()
+        user: User = (await session.exec(select(User).where(User.session_token == token))).one()
 
     except NoResultFound:
         logger.info("Failed attempt to access protected resource")
@@ -30,7 +88,20 @@ def get_user_by_token(token: str, session: Annotated[Session, Depends(get_db_ses
         logger.exception("Multiple users with identical session_token found: %s", mrfe)
         raise
 
+    session_token_cache.set(token, user.model_dump())
     return user
 
-def get_current_user(authorization_token: Annotated[str, Depends(oauth2_scheme)]) -> User:
-    return get_user_by_token(authorization_token)
\ No newline at end of file
+async def get_current_user(
+    authorization_token: Annotated[str, Depends(oauth2_scheme)],
+    session: Annotated[AsyncSession, Depends(get_db_session)]
+) -> User:
+    return await get_user_by_token(authorization_token, session)
+
+async def get_optional_current_user(
+    authorization_token: Annotated[str | None, Depends(optional_oauth2_scheme)],
+    session: Annotated[AsyncSession, Depends(get_db_session)]
+) -> User | None:
+    # An invalid token is still rejected, only a missing one makes the request anonymous
+    if authorization_token is None:
+        return None
+    return await get_user_by_token(authorization_token, session)
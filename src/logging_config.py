@@ -1,22 +1,81 @@
+import atexit
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+import multiprocessing
+import queue
 
-from .app_config import LOG_FILE_PATH
+from .app_config import LOG_FILE_PATH, LOG_LEVEL, LOG_FILE_LEVEL, LOG_CONSOLE_LEVEL, LOG_JSON_FORMAT, LOG_SQL_ECHO
+from .app_config import LOG_ROTATION, LOG_MAX_SIZE, LOG_ROTATE_WHEN, LOG_BACKUP_COUNT
+
+# Id of the request being handled, set by the RequestIdMiddleware ("-" outside of requests)
+request_id = ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    # Runs where the record is created, the context (and so the request id) isn't available on the listener's thread
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
 
 logger = logging.getLogger("main")
 
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
-file_handler = logging.FileHandler(LOG_FILE_PATH)
+if LOG_ROTATION == "time":
+    file_handler = TimedRotatingFileHandler(LOG_FILE_PATH, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+else:
+    file_handler = RotatingFileHandler(LOG_FILE_PATH, maxBytes=LOG_MAX_SIZE * 1024 * 1024, backupCount=LOG_BACKUP_COUNT)
 console_handler = logging.StreamHandler()
 
-file_handler.setLevel(logging.DEBUG)  # Log all messages to the file
-console_handler.setLevel(logging.WARNING)  # Log warnings and worse to the console
+file_handler.setLevel(LOG_FILE_LEVEL)
+console_handler.setLevel(LOG_CONSOLE_LEVEL)
 
-file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_formatter = logging.Formatter('%(levelname)s - %(message)s')
+if LOG_JSON_FORMAT:
+    file_formatter = JsonFormatter()
+    console_formatter = JsonFormatter()
+else:
+    file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] - %(message)s')
+    console_formatter = logging.Formatter('%(levelname)s - %(message)s')
 
 file_handler.setFormatter(file_formatter)
 console_handler.setFormatter(console_formatter)
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
\ No newline at end of file
+# The spawned image processing workers import this module too, only the main process writes (and rotates) the file
+if multiprocessing.current_process().name == "MainProcess":
+    output_handlers = [file_handler, console_handler]
+else:
+    file_handler.close()
+    output_handlers = [console_handler]
+
+# Logging calls only format the message and enqueue the record, the handlers above run on the listener's thread
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(RequestIdFilter())
+
+queue_listener = QueueListener(log_queue, *output_handlers, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)  # Writes out whatever is still queued
+
+logger.addHandler(queue_handler)
+
+# SQLAlchemy's echo would attach its own blocking stdout handler, its engine logger goes through the queue instead
+sql_logger = logging.getLogger("sqlalchemy.engine")
+sql_logger.setLevel(logging.INFO if LOG_SQL_ECHO else logging.WARNING)
+sql_logger.addHandler(queue_handler)
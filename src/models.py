@@ -2,9 +2,21 @@ from datetime import datetime, date, timezone
 from enum import Enum
 import uuid
 
-from pydantic import EmailStr, field_validator, HttpUrl
+from pydantic import EmailStr, field_validator, computed_field, HttpUrl
+from sqlalchemy import BigInteger, DateTime, Index
 from sqlmodel import Field, Relationship, SQLModel
 
+from .utils.image_variants import image_variant_links
+
+class StoredImage(SQLModel, table=True):
+    # One row per content addressed image file, counting the users/listings that use it
+    content_hash: str = Field(primary_key=True, min_length=64, max_length=64)
+    ref_count: int = Field(default=1, nullable=False)
+    size: int = Field(nullable=False)
+    # Every timestamp is aware and stored as timestamptz, which asyncpg requires for aware values (the column type
+    # sqlmodel infers for datetime differs between its versions)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+
 class UserBase(SQLModel):
     email: EmailStr = Field(unique=True, nullable=False)
     # only alphanumeric characters and underscores
@@ -19,24 +31,36 @@ class UserBase(SQLModel):
     # check if birth_date is not in the future
     @field_validator("birth_date")
     def check_birth_date(cls, value):
-        if value > datetime.date.today():
+        if value > date.today():
             raise ValueError("Birth date cannot be in the future")
         return value
 
 class User(UserBase, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    profile_picture_link: str | None = Field(default=None, regex=r'^[\w-]+$')
+    profile_picture_link: str | None = Field(default=None, regex=r'^[\w/-]+$')
     hashed_password: str = Field(nullable=False)
-    session_token: str | None = Field(default=None, index=True)
-    signup_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    session_token: str | None = Field(default=None, unique=True, index=True)
+    signup_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+    # Bumped whenever the public profile changes, it's part of the ETags of every response embedding the user
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
 
-    listings: list["Listing"] = Relationship(back_populates="author", cascade_delete=True)
+    # passive_deletes leaves removing the listings to the FK's ON DELETE CASCADE instead of loading them all first.
+    # Relationships must be loaded eagerly by the query that needs them, an implicit per-row lazy load raises instead
+    listings: list["Listing"] = Relationship(
+        back_populates="author",
+        cascade_delete=True,
+        passive_deletes=True,
+        sa_relationship_kwargs={"lazy": "raise_on_sql"},
+    )
 
     @field_validator("profile_picture_link")
     def check_for_special_url_characters(cls, value):
-        for i in value:
-            if value in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
+        if value is None:
+            return value
+        for char in value:
+            if char in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
                 raise ValueError("Link contains invalid characters")
+        return value
 
 class UserCreate(UserBase):
     password: str = Field(min_length=8, max_length=128)
@@ -56,23 +80,41 @@ class UserCreate(UserBase):
 
 class UserGetPrivate(UserBase):
     id: uuid.UUID
-    profile_picture_link: str | None = Field(default=None, regex=r'^[\w-]+$')
+    profile_picture_link: str | None = Field(default=None, regex=r'^[\w/-]+$')
 
     @field_validator("profile_picture_link")
     def check_for_special_url_characters(cls, value):
-        for i in value:
-            if value in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
+        if value is None:
+            return value
+        for char in value:
+            if char in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
                 raise ValueError("Link contains invalid characters")
+        return value
+
+    # Resized, EXIF free copies of the picture: {"thumb": {"webp": link, "jpeg": link}, "medium": ..., "full": ...}
+    @computed_field
+    @property
+    def profile_picture_variants(self) -> dict[str, dict[str, str]] | None:
+        return image_variant_links(self.profile_picture_link)
 
 class UserGetPublic(SQLModel):
     username: str = Field(unique=True, min_length=3, max_length=20, regex=r'^[a-zA-Z0-9_]+$', nullable=False)
-    profile_picture_link: str | None = Field(default=None, regex=r'^[\w-]+$')
+    profile_picture_link: str | None = Field(default=None, regex=r'^[\w/-]+$')
 
     @field_validator("profile_picture_link")
     def check_for_special_url_characters(cls, value):
-        for i in value:
-            if value in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
+        if value is None:
+            return value
+        for char in value:
+            if char in {".", ":", "?", "#", "(", ")", "=", "@", "&", "+"}:
                 raise ValueError("Link contains invalid characters")
+        return value
+
+    # Resized, EXIF free copies of the picture: {"thumb": {"webp": link, "jpeg": link}, "medium": ..., "full": ...}
+    @computed_field
+    @property
+    def profile_picture_variants(self) -> dict[str, dict[str, str]] | None:
+        return image_variant_links(self.profile_picture_link)
 
 class UserUpdate(SQLModel):
     email: EmailStr | None = None
@@ -85,7 +127,7 @@ class UserUpdate(SQLModel):
 
     @field_validator("birth_date")
     def check_birth_date(cls, value):
-        if value > datetime.date.today():
+        if value > date.today():
             raise ValueError("Birth date cannot be in the future")
         return value
 
@@ -169,19 +211,84 @@ class ListingCategory(str, Enum):
     COLLECTIBLES = "collectibles"
     OTHER = "other"
 
+class ListingSort(str, Enum):
+    NEWEST = "newest"
+    PRICE_ASC = "price_asc"
+    PRICE_DESC = "price_desc"
+    RELEVANCE = "relevance"  # Only with a full-text search query
+
+class ListingExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
 class ListingBase(SQLModel):
     title: str = Field(max_length=150, nullable=False)
     description: str = Field(default="", max_length=1000)
-    category: ListingCategory = Field(nullable=False, index=True)
+    category: ListingCategory = Field(nullable=False)
     price: float = Field(default=0, ge=0, nullable=False)
 
 class Listing(ListingBase, table=True):
+    # Back the keyset pagination of GET /listings for every supported sort, with and without the equality filters
+    # (category, author) in front. Price sorts break ties like the newest sort, so (price, created_at, id) is unique too.
+    # The category and author ones also cover plain category lookups and the per-user listing counts
+    __table_args__ = (
+        Index("ix_listing_created_at_id", "created_at", "id"),
+        Index("ix_listing_category_created_at_id", "category", "created_at", "id"),
+        Index("ix_listing_author_id_created_at_id", "author_id", "created_at", "id"),
+        Index("ix_listing_price_created_at_id", "price", "created_at", "id"),
+        Index("ix_listing_category_price_created_at_id", "category", "price", "created_at", "id"),
+        Index("ix_listing_author_id_price_created_at_id", "author_id", "price", "created_at", "id"),
+        # Radius queries are turned into a few geo_cell ranges, see src/utils/geo.py
+        Index("ix_listing_geo_cell", "geo_cell"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     author_id: uuid.UUID = Field(nullable=False, foreign_key="user.id", ondelete="CASCADE")
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+    # Bumped on every change to the listing or its pictures, the listing's ETag and Last-Modified are derived from it
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+    # Maintained by src/utils/bookmarks.py, which applies the changes in periodic batches so it may lag slightly
+    bookmark_count: int = Field(default=0, nullable=False)
+    # Copied from the author's postal code (or city) when the listing is created and whenever the author moves,
+    # None if it couldn't be geocoded. geo_cell is the position as an integer geohash, see src/utils/geo.py
+    latitude: float | None = Field(default=None)
+    longitude: float | None = Field(default=None)
+    geo_cell: int | None = Field(default=None, sa_type=BigInteger)
+
+    author: User = Relationship(back_populates="listings", sa_relationship_kwargs={"lazy": "raise_on_sql"})
+    # Removed by the FK's ON DELETE CASCADE, their images must be released before the listing is deleted
+    pictures: list["ListingPicture"] = Relationship(
+        back_populates="listing",
+        cascade_delete=True,
+        passive_deletes=True,
+        sa_relationship_kwargs={"lazy": "raise_on_sql", "order_by": "ListingPicture.position"},
+    )
 
-    author: User = Relationship(back_populates="listings")
+class ListingPicture(SQLModel, table=True):
+    # Also backs the per-listing picture counts and loading a listing's pictures in order
+    __table_args__ = (
+        Index("ix_listingpicture_listing_id_position", "listing_id", "position"),
+    )
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    listing_id: uuid.UUID = Field(nullable=False, foreign_key="listing.id", ondelete="CASCADE")
+    link: str = Field(nullable=False, regex=r'^[\w/-]+$')
+    position: int = Field(default=0, nullable=False)  # Pictures are shown in ascending order, may have gaps
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+
+    listing: Listing = Relationship(back_populates="pictures", sa_relationship_kwargs={"lazy": "raise_on_sql"})
+
+class Bookmark(SQLModel, table=True):
+    # The primary key backs the "is bookmarked" lookups of a page of listings, the indexes back the user's bookmark
+    # feed (newest first) and the ON DELETE CASCADE of a listing
+    __table_args__ = (
+        Index("ix_bookmark_user_id_created_at_listing_id", "user_id", "created_at", "listing_id"),
+        Index("ix_bookmark_listing_id", "listing_id"),
+    )
+
+    user_id: uuid.UUID = Field(primary_key=True, foreign_key="user.id", ondelete="CASCADE")
+    listing_id: uuid.UUID = Field(primary_key=True, foreign_key="listing.id", ondelete="CASCADE")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
 
 class ListingCreate(ListingBase):
     pass
@@ -189,6 +296,18 @@ class ListingCreate(ListingBase):
 class ListingGet(ListingBase):
     id: uuid.UUID
     author_id: uuid.UUID
+    bookmark_count: int = 0
+
+class ListingPictureGet(SQLModel):
+    id: uuid.UUID
+    link: str
+    position: int
+
+    # Resized, EXIF free copies of the picture: {"thumb": {"webp": link, "jpeg": link}, "medium": ..., "full": ...}
+    @computed_field
+    @property
+    def variants(self) -> dict[str, dict[str, str]] | None:
+        return image_variant_links(self.link)
 
 class ListingUpdate(ListingBase):
     title: str | None = Field(default=None, max_length=150)
@@ -196,14 +315,103 @@ class ListingUpdate(ListingBase):
     category: ListingCategory | None = Field(default=None)
     price: float | None = Field(default=None, ge=0)
 
+    @field_validator("title", "description", "category", "price")
+    def check_not_null(cls, value):
+        # Fields can be left out, but not set to null, their columns are NOT NULL
+        if value is None:
+            raise ValueError("Can't be null")
+        return value
+
+
+class ListingBulkUpdate(ListingUpdate):
+    id: uuid.UUID
+
+class BulkRowResult(SQLModel):
+    index: int  # Of the row in the request
+    status: str  # created, updated, deleted, invalid, not_found, forbidden or duplicate
+    id: uuid.UUID | None = None
+    errors: list[dict] | None = None  # Validation errors of an invalid row
+
+class BulkResult(SQLModel):
+    results: list[BulkRowResult] = []
+    succeeded: int = 0
+    failed: int = 0
+
 
 class UserGetPublicWithListings(UserGetPublic):
+    # Only the newest few listings, the rest are paged through GET /users/{user_id}/listings?cursor=listings_next_cursor
     listings: list[ListingGet] = []
+    listings_next_cursor: str | None = None
+    listings_total: int = 0
+
+class UserListingPage(SQLModel):
+    listings: list[ListingGet] = []
+    next_cursor: str | None = None
 
 class ListingGetWithUser(ListingGet):
-    owner: UserGetPublic
+    owner: UserGetPublic = Field(validation_alias="author")  # Read from the Listing.author relationship
+
+class ListingGetWithPictures(ListingGetWithUser):
+    pictures: list[ListingPictureGet] = []
+
+class ListingPageEntry(ListingGetWithUser):
+    is_bookmarked: bool | None = None  # Whether the logged-in user bookmarked the listing, None for anonymous requests
+
+class ListingPage(SQLModel):
+    listings: list[ListingPageEntry] = []
+    # Pass as ?cursor= to get the next page, None on the last page
+    next_cursor: str | None = None
+
+
+class SavedSearchBase(SQLModel):
+    # Every given criterion must match, a search without any matches every new listing
+    category: ListingCategory | None = Field(default=None)
+    min_price: float | None = Field(default=None, ge=0)
+    max_price: float | None = Field(default=None, ge=0)
+    # Words that must all appear in the title or description, in any order and case
+    keywords: str | None = Field(default=None, min_length=1, max_length=200)
+    # Of the listing's author, compared case-insensitively
+    city: str | None = Field(default=None, min_length=1, max_length=85, regex=r'^[a-zA-Z\s]+$')
+
+class SavedSearch(SavedSearchBase, table=True):
+    # Backs listing a user's searches, the matcher loads new searches by created_at
+    __table_args__ = (
+        Index("ix_savedsearch_user_id", "user_id"),
+        Index("ix_savedsearch_created_at", "created_at"),
+    )
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    user_id: uuid.UUID = Field(nullable=False, foreign_key="user.id", ondelete="CASCADE")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+
+class SavedSearchMatch(SQLModel, table=True):
+    # One alert per user and new listing, however many of the user's searches it matches
+    __table_args__ = (
+        Index("ix_savedsearchmatch_user_id_created_at_listing_id", "user_id", "created_at", "listing_id"),
+        Index("ix_savedsearchmatch_listing_id", "listing_id"),
+        Index("ix_savedsearchmatch_saved_search_id", "saved_search_id"),
+    )
+
+    user_id: uuid.UUID = Field(primary_key=True, foreign_key="user.id", ondelete="CASCADE")
+    listing_id: uuid.UUID = Field(primary_key=True, foreign_key="listing.id", ondelete="CASCADE")
+    saved_search_id: uuid.UUID = Field(nullable=False, foreign_key="savedsearch.id", ondelete="CASCADE")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+
+    listing: Listing = Relationship(sa_relationship_kwargs={"lazy": "raise_on_sql"})
+
+class SavedSearchCreate(SavedSearchBase):
+    pass
+
+class SavedSearchGet(SavedSearchBase):
+    id: uuid.UUID
+    created_at: datetime
 
+class SavedSearchMatchGet(SQLModel):
+    saved_search_id: uuid.UUID
+    matched_at: datetime = Field(validation_alias="created_at")
+    listing: ListingGetWithUser
 
-#class Bookmark(SQLModel, table=True):
-#    user_id: uuid.UUID = Field(primary_key=True, foreign_key=user.id)
-#    listing_id: uuid.UUID = Field(primary_key=True, foreign_key=listing.id)
\ No newline at end of file
+class SavedSearchMatchPage(SQLModel):
+    matches: list[SavedSearchMatchGet] = []
+    # Pass as ?cursor= to get the next page, None on the last page
+    next_cursor: str | None = None
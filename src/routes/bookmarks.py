@@ -0,0 +1,50 @@
+from typing import Annotated
+import uuid
+
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..models import User, ListingPage
+from ..utils.listings import get_listing_by_id
+from ..utils.bookmarks import add_bookmark, remove_bookmark, get_bookmarks_page, bookmark_counter
+from ..dependencies import get_db_session, get_read_db_session, get_current_user
+
+router = APIRouter(prefix="/bookmarks", tags=["bookmarks"])
+
+obtain_session = Annotated[AsyncSession, Depends(get_db_session)]
+# Read-only endpoints, may be served by a replica
+obtain_read_session = Annotated[AsyncSession, Depends(get_read_db_session)]
+get_logged_in_user = Annotated[User, Depends(get_current_user)]
+
+@router.get("/", response_model=ListingPage)
+async def get_bookmarks(
+    session: obtain_read_session,
+    user: get_logged_in_user,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(gt=0, le=256)] = 32
+):
+    listings, next_cursor = await get_bookmarks_page(session, user.id, cursor, limit)
+    page = ListingPage.model_validate({"listings": listings, "next_cursor": next_cursor})
+    for entry in page.listings:
+        entry.is_bookmarked = True
+    return page
+
+@router.put("/{listing_id}", status_code=204)
+async def bookmark_listing(session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()]):
+    await get_listing_by_id(session, listing_id)  # 404 for unknown listings
+
+    is_new = await add_bookmark(session, user.id, listing_id)
+    await session.commit()
+    if is_new:
+        bookmark_counter.add(listing_id, 1)
+
+    return
+
+@router.delete("/{listing_id}", status_code=204)
+async def unbookmark_listing(session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()]):
+    if not await remove_bookmark(session, user.id, listing_id):
+        raise HTTPException(status_code=404, detail="Bookmark not found")
+    await session.commit()
+    bookmark_counter.add(listing_id, -1)
+
+    return
@@ -1,74 +1,469 @@
+from datetime import datetime, timezone
+import json
 from typing import Annotated
 import uuid
 
-from fastapi import APIRouter, Path, Query, Response, Depends
-from sqlmodel import Session
+from fastapi import APIRouter, BackgroundTasks, Body, HTTPException, Header, Path, Query, Request, Response, Depends
+from fastapi.responses import StreamingResponse
+from sqlmodel import select, insert, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..models import User, ListingCategory, Listing, ListingCreate, ListingGet, ListingGetWithUser, ListingUpdate
-from ..utils.listings import verify_listing_owner, get_listing_by_id
-from ..dependencies import get_db_session, get_current_user
+from ..app_config import LISTING_PICTURE_MAX_SIZE, LISTING_PICTURES_MAX_NUMBER, BULK_MAX_ROWS, GEO_MAX_RADIUS
+from ..models import User, ListingCategory, ListingSort, Listing, ListingCreate, ListingGet, ListingGetWithPictures, ListingUpdate, ListingPage
+from ..models import ListingPicture, ListingPictureGet, ListingExportFormat, ListingBulkUpdate, BulkRowResult, BulkResult
+from ..utils.listings import verify_listing_owner, get_listing_by_id, get_listings_page
+from ..utils.listings import listing_with_owner_projection, listing_page_entry_dicts
+from ..utils.listings import listing_page_cache_tags, invalidate_listing_pages
+from ..utils.response_cache import listing_page_cache
+from ..utils.exports import stream_listing_export, EXPORT_MEDIA_TYPES
+from ..utils.bulk import read_bulk_rows, validate_bulk_rows, bulk_response
+from ..utils.images import store_images, restore_released_images, release_image, delete_unreferenced_image
+from ..utils.image_store import image_storage
+from ..utils.image_variants import generate_variants_of_images
+from ..utils.uploads import receive_image_uploads, verify_uploaded_images, discard_uploaded_images
+from ..utils.fast_json import dump_json, load_json
+from ..utils.http_cache import make_etag, conditional_response
+from ..utils.search import listing_search_filter, listing_search_rank
+from ..utils.replicas import reads_from_primary
+from ..utils.bookmarks import get_bookmarked_ids
+from ..utils.saved_searches import saved_search_matcher
+from ..utils.geo import postal_code_table, listing_location, near_filters, normalize_postal_code
+from ..dependencies import get_db_session, get_read_db_session, get_current_user, get_optional_current_user
 
 router = APIRouter(prefix="/listings", tags=["listings"])
 
-obtain_session = Annotated[Session, Depends(get_db_session)]
+obtain_session = Annotated[AsyncSession, Depends(get_db_session)]
+# Read-only endpoints, may be served by a replica
+obtain_read_session = Annotated[AsyncSession, Depends(get_read_db_session)]
 get_logged_in_user = Annotated[User, Depends(get_current_user)]
+get_optional_user = Annotated[User | None, Depends(get_optional_current_user)]
+
+# The pictures are streamed straight from the request body, so the form has to be described by hand for the docs
+PICTURES_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"uploaded_files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                    "required": ["uploaded_files"],
+                }
+            }
+        },
+        "required": True,
+    }
+}
+
+# The rows are parsed from the raw body so that NDJSON is accepted too, every row is validated separately
+def bulk_rows_openapi(description: str) -> dict:
+    row_list = {"schema": {"type": "array", "items": {"type": "object"}, "description": description}}
+    return {"requestBody": {"content": {"application/json": row_list, "application/x-ndjson": row_list}, "required": True}}
 
 @router.post("/", status_code=201, response_model=ListingGet)
 async def create_listing(session: obtain_session, user: get_logged_in_user, listing: ListingCreate, response: Response):
-    new_listing = Listing.model_validate(ListingCreate, update={"author_id" : user.id})
-
-    new_listing = ensure_unique_listing_id(session, new_listing)
+    new_listing = Listing.model_validate(listing, update={"author_id" : user.id, **listing_location(user)})
 
+    # A single INSERT, the id is a random UUID and every other column is already set by the model
     session.add(new_listing)
-    session.commit()
-    session.refresh(new_listing)
+    await session.commit()
+    await invalidate_listing_pages(new_listing.category)
+    saved_search_matcher.submit(new_listing, user.city)
 
     response.headers["Location"] = f"/listings/{new_listing.id}"
     return new_listing
 
-@router.get("/", response_model=list[ListingGetWithUser])
+@router.get("/", response_model=ListingPage)
 async def query_listings(
-    session: obtain_session, 
-    offset: Annotated[int, Query(ge=0, lt=4294967296)] = 0,
+    session: obtain_read_session,
+    user: get_optional_user,
+    request: Request,
+    cursor: Annotated[str | None, Query()] = None,
+    # Deprecated: the DB has to scan every skipped row, use cursor instead
+    offset: Annotated[int | None, Query(ge=0, le=1024, deprecated=True)] = None,
     limit: Annotated[int, Query(gt=0, le=256)] = 32,
-    category: Annotated[ListingCategory | None, Query()] = None
+    category: Annotated[list[ListingCategory] | None, Query()] = None,  # Any of the given categories
+    min_price: Annotated[float | None, Query(ge=0)] = None,
+    max_price: Annotated[float | None, Query(ge=0)] = None,
+    author_id: Annotated[uuid.UUID | None, Query()] = None,
+    # Only these listings (?ids=...&ids=...), a multi-get in a single query
+    ids: Annotated[list[uuid.UUID] | None, Query()] = None,
+    # Full-text search over title and description
+    q: Annotated[str | None, Query(min_length=1, max_length=200)] = None,
+    # Listings within radius_km of this postal code, located at their author's postal code
+    near: Annotated[str | None, Query(min_length=4, max_length=10)] = None,
+    radius_km: Annotated[float, Query(gt=0, le=GEO_MAX_RADIUS)] = 10,
+    # Defaults to relevance when searching, newest otherwise
+    sort: Annotated[ListingSort | None, Query()] = None
 ):
-    if category is not None:
-        query_statement = select(Listing).where(Listing.category == category).offset(offset).limit(limit)
+    if cursor is not None and offset is not None:
+        raise HTTPException(status_code=400, detail="Use either cursor or offset, not both")
+
+    if sort is None:
+        sort = ListingSort.RELEVANCE if q is not None else ListingSort.NEWEST
+    if sort == ListingSort.RELEVANCE and q is None:
+        raise HTTPException(status_code=400, detail="Sorting by relevance requires a search query")
+
+    filters = []
+
+    if category:
+        filters.append(Listing.category.in_(category))
+    if min_price is not None:
+        filters.append(Listing.price >= min_price)
+    if max_price is not None:
+        filters.append(Listing.price <= max_price)
+    if author_id is not None:
+        filters.append(Listing.author_id == author_id)
+    if ids:
+        if len(ids) > limit:
+            raise HTTPException(status_code=400, detail="Ask for at most limit ids at once")
+        filters.append(Listing.id.in_(ids))
+    if q is not None:
+        filters.append(listing_search_filter(q))
+    if near is not None:
+        position = postal_code_table.locate_postal_code(near)
+        if position is None:
+            raise HTTPException(status_code=400, detail="Unknown postal code")
+        filters += near_filters(*position, radius_km)
+
+    sort_key = None
+    descending = True
+
+    if sort == ListingSort.RELEVANCE:
+        sort_key = listing_search_rank(q)
+    elif sort == ListingSort.PRICE_ASC:
+        sort_key = Listing.price
+        descending = False
+    elif sort == ListingSort.PRICE_DESC:
+        sort_key = Listing.price
+
+    async def render_page() -> bytes:
+        # Authors are joined in, only the columns of the response are read
+        rows, next_cursor = await get_listings_page(
+            session, filters, cursor, limit, offset, sort_key, descending, projection=listing_with_owner_projection
+        )
+
+        # The page's fingerprint covers every listing and author on it, the query itself is part of the URL
+        etag = make_etag(next_cursor, *(
+            part for row in rows for part in (row.id, row.updated_at, row.bookmark_count, row.author_updated_at)
+        ))
+        body = dump_json({"listings": listing_page_entry_dicts(rows), "next_cursor": next_cursor})
+        return etag.encode() + b"\n" + body
+
+    # Equivalent queries share a cache entry however their parameters were written
+    cache_key = json.dumps({
+        "cursor": cursor,
+        "offset": offset,
+        "limit": limit,
+        "category": sorted({category_value.value for category_value in category or []}),
+        "min_price": min_price,
+        "max_price": max_price,
+        "author_id": str(author_id) if author_id is not None else None,
+        "ids": sorted({str(listing_id) for listing_id in ids or []}),
+        "q": " ".join(q.split()) if q is not None else None,
+        "near": normalize_postal_code(near) if near is not None else None,
+        "radius_km": radius_km if near is not None else None,
+        "sort": sort.value,
+    }, sort_keys=True)
+
+    if reads_from_primary(request):
+        # The cached page may have been rendered on a replica that hasn't caught up with this client's write yet
+        page = await render_page()
     else:
-        query_statement = select(Listing).offset(offset).limit(limit)
+        # Author changes (e.g. a new username) aren't invalidated, they show up once the entry's TTL runs out
+        page = await listing_page_cache.get_or_render(cache_key, listing_page_cache_tags(category), render_page)
+    etag, body = page.split(b"\n", 1)
+    etag = etag.decode()
+
+    if user is not None:
+        # The cached page is shared by everyone, the user's own flags are added with one query for the whole page
+        page_data = load_json(body)
+        listing_ids = [uuid.UUID(entry["id"]) for entry in page_data["listings"]]
+        bookmarked_ids = await get_bookmarked_ids(session, user.id, listing_ids)
+        for listing_id, entry in zip(listing_ids, page_data["listings"]):
+            entry["is_bookmarked"] = listing_id in bookmarked_ids
+        body = dump_json(page_data)
+        etag = make_etag(etag, *sorted(bookmarked_ids))
+
+    # Already serialized, so it's returned as is instead of through the response model
+    page_response = Response(content=body, media_type="application/json")
+    not_modified = conditional_response(request, page_response, etag, vary="Authorization")
+    if not_modified is not None:
+        return not_modified
+
+    return page_response
+
+# The fixed paths below are declared before /{listing_id} so that e.g. "bulk" isn't taken for a listing id
+@router.post("/bulk", response_model=BulkResult, openapi_extra=bulk_rows_openapi("ListingCreate rows"))
+async def create_listings_bulk(session: obtain_session, user: get_logged_in_user, request: Request):
+    rows = await read_bulk_rows(request)
+    valid_rows, results = validate_bulk_rows(rows, ListingCreate)
+
+    location = listing_location(user)
+    new_listings = {
+        index: Listing.model_validate(listing, update={"author_id": user.id, **location}) for index, listing in valid_rows.items()
+    }
+
+    if new_listings:
+        # One executemany, sent by SQLAlchemy as multi-row INSERTs. The ids are random UUIDs, like in
+        # create_listing a collision would fail the primary key
+        await session.exec(insert(Listing), params=[listing.model_dump() for listing in new_listings.values()])
+        await session.commit()
+        await invalidate_listing_pages(*{listing.category for listing in new_listings.values()})
+        for listing in new_listings.values():
+            saved_search_matcher.submit(listing, user.city)
+
+    results += [BulkRowResult(index=index, status="created", id=listing.id) for index, listing in new_listings.items()]
+    return bulk_response(results)
+
+@router.patch("/bulk", response_model=BulkResult, openapi_extra=bulk_rows_openapi("ListingBulkUpdate rows, i.e. ListingUpdate with the id"))
+async def update_listings_bulk(session: obtain_session, user: get_logged_in_user, request: Request):
+    rows = await read_bulk_rows(request)
+    valid_rows, results = validate_bulk_rows(rows, ListingBulkUpdate)
+
+    # The listings of all rows are loaded, and their owners checked, with a single query
+    listing_ids = {update.id for update in valid_rows.values()}
+    listings = {listing.id: listing for listing in (await session.exec(select(Listing).where(Listing.id.in_(listing_ids)))).all()}
+
+    changed_categories = set()
+    now = datetime.now(timezone.utc)
+
+    for index, update in valid_rows.items():
+        listing = listings.get(update.id)
+        if listing is None:
+            results.append(BulkRowResult(index=index, status="not_found", id=update.id))
+            continue
+        if listing.author_id != user.id:
+            results.append(BulkRowResult(index=index, status="forbidden", id=update.id))
+            continue
+
+        changed_categories.add(listing.category)
+        listing.sqlmodel_update(update.model_dump(exclude_unset=True, exclude={"id"}), update={"updated_at": now})
+        changed_categories.add(listing.category)
+        results.append(BulkRowResult(index=index, status="updated", id=update.id))
+
+    if changed_categories:
+        # Flushed as one batch of UPDATEs in a single transaction
+        session.add_all(listings.values())
+        await session.commit()
+        await invalidate_listing_pages(*changed_categories)
+
+    return bulk_response(results)
+
+@router.delete("/bulk", response_model=BulkResult)
+async def delete_listings_bulk(
+    session: obtain_session, user: get_logged_in_user,
+    listing_ids: Annotated[list[uuid.UUID], Body(min_length=1, max_length=BULK_MAX_ROWS)]
+):
+    # Owners and categories of all listings in a single query, without loading the listings themselves
+    found = {
+        listing_id: (author_id, category)
+        for listing_id, author_id, category in (await session.exec(
+            select(Listing.id, Listing.author_id, Listing.category).where(Listing.id.in_(set(listing_ids)))
+        )).all()
+    }
+
+    results = []
+    owned_ids = set()
+    seen_ids = set()
+    for index, listing_id in enumerate(listing_ids):
+        # A repeated id is only acted on (and counted) at its first occurrence
+        if listing_id in seen_ids:
+            results.append(BulkRowResult(index=index, status="duplicate", id=listing_id))
+            continue
+        seen_ids.add(listing_id)
+
+        if listing_id not in found:
+            results.append(BulkRowResult(index=index, status="not_found", id=listing_id))
+        elif found[listing_id][0] != user.id:
+            results.append(BulkRowResult(index=index, status="forbidden", id=listing_id))
+        else:
+            owned_ids.add(listing_id)
+            results.append(BulkRowResult(index=index, status="deleted", id=listing_id))
+
+    if owned_ids:
+        picture_links = (await session.exec(select(ListingPicture.link).where(ListingPicture.listing_id.in_(owned_ids)))).all()
+        unreferenced_pictures = [await release_image(session, picture_link) for picture_link in picture_links]
+
+        await session.exec(delete(ListingPicture).where(ListingPicture.listing_id.in_(owned_ids)))
+        await session.exec(delete(Listing).where(Listing.id.in_(owned_ids)))
+        await session.commit()
+        await invalidate_listing_pages(*{found[listing_id][1] for listing_id in owned_ids})
+
+        for unreferenced_picture in unreferenced_pictures:
+            await delete_unreferenced_image(session, unreferenced_picture)
+
+    return bulk_response(results)
+
+@router.get("/export", response_class=StreamingResponse, responses={200: {"content": {media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()}}})
+async def export_listings(
+    format: Annotated[ListingExportFormat, Query()] = ListingExportFormat.NDJSON,
+    category: Annotated[list[ListingCategory] | None, Query()] = None,
+    author_id: Annotated[uuid.UUID | None, Query()] = None,
+    # Resumes an interrupted export, listings are exported in ascending id order
+    after: Annotated[uuid.UUID | None, Query()] = None,
+    accept_encoding: Annotated[str, Header()] = ""
+):
+    filters = []
+
+    if category:
+        filters.append(Listing.category.in_(category))
+    if author_id is not None:
+        filters.append(Listing.author_id == author_id)
+    if after is not None:
+        filters.append(Listing.id > after)
 
-    listings = session.exec(query_statement).all()
+    compress = "gzip" in accept_encoding.lower()
 
-    return listings
+    headers = {"Content-Disposition": f'attachment; filename="listings.{format.value}"', "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
 
-@router.get("/{listing_id}", response_model=ListingGetWithUser)
-async def get_listing(session: obtain_session, listing_id: Annotated[uuid.UUID, Path()]):
-    return get_listing_by_id(session, listing_id)
+    return StreamingResponse(
+        stream_listing_export(filters, format, compress), media_type=EXPORT_MEDIA_TYPES[format], headers=headers
+    )
+
+@router.get("/{listing_id}", response_model=ListingGetWithPictures)
+async def get_listing(session: obtain_read_session, listing_id: Annotated[uuid.UUID, Path()], request: Request, response: Response):
+    listing = await get_listing_by_id(session, listing_id, load_author=True, load_pictures=True)
+
+    # The embedded owner can change independently of the listing. No Last-Modified, flushing the bookmark count
+    # changes the body without any timestamp moving forward
+    etag = make_etag(listing.id, listing.updated_at, listing.bookmark_count, listing.author.updated_at)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    return listing
 
 @router.patch("/{listing_id}", response_model=ListingGet)
 async def update_listing(session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()], updated_listing: ListingUpdate):
-    listing = get_listing_by_id(session, listing_id)
+    listing = await get_listing_by_id(session, listing_id)
 
     verify_listing_owner(listing.author_id, user.id)
 
     updated_listing_data = updated_listing.model_dump(exclude_unset=True)
+    previous_category = listing.category
 
-    listing.sqlmodel_update(updated_listing_data)
+    listing.sqlmodel_update(updated_listing_data, update={"updated_at": datetime.now(timezone.utc)})
 
     session.add(listing)
-    session.commit()
-    session.refresh(listing)
+    await session.commit()
+    await session.refresh(listing)
+    # A moved listing leaves the pages of its old category too
+    await invalidate_listing_pages(previous_category, listing.category)
 
     return listing
 
 @router.delete("/{listing_id}", status_code=204)
 async def delete_listing(session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()]):
-    listing = get_listing_by_id(session, listing_id)
+    listing = await get_listing_by_id(session, listing_id, load_pictures=True)
+
+    verify_listing_owner(listing.author_id, user.id)
+
+    unreferenced_pictures = [await release_image(session, picture.link) for picture in listing.pictures]
+
+    await session.delete(listing)
+    await session.commit()
+    await invalidate_listing_pages(listing.category)
+
+    for unreferenced_picture in unreferenced_pictures:
+        await delete_unreferenced_image(session, unreferenced_picture)
+
+    return
+
+@router.get("/{listing_id}/pictures", response_model=list[ListingPictureGet])
+async def get_listing_pictures(session: obtain_read_session, listing_id: Annotated[uuid.UUID, Path()]):
+    listing = await get_listing_by_id(session, listing_id, load_pictures=True)
+    return listing.pictures
+
+@router.post("/{listing_id}/pictures", status_code=201, response_model=list[ListingPictureGet], openapi_extra=PICTURES_UPLOAD_OPENAPI)
+async def upload_listing_pictures(
+    session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()],
+    request: Request, response: Response, background_tasks: BackgroundTasks
+):
+    listing = await get_listing_by_id(session, listing_id, load_pictures=True)
+
+    verify_listing_owner(listing.author_id, user.id)
+
+    # The per-listing limit is turned into a file count limit, so extra files are rejected while they're being received
+    free_slots = LISTING_PICTURES_MAX_NUMBER - len(listing.pictures)
+    if free_slots <= 0:
+        raise HTTPException(status_code=400, detail=f"A listing can have at most {LISTING_PICTURES_MAX_NUMBER} pictures")
+
+    uploaded_pictures = await receive_image_uploads(
+        request, "uploaded_files", LISTING_PICTURE_MAX_SIZE * 1024 * 1024, max_files=free_slots
+    )
+    await verify_uploaded_images(uploaded_pictures)
+
+    stored_pictures = await store_images(session, uploaded_pictures)
+    try:
+        next_position = max((picture.position for picture in listing.pictures), default=-1) + 1
+        new_pictures = [
+            ListingPicture(listing_id=listing.id, link=image_storage.link(key), position=next_position + index)
+            for index, (key, _) in enumerate(stored_pictures)
+        ]
+
+        listing.updated_at = datetime.now(timezone.utc)
+
+        session.add(listing)
+        session.add_all(new_pictures)
+        await session.commit()
+        await restore_released_images(uploaded_pictures)
+    finally:
+        await discard_uploaded_images(uploaded_pictures)
+
+    # The resized variants of all new files are generated concurrently after the response is sent
+    background_tasks.add_task(
+        generate_variants_of_images, [image_storage.relative_path(key) for key, is_new_file in stored_pictures if is_new_file]
+    )
+
+    response.headers["Location"] = f"/listings/{listing.id}/pictures"
+    return new_pictures
+
+@router.put("/{listing_id}/pictures/order", response_model=list[ListingPictureGet])
+async def reorder_listing_pictures(
+    session: obtain_session, user: get_logged_in_user, listing_id: Annotated[uuid.UUID, Path()],
+    picture_ids: Annotated[list[uuid.UUID], Body()]
+):
+    listing = await get_listing_by_id(session, listing_id, load_pictures=True)
+
+    verify_listing_owner(listing.author_id, user.id)
+
+    pictures_by_id = {picture.id: picture for picture in listing.pictures}
+    if len(picture_ids) != len(pictures_by_id) or set(picture_ids) != set(pictures_by_id):
+        raise HTTPException(status_code=400, detail="The order must list every picture of the listing exactly once")
+
+    for position, picture_id in enumerate(picture_ids):
+        pictures_by_id[picture_id].position = position
+    listing.updated_at = datetime.now(timezone.utc)
+
+    session.add(listing)
+    session.add_all(pictures_by_id.values())
+    await session.commit()
+
+    return [pictures_by_id[picture_id] for picture_id in picture_ids]
+
+@router.delete("/{listing_id}/pictures/{picture_id}", status_code=204)
+async def delete_listing_picture(
+    session: obtain_session, user: get_logged_in_user,
+    listing_id: Annotated[uuid.UUID, Path()], picture_id: Annotated[uuid.UUID, Path()]
+):
+    listing = await get_listing_by_id(session, listing_id)
 
     verify_listing_owner(listing.author_id, user.id)
 
-    session.delete(listing)
-    session.commit()
+    picture = (await session.exec(
+        select(ListingPicture).where(ListingPicture.id == picture_id, ListingPicture.listing_id == listing.id)
+    )).first()
+    if picture is None:
+        raise HTTPException(status_code=404, detail="Picture not found")
+
+    unreferenced_picture = await release_image(session, picture.link)
+    listing.updated_at = datetime.now(timezone.utc)
+
+    session.add(listing)
+    await session.delete(picture)
+    await session.commit()
+    await delete_unreferenced_image(session, unreferenced_picture)
 
     return
\ No newline at end of file
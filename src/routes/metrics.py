@@ -0,0 +1,37 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..dependencies import session_token_cache
+from ..utils.metrics import Counter, Gauge, render_metrics
+from ..utils.response_cache import listing_page_cache
+from ..utils.workers import password_hashing_pool, image_processing_pool
+
+router = APIRouter(tags=["metrics"])
+
+# Read from the existing stats when scraped
+Gauge(
+    "cache_hit_rate", "Share of lookups answered from the cache", ("cache",),
+    callback=lambda: {
+        ("session_token",): session_token_cache.stats()["hit_rate"],
+        ("listing_page",): listing_page_cache.stats()["hit_rate"],
+    },
+)
+Counter(
+    "cache_lookups_total", "Cache lookups by outcome", ("cache", "outcome"),
+    callback=lambda: {
+        ("session_token", "hit"): session_token_cache.hits,
+        ("session_token", "miss"): session_token_cache.misses,
+        ("listing_page", "hit"): listing_page_cache.hits,
+        ("listing_page", "miss"): listing_page_cache.misses,
+        ("listing_page", "coalesced"): listing_page_cache.coalesced,
+    },
+)
+Gauge(
+    "worker_pool_pending", "Calls running or waiting on a worker pool", ("pool",),
+    callback=lambda: {(pool.name,): pool.pending for pool in (password_hashing_pool, image_processing_pool)},
+)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
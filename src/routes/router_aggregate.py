@@ -3,9 +3,15 @@ from fastapi import APIRouter
 from . import users
 from . import tokens
 from . import listings
+from . import metrics
+from . import bookmarks
+from . import saved_searches
 
 router = APIRouter()
 
 router.include_router(users.router)
 router.include_router(tokens.router)
-router.include_router(listings.router)
\ No newline at end of file
+router.include_router(listings.router)
+router.include_router(bookmarks.router)
+router.include_router(saved_searches.router)
+router.include_router(metrics.router)
\ No newline at end of file
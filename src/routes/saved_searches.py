@@ -0,0 +1,71 @@
+from typing import Annotated
+import uuid
+
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from sqlmodel import select, delete, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..app_config import SAVED_SEARCHES_MAX_PER_USER
+from ..models import User, SavedSearch, SavedSearchCreate, SavedSearchGet, SavedSearchMatchPage
+from ..utils.saved_searches import normalize_keywords, saved_search_matcher, get_matches_page
+from ..dependencies import get_db_session, get_read_db_session, get_current_user
+
+router = APIRouter(prefix="/saved-searches", tags=["saved searches"])
+
+obtain_session = Annotated[AsyncSession, Depends(get_db_session)]
+# Read-only endpoints, may be served by a replica
+obtain_read_session = Annotated[AsyncSession, Depends(get_read_db_session)]
+get_logged_in_user = Annotated[User, Depends(get_current_user)]
+
+MAX_KEYWORDS = 10
+
+@router.post("/", status_code=201, response_model=SavedSearchGet)
+async def create_saved_search(session: obtain_session, user: get_logged_in_user, saved_search: SavedSearchCreate):
+    if saved_search.min_price is not None and saved_search.max_price is not None and saved_search.min_price > saved_search.max_price:
+        raise HTTPException(status_code=400, detail="min_price can't be greater than max_price")
+
+    keywords = normalize_keywords(saved_search.keywords)
+    if saved_search.keywords is not None and keywords is None:
+        raise HTTPException(status_code=400, detail="Keywords must contain at least one word")
+    if keywords is not None and len(keywords.split()) > MAX_KEYWORDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_KEYWORDS} keywords are allowed")
+
+    saved_searches_count = (await session.exec(
+        select(func.count()).select_from(SavedSearch).where(SavedSearch.user_id == user.id)
+    )).one()
+    if saved_searches_count >= SAVED_SEARCHES_MAX_PER_USER:
+        raise HTTPException(status_code=400, detail=f"At most {SAVED_SEARCHES_MAX_PER_USER} saved searches are allowed")
+
+    new_saved_search = SavedSearch.model_validate(saved_search, update={"user_id": user.id, "keywords": keywords})
+
+    session.add(new_saved_search)
+    await session.commit()
+    saved_search_matcher.add(new_saved_search)
+
+    return new_saved_search
+
+@router.get("/", response_model=list[SavedSearchGet])
+async def get_saved_searches(session: obtain_read_session, user: get_logged_in_user):
+    return (await session.exec(
+        select(SavedSearch).where(SavedSearch.user_id == user.id).order_by(SavedSearch.created_at)
+    )).all()
+
+@router.get("/matches", response_model=SavedSearchMatchPage)
+async def get_saved_search_matches(
+    session: obtain_read_session,
+    user: get_logged_in_user,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(gt=0, le=256)] = 32
+):
+    matches, next_cursor = await get_matches_page(session, user.id, cursor, limit)
+    return {"matches": matches, "next_cursor": next_cursor}
+
+@router.delete("/{saved_search_id}", status_code=204)
+async def delete_saved_search(session: obtain_session, user: get_logged_in_user, saved_search_id: Annotated[uuid.UUID, Path()]):
+    result = await session.exec(delete(SavedSearch).where(SavedSearch.id == saved_search_id, SavedSearch.user_id == user.id))
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    await session.commit()
+    saved_search_matcher.remove(saved_search_id)
+
+    return
@@ -2,37 +2,39 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..models import User
-from ..utils.tokens import generate_unique_session_token, authenticate_user
-from ..dependencies import get_db_session, get_current_user
+from ..utils.tokens import generate_session_token, authenticate_user
+from ..dependencies import get_db_session, get_current_user, invalidate_cached_user
 
 router = APIRouter(prefix="/tokens", tags=["tokens"])
 
-obtain_session = Annotated[Session, Depends(get_db_session)]
+obtain_session = Annotated[AsyncSession, Depends(get_db_session)]
 get_logged_in_user = Annotated[User, Depends(get_current_user)]
 
 @router.post("/")
 async def login(session: obtain_session, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    authenticated_user = authenticate_user(session, form_data.username, form_data.password)
+    authenticated_user = await authenticate_user(session, form_data.username, form_data.password)
 
-    if authenticated_user.session_token is not None:
-        return authenticated_user.session_token
-
-    new_token = generate_unique_session_token(session)
+    # Every login rotates the user's token, which revokes the previous one
+    new_token = generate_session_token()
 
+    old_token = authenticated_user.session_token
     authenticated_user.session_token = new_token
     session.add(authenticated_user)
-    session.commit()
+    await session.commit()
+    invalidate_cached_user(old_token)
 
     return {"access_token": new_token, "token_type": "bearer"}
 
 @router.delete("/")
 async def logout(session: obtain_session, user: get_logged_in_user):
+    old_token = user.session_token
     user.session_token = None
 
     session.add(user)
-    session.commit()
+    await session.commit()
+    invalidate_cached_user(old_token)
 
     return
\ No newline at end of file
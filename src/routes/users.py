@@ -1,34 +1,66 @@
+from datetime import datetime, timezone
 from typing import Annotated
 import uuid
 
-from fastapi import APIRouter, HTTPException, Path, Header, Response, Depends, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Path, Query, Request, Response, Depends
 from fastapi.responses import FileResponse
-from sqlmodel import Session
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.exc import IntegrityError
 
-from ..app_config import PROFILE_PICTURE_MAX_SIZE, IMAGES_ENDPOINT, IMAGES_FOLDER_PATH
+from ..app_config import PROFILE_PICTURE_MAX_SIZE, USER_PROFILE_LISTINGS_LIMIT
 from ..logging_config import logger
-from ..models import User, UserCreate, UserGetPrivate, UserGetPublicWithListings, UserUpdate
-from ..utils.users import check_unique_new_user, ensure_unique_user_id, hash_password, get_user_by_id
-from ..utils.images import ensure_unique_image_name, delete_profile_picture
-from ..dependencies import get_db_session, get_current_user
+from ..models import User, UserCreate, UserGetPrivate, UserGetPublic, UserGetPublicWithListings, UserUpdate, UserListingPage, Listing, ListingCategory, ListingPicture, Bookmark
+from ..utils.users import USER_UNIQUE_VIOLATIONS, hash_password, get_user_by_id
+from ..utils.constraints import raise_for_violation
+from ..utils.listings import get_listings_page, count_user_listings, invalidate_listing_pages
+from ..utils.listings import listing_get_projection, listing_get_dict
+from ..utils.images import store_image, restore_released_images, release_image, delete_unreferenced_image
+from ..utils.image_store import image_storage
+from ..utils.uploads import receive_image_uploads, verify_uploaded_images, discard_uploaded_images, UploadedImage
+from ..utils.image_variants import generate_image_variants
+from ..utils.fast_json import dump_json
+from ..utils.http_cache import make_etag, conditional_response
+from ..utils.bookmarks import bookmark_counter
+from ..utils.geo import listing_location
+from ..dependencies import get_db_session, get_read_db_session, get_current_user, invalidate_cached_user
 
 router = APIRouter(prefix="/users", tags=["users"])
 
-obtain_session = Annotated[Session, Depends(get_db_session)]
+obtain_session = Annotated[AsyncSession, Depends(get_db_session)]
+# Read-only endpoints, may be served by a replica
+obtain_read_session = Annotated[AsyncSession, Depends(get_read_db_session)]
 get_logged_in_user = Annotated[User, Depends(get_current_user)]
 
+# The picture is streamed straight from the request body instead of going through an UploadFile parameter,
+# so the form has to be described by hand for the docs
+PICTURE_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"uploaded_file": {"type": "string", "format": "binary"}},
+                    "required": ["uploaded_file"],
+                }
+            }
+        },
+        "required": True,
+    }
+}
+
 @router.post("/", status_code=201, response_model=UserGetPrivate)
 async def create_user(session: obtain_session, user: UserCreate, response: Response):
-    new_hashed_password = hash_password(user.password)
+    new_hashed_password = await hash_password(user.password)
     new_user = User.model_validate(user, update={"hashed_password": new_hashed_password})
 
-    check_unique_new_user(session, new_user)
-    new_user = ensure_unique_user_id(session, new_user)
-
-    session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    # A single INSERT, taken usernames and emails are reported by the DB's unique constraints instead of a SELECT first
+    try:
+        session.add(new_user)
+        await session.commit()
+    except IntegrityError as e:
+        await session.rollback()
+        raise_for_violation(e, USER_UNIQUE_VIOLATIONS, status_code=409)
 
     response.headers["Location"] = "/users/me"
     return new_user
@@ -38,8 +70,59 @@ async def get_user(user: get_logged_in_user):
     return user
 
 @router.get("/{user_id}", response_model=UserGetPublicWithListings)
-async def get_user_public(session: obtain_session, user_id: Annotated[uuid.UUID, Path()]):
-    return get_user_by_id(session, user_id)
+async def get_user_public(session: obtain_read_session, user_id: Annotated[uuid.UUID, Path()], request: Request):
+    user = await get_user_by_id(session, user_id)
+
+    rows, next_cursor = await get_listings_page(
+        session, [Listing.author_id == user_id], None, USER_PROFILE_LISTINGS_LIMIT, projection=listing_get_projection
+    )
+    listings_total = await count_user_listings(session, user_id)
+
+    # No Last-Modified, a deleted listing changes the body without any timestamp moving forward
+    etag = make_etag(user.id, user.updated_at, listings_total, next_cursor, *(part for row in rows for part in (row.id, row.updated_at, row.bookmark_count)))
+
+    # Serialized here instead of through the response model, the listings are built from their rows directly
+    user_response = Response(content=dump_json({
+        **UserGetPublic.model_validate(user).model_dump(),
+        "listings": [listing_get_dict(row) for row in rows],
+        "listings_next_cursor": next_cursor,
+        "listings_total": listings_total,
+    }), media_type="application/json")
+    not_modified = conditional_response(request, user_response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    return user_response
+
+@router.get("/{user_id}/listings", response_model=UserListingPage)
+async def get_user_listings(
+    session: obtain_read_session,
+    user_id: Annotated[uuid.UUID, Path()],
+    request: Request,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(gt=0, le=256)] = 32,
+    category: Annotated[ListingCategory | None, Query()] = None
+):
+    await get_user_by_id(session, user_id)  # 404 for unknown users rather than an empty page
+
+    filters = [Listing.author_id == user_id]
+
+    if category is not None:
+        filters.append(Listing.category == category)
+
+    rows, next_cursor = await get_listings_page(session, filters, cursor, limit, projection=listing_get_projection)
+
+    etag = make_etag(next_cursor, *(part for row in rows for part in (row.id, row.updated_at, row.bookmark_count)))
+
+    page_response = Response(
+        content=dump_json({"listings": [listing_get_dict(row) for row in rows], "next_cursor": next_cursor}),
+        media_type="application/json"
+    )
+    not_modified = conditional_response(request, page_response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    return page_response
 
 @router.patch("/me", response_model=UserGetPrivate)
 async def update_user(session: obtain_session, user: get_logged_in_user, updated_user: UserUpdate):
@@ -47,107 +130,109 @@ async def update_user(session: obtain_session, user: get_logged_in_user, updated
 
     extra_data = {}
     if "password" in updated_user_data:
-        new_password = updated_user["password"]
-        new_hashed_password = hash_password(new_password)
+        new_password = updated_user_data["password"]
+        new_hashed_password = await hash_password(new_password)
         extra_data["hashed_password"] = new_hashed_password
 
+    extra_data["updated_at"] = datetime.now(timezone.utc)
+
     user.sqlmodel_update(updated_user_data, update=extra_data)
 
+    moved = "postal_code" in updated_user_data or "city" in updated_user_data
+
     try:
         session.add(user)
-        session.commit()
-        session.refresh(user)
+        # Flushed first so that a taken username or email fails here, not in the UPDATE's autoflush
+        await session.flush()
+        # The user's listings are located where the user is
+        if moved:
+            await session.exec(update(Listing).where(Listing.author_id == user.id).values(**listing_location(user)))
+        await session.commit()
     # check for uniqueness violation
-    except IntegrityError as excep:
-        session.rollback()
-        error_message = str(e.orig)
-        if "UNIQUE constraint failed" in error_message:
-            logger.info(f"Attempted patch to User model with non-unique data: {error_message}")
-            if "email" in error_message:
-                raise HTTPException(status_code=400, detail="Email already exists")
-            elif "username" in error_message:
-                raise HTTPException(status_code=400, detail="Username already exists")
-            else:
-                raise HTTPException(status_code=400, detail="Unique constraint violation")
-        raise # if the integrity error was somehow not related to uniqueness
-
+    except IntegrityError as e:
+        await session.rollback()
+        logger.info("Attempted patch to User model with non-unique data: %s", e.orig)
+        raise_for_violation(e, USER_UNIQUE_VIOLATIONS, status_code=400)
+
+    invalidate_cached_user(user.session_token)
+    if moved:
+        await invalidate_listing_pages(*(await session.exec(select(Listing.category).where(Listing.author_id == user.id).distinct())).all())
     return user
 
 @router.delete("/me", status_code=204)
 async def delete_user(session: obtain_session, user: get_logged_in_user):
-    session.delete(user)
-    session.commit()
+    # The user's listings and their pictures go with the user through ON DELETE CASCADE, so the images are released first
+    listing_picture_links = (await session.exec(
+        select(ListingPicture.link).join(Listing).where(Listing.author_id == user.id)
+    )).all()
+    listing_categories = (await session.exec(select(Listing.category).where(Listing.author_id == user.id).distinct())).all()
+    picture_links = [user.profile_picture_link, *listing_picture_links]
+    unreferenced_pictures = [await release_image(session, picture_link) for picture_link in picture_links]
+    # The user's bookmarks are removed by the cascade too, the other listings' counts must go down with them
+    bookmarked_listing_ids = (await session.exec(select(Bookmark.listing_id).where(Bookmark.user_id == user.id))).all()
+
+    await session.delete(user)
+    await session.commit()
+    invalidate_cached_user(user.session_token)
+    for listing_id in bookmarked_listing_ids:
+        bookmark_counter.add(listing_id, -1)
+    await invalidate_listing_pages(*listing_categories)
+    for unreferenced_picture in unreferenced_pictures:
+        await delete_unreferenced_image(session, unreferenced_picture)
 
     return
 
-@router.post("/me/picture", status_code=201)
-async def upload_profile_picture(
-    session: obtain_session, 
-    user: get_logged_in_user, 
-    uploaded_file: Annotated[UploadFile, File()], 
-    content_lenght: Annotated[int, Header()],
-    response: Response
-):
-    if content_lenght > PROFILE_PICTURE_MAX_SIZE * 1024 * 1024:
-        raise HTTPException(status_code=400, detail=f"File size must not exceed {PROFILE_PICTURE_MAX_SIZE}MB")
-
-    if uploaded_file.content_type not in {"image/jpeg", "image/png"}:
-        raise HTTPException(status_code=400, detail="File type must be either JPEG or PNG")
-
-    new_picture_name = ensure_unique_image_name(user.username)  # We want the filename to be username+uuid
-    new_picture_path = os.path.join(IMAGES_FOLDER_PATH, new_picture_name)
-
-    with open(new_picture_path, "wb") as new_picture:
-        new_picture.write(await file.read())
-
-    relative_path = f"{IMAGES_ENDPOINT}/{new_picture_name}"
-    user.profile_picture_link = relative_path
+@router.post("/me/picture", status_code=201, openapi_extra=PICTURE_UPLOAD_OPENAPI)
+async def upload_profile_picture(session: obtain_session, user: get_logged_in_user, request: Request, background_tasks: BackgroundTasks):
+    uploaded_picture, = await receive_image_uploads(request, "uploaded_file", PROFILE_PICTURE_MAX_SIZE * 1024 * 1024)
 
-    session.add(user)
-    session.commit()
+    return await set_profile_picture(session, user, uploaded_picture, background_tasks)
 
-    response.headers["Location"] = relative_path
-    return FileResponse(new_picture_path)
-
-@router.put("/me/picture", status_code=201)
+@router.put("/me/picture", status_code=201, openapi_extra=PICTURE_UPLOAD_OPENAPI)
 async def replace_profile_picture(
-    *,
-    session: obtain_session, 
-    user: get_logged_in_user, 
-    uploaded_file: Annotated[UploadFile | None, File()] = None, 
-    content_lenght: Annotated[int | None, Header()] = None,
-    response: Response
+    session: obtain_session, user: get_logged_in_user, request: Request, response: Response, background_tasks: BackgroundTasks
 ):
-    if content_lenght is None or uploaded_file is None:
-        delete_profile_picture(user)
+    # A request without a file removes the current picture
+    if "multipart/form-data" not in request.headers.get("content-type", ""):
+        unreferenced_picture = await release_image(session, user.profile_picture_link)
         user.profile_picture_link = None
-        
+        user.updated_at = datetime.now(timezone.utc)
+
         session.add(user)
-        session.commit()
+        await session.commit()
+        invalidate_cached_user(user.session_token)
+        await delete_unreferenced_image(session, unreferenced_picture)
 
         response.status_code = 204
         return
-    
-    if content_lenght > PROFILE_PICTURE_MAX_SIZE * 1024 * 1024:
-        raise HTTPException(status_code=400, detail=f"File size must not exceed {PROFILE_PICTURE_MAX_SIZE}MB")
-
-    if uploaded_file.content_type not in {"image/jpeg", "image/png"}:
-        raise HTTPException(status_code=400, detail="File type must be either JPEG or PNG")
 
-    # If we've got a valid new picture, delete the old one first (if there is one)
-    delete_profile_picture(user)
+    uploaded_picture, = await receive_image_uploads(request, "uploaded_file", PROFILE_PICTURE_MAX_SIZE * 1024 * 1024)
 
-    new_picture_name = ensure_unique_image_name(user.username)  # We want the filename to be username+uuid
-    new_picture_path = os.path.join(IMAGES_FOLDER_PATH, new_picture_name)
+    return await set_profile_picture(session, user, uploaded_picture, background_tasks)
 
-    with open(new_picture_path, "wb") as new_picture:
-        new_picture.write(await file.read())
+async def set_profile_picture(session: AsyncSession, user: User, uploaded_picture: UploadedImage, background_tasks: BackgroundTasks):
+    await verify_uploaded_images([uploaded_picture])
 
-    relative_path = f"{IMAGES_ENDPOINT}/{new_picture_name}"
-    user.profile_picture_link = relative_path
+    picture_key, is_new_file = await store_image(session, uploaded_picture)
+    try:
+        # Only dropped once the new picture is in place, the old one is deleted if nothing else uses it
+        unreferenced_picture = await release_image(session, user.profile_picture_link)
 
-    session.add(user)
-    session.commit()
+        picture_link = image_storage.link(picture_key)
+        user.profile_picture_link = picture_link
+        user.updated_at = datetime.now(timezone.utc)
 
-    response.headers["Location"] = relative_path
-    return FileResponse(new_picture_path)
\ No newline at end of file
+        session.add(user)
+        await session.commit()
+        await restore_released_images([uploaded_picture])
+    finally:
+        await discard_uploaded_images([uploaded_picture])
+    invalidate_cached_user(user.session_token)
+    await delete_unreferenced_image(session, unreferenced_picture)
+
+    # The resized variants are generated after the response is sent, identical images already have them
+    if is_new_file:
+        background_tasks.add_task(generate_image_variants, image_storage.relative_path(picture_key))
+
+    # A returned Response is sent as is, so the status and headers have to be set on it directly
+    return FileResponse(image_storage.local_path(picture_key), status_code=201, headers={"Location": picture_link})
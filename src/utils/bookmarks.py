@@ -0,0 +1,128 @@
+import asyncio
+from collections import defaultdict
+import uuid
+
+from sqlalchemy import case, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
+from sqlmodel import select, delete, tuple_
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..app_config import BOOKMARK_COUNT_FLUSH_INTERVAL
+from ..database import DB_BACKEND
+from ..dependencies import open_db_session
+from ..logging_config import logger
+from ..models import Bookmark, Listing
+from .listings import encode_listing_cursor, decode_listing_cursor, invalidate_listing_pages
+
+
+async def add_bookmark(session: AsyncSession, user_id: uuid.UUID, listing_id: uuid.UUID) -> bool:
+    # Idempotent, returns whether the bookmark is new so that the count is only changed once
+    insert = postgresql_insert if DB_BACKEND == "postgresql" else sqlite_insert
+    result = await session.exec(
+        insert(Bookmark).values(user_id=user_id, listing_id=listing_id).on_conflict_do_nothing(index_elements=["user_id", "listing_id"])
+    )
+    return result.rowcount > 0
+
+async def remove_bookmark(session: AsyncSession, user_id: uuid.UUID, listing_id: uuid.UUID) -> bool:
+    result = await session.exec(delete(Bookmark).where(Bookmark.user_id == user_id, Bookmark.listing_id == listing_id))
+    return result.rowcount > 0
+
+async def get_bookmarked_ids(session: AsyncSession, user_id: uuid.UUID, listing_ids: list[uuid.UUID]) -> set[uuid.UUID]:
+    # Which of a page's listings the user bookmarked, in one primary key lookup for the whole page
+    if not listing_ids:
+        return set()
+    return set((await session.exec(
+        select(Bookmark.listing_id).where(Bookmark.user_id == user_id, Bookmark.listing_id.in_(listing_ids))
+    )).all())
+
+async def get_bookmarks_page(session: AsyncSession, user_id: uuid.UUID, cursor: str | None, limit: int) -> tuple[list[Listing], str | None]:
+    # Newest bookmarks first, with the same keyset cursors as the listing pages
+    keys = [Bookmark.created_at, Bookmark.listing_id]
+    query_statement = (
+        select(Listing, Bookmark.created_at)
+        .join(Bookmark, Bookmark.listing_id == Listing.id)
+        .where(Bookmark.user_id == user_id)
+        .options(selectinload(Listing.author))
+        .order_by(*(key.desc() for key in keys))
+    )
+    if cursor is not None:
+        query_statement = query_statement.where(tuple_(*keys) < tuple_(*decode_listing_cursor(cursor, len(keys))))
+
+    # Fetch one extra row to know whether there is a next page
+    rows = list((await session.exec(query_statement.limit(limit + 1))).all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_listing, bookmarked_at = rows[-1]
+        next_cursor = encode_listing_cursor([bookmarked_at, last_listing.id])
+
+    return [listing for listing, _ in rows], next_cursor
+
+
+class BookmarkCounter:
+    """
+    Coalesces the changes to Listing.bookmark_count: they're summed up per listing in memory and written every
+    few seconds in a single UPDATE, so a popular listing's row is locked once per flush instead of once per
+    bookmark. Changes are only lost if the worker dies without shutting down.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.pending: defaultdict[uuid.UUID, int] = defaultdict(int)
+        self._task: asyncio.Task | None = None
+        self._stopping: asyncio.Event | None = None
+
+    def add(self, listing_id: uuid.UUID, change: int):
+        # Must be called after the bookmark change is committed
+        self.pending[listing_id] += change
+
+    async def flush(self):
+        changes = {listing_id: change for listing_id, change in self.pending.items() if change}
+        self.pending = defaultdict(int)
+        if not changes:
+            return
+
+        # Sorted, so that concurrent flushes of several workers lock the rows in the same order
+        listing_ids = sorted(changes)
+        try:
+            async with open_db_session() as session:
+                changed_categories = set((await session.exec(
+                    update(Listing)
+                    .where(Listing.id.in_(listing_ids))
+                    .values(bookmark_count=Listing.bookmark_count + case(changes, value=Listing.id, else_=0))
+                    .returning(Listing.category)
+                )).scalars().all())
+                await session.commit()
+        except Exception as e:
+            logger.exception("Unexpected exception when updating bookmark counts: %s", e)
+            for listing_id, change in changes.items():  # Retried with the next flush
+                self.pending[listing_id] += change
+            return
+
+        # The counts are part of the cached listing pages
+        await invalidate_listing_pages(*changed_categories)
+
+    async def _run(self):
+        # Stopped through the event rather than cancelled, so that a flush is never interrupted halfway
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Flushes whatever is still pending
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+bookmark_counter = BookmarkCounter(BOOKMARK_COUNT_FLUSH_INTERVAL)
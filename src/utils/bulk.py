@@ -0,0 +1,62 @@
+import json
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+
+from ..app_config import BULK_MAX_ROWS, BULK_MAX_BODY_SIZE
+from ..models import BulkRowResult
+
+
+async def read_bulk_rows(request: Request) -> list:
+    """
+    Reads the rows of a bulk request body, either NDJSON (Content-Type: application/x-ndjson, one JSON value per line)
+    or a JSON array. A row that isn't valid JSON is returned as the JSONDecodeError, so it's reported with its index.
+    """
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > BULK_MAX_BODY_SIZE * 1024 * 1024:
+            raise HTTPException(status_code=400, detail=f"Request body must not exceed {BULK_MAX_BODY_SIZE}MB")
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        rows = []
+        for line in body.decode("utf-8", "replace").splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                rows.append(e)
+    else:
+        try:
+            rows = json.loads(body)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+        if not isinstance(rows, list):
+            raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows were sent")
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ROWS} rows can be sent at once")
+
+    return rows
+
+def validate_bulk_rows(rows: list, model) -> tuple[dict, list[BulkRowResult]]:
+    # Returns {row index: validated model} and the results of the rows that failed
+    valid_rows = {}
+    failed = []
+    for index, row in enumerate(rows):
+        if isinstance(row, json.JSONDecodeError):
+            failed.append(BulkRowResult(index=index, status="invalid", errors=[{"type": "json_invalid", "msg": str(row)}]))
+            continue
+        try:
+            valid_rows[index] = model.model_validate(row)
+        except ValidationError as e:
+            failed.append(BulkRowResult(index=index, status="invalid", errors=json.loads(e.json(include_url=False))))
+    return valid_rows, failed
+
+def bulk_response(results: list[BulkRowResult]) -> dict:
+    results.sort(key=lambda result: result.index)
+    succeeded = sum(result.status in {"created", "updated", "deleted"} for result in results)
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
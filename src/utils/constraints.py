@@ -0,0 +1,46 @@
+import re
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import SQLModel
+
+# Constraints are named the way PostgreSQL names them: "user_pkey", "user_email_key" for Field(unique=True)
+# columns and "ix_user_session_token" for unique indexes
+USER_EMAIL_KEY = "user_email_key"
+USER_USERNAME_KEY = "user_username_key"
+
+SQLITE_UNIQUE_VIOLATION = re.compile(r"UNIQUE constraint failed: ([\w.]+(?:, [\w.]+)*)")
+
+
+def constraint_name_from_columns(table_name: str, column_names: list[str]) -> str:
+    table = SQLModel.metadata.tables[table_name]
+    if column_names == [column.name for column in table.primary_key]:
+        return f"{table_name}_pkey"
+    for index in table.indexes:
+        if index.unique and column_names == [column.name for column in index.columns]:
+            return index.name
+    return f"{table_name}_{'_'.join(column_names)}_key"
+
+def violated_constraint(error: IntegrityError) -> str | None:
+    # psycopg2 has the name in its diagnostics, asyncpg's error is the cause of the DBAPI adapter's one
+    diagnostics = getattr(error.orig, "diag", None)
+    constraint_name = getattr(diagnostics, "constraint_name", None) or getattr(error.orig.__cause__, "constraint_name", None)
+    if constraint_name is not None:
+        return constraint_name
+
+    # SQLite only gives the columns, e.g. "UNIQUE constraint failed: user.email"
+    match = SQLITE_UNIQUE_VIOLATION.search(str(error.orig))
+    if match is None:
+        return None
+    qualified_columns = match.group(1).split(", ")
+    return constraint_name_from_columns(qualified_columns[0].split(".")[0], [column.split(".")[1] for column in qualified_columns])
+
+def raise_for_violation(error: IntegrityError, details: dict[str, str], status_code: int):
+    """
+    Turns the violation of one of the given constraints (name -> detail) into an HTTPException,
+    re-raises any other integrity error. The session must be rolled back before.
+    """
+    detail = details.get(violated_constraint(error))
+    if detail is None:
+        raise error
+    raise HTTPException(status_code=status_code, detail=detail) from error
@@ -0,0 +1,98 @@
+import csv
+import io
+import json
+import zlib
+
+from sqlmodel import select
+
+from ..app_config import LISTING_EXPORT_BATCH_SIZE
+from ..dependencies import open_db_session
+from ..logging_config import logger
+from ..models import Listing, ListingExportFormat
+from .http_cache import as_utc
+
+# Exported columns, in CSV column order
+LISTING_EXPORT_COLUMNS = [
+    Listing.id,
+    Listing.author_id,
+    Listing.title,
+    Listing.description,
+    Listing.category,
+    Listing.price,
+    Listing.created_at,
+    Listing.updated_at,
+]
+LISTING_EXPORT_FIELDS = [column.key for column in LISTING_EXPORT_COLUMNS]
+
+EXPORT_MEDIA_TYPES = {
+    ListingExportFormat.NDJSON: "application/x-ndjson",
+    ListingExportFormat.CSV: "text/csv",
+}
+
+
+def export_value(value):
+    if hasattr(value, "isoformat"):
+        return as_utc(value).isoformat()
+    if hasattr(value, "value"):  # Enums
+        return value.value
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)  # UUIDs
+
+def encode_ndjson(rows) -> str:
+    return "".join(
+        json.dumps(dict(zip(LISTING_EXPORT_FIELDS, map(export_value, row))), ensure_ascii=False) + "\n" for row in rows
+    )
+
+def encode_csv(rows, include_header: bool = False) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if include_header:
+        writer.writerow(LISTING_EXPORT_FIELDS)
+    writer.writerows([map(export_value, row) for row in rows])
+    return buffer.getvalue()
+
+async def stream_listing_export(filters: list, export_format: ListingExportFormat, compress: bool):
+    """
+    Yields the encoded listings matching filters, ordered by id so that an interrupted export can be resumed
+    with a filter on the last id received. Rows are read from a server-side cursor one batch at a time,
+    so memory use doesn't depend on the size of the export.
+    """
+    # Plain column rows rather than ORM objects, nothing has to be tracked by the session
+    query_statement = (
+        select(*LISTING_EXPORT_COLUMNS)
+        .where(*filters)
+        .order_by(Listing.id)
+        .execution_options(yield_per=LISTING_EXPORT_BATCH_SIZE)
+    )
+    # wbits=31 writes a gzip container instead of a bare zlib stream
+    compressor = zlib.compressobj(level=6, wbits=31) if compress else None
+
+    def encode(text: str) -> bytes:
+        data = text.encode("utf-8")
+        if compressor is None:
+            return data
+        # Flushed per batch so the client receives rows as they're read instead of once the compressor's buffer fills
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    # The request's session is closed once the endpoint returns, the body is streamed after that
+    async with open_db_session() as session:
+        try:
+            if export_format == ListingExportFormat.CSV:
+                yield encode(encode_csv([], include_header=True))
+
+            result = await session.stream(query_statement)
+            async for rows in result.partitions():
+                if export_format == ListingExportFormat.CSV:
+                    chunk = encode(encode_csv(rows))
+                else:
+                    chunk = encode(encode_ndjson(rows))
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            # The status was already sent, the client sees a truncated export and can resume from its last id
+            logger.exception("Listing export failed: %s", e)
+            raise
+
+    if compressor is not None:
+        yield compressor.flush()
@@ -0,0 +1,26 @@
+import json
+import uuid
+
+try:
+    import orjson  # Optional, several times faster than json on large pages
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    # What json can't encode by itself, in the same format as pydantic. orjson handles these natively, except for
+    # subclasses such as the UUIDs asyncpg returns
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(value) -> bytes:
+    # Compact UTF-8 JSON like pydantic's model_dump_json, enums are encoded as their values
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def load_json(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,147 @@
+import csv
+import math
+
+from sqlalchemy import and_, or_
+
+from ..app_config import POSTAL_CODES_PATH, POSTAL_CODES_COUNTRY
+from ..logging_config import logger
+from ..models import Listing, User
+
+# Positions are indexed as an integer geohash: longitude and latitude are each quantized to CELL_BITS bits and
+# interleaved (longitude first, as in geohash), so every geohash prefix is a contiguous range of geo_cell values.
+# Unlike geohash strings, integer ranges use any B-tree index the same way on every DB and collation.
+CELL_BITS = 26  # Per axis, cells of about 0.6 x 0.3 m at the equator
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def normalize_postal_code(postal_code: str) -> str:
+    return "".join(postal_code.split()).upper()
+
+class PostalCodeTable:
+    """
+    Postal code -> (latitude, longitude), loaded from a GeoNames postal code dump. Cities are located at the
+    average position of their postal codes, for users whose postal code isn't in the table.
+    """
+
+    def __init__(self, path: str, country: str | None = None):
+        self.postal_codes: dict[str, tuple[float, float]] = {}
+        self.cities: dict[str, tuple[float, float]] = {}
+        try:
+            self.load(path, country)
+        except FileNotFoundError:
+            logger.warning("Postal code table %s not found, listings won't be located and near= queries will fail", path)
+
+    def load(self, path: str, country: str | None):
+        city_sums = {}
+        with open(path, newline="", encoding="utf-8") as postal_codes_file:
+            # country code, postal code, place name, 3 admin names and codes, latitude, longitude, accuracy
+            for row in csv.reader(postal_codes_file, delimiter="\t", quoting=csv.QUOTE_NONE):
+                if len(row) < 11 or (country is not None and row[0] != country):
+                    continue
+                try:
+                    position = (float(row[9]), float(row[10]))
+                except ValueError:
+                    continue
+                self.postal_codes.setdefault(normalize_postal_code(row[1]), position)
+                city_sum = city_sums.setdefault(row[2].lower(), [0.0, 0.0, 0])
+                city_sum[0] += position[0]
+                city_sum[1] += position[1]
+                city_sum[2] += 1
+
+        self.cities = {city: (latitude / count, longitude / count) for city, (latitude, longitude, count) in city_sums.items()}
+        logger.info("Loaded %d postal codes and %d cities from %s", len(self.postal_codes), len(self.cities), path)
+
+    def locate_postal_code(self, postal_code: str) -> tuple[float, float] | None:
+        return self.postal_codes.get(normalize_postal_code(postal_code))
+
+    def locate(self, postal_code: str | None, city: str | None) -> tuple[float, float] | None:
+        position = self.locate_postal_code(postal_code) if postal_code else None
+        if position is None and city:
+            position = self.cities.get(city.lower())
+        return position
+
+postal_code_table = PostalCodeTable(POSTAL_CODES_PATH, POSTAL_CODES_COUNTRY)
+
+
+def cell_coordinates(latitude: float, longitude: float, bits: int) -> tuple[int, int]:
+    # Column (longitude) and row (latitude) of the cell containing the position, in a grid of 2^bits x 2^bits
+    size = 1 << bits
+    column = min(size - 1, max(0, int((longitude + 180) / 360 * size)))
+    row = min(size - 1, max(0, int((latitude + 90) / 180 * size)))
+    return column, row
+
+def interleave(column: int, row: int, bits: int) -> int:
+    cell = 0
+    for bit in range(bits - 1, -1, -1):
+        cell = (cell << 2) | (((column >> bit) & 1) << 1) | ((row >> bit) & 1)
+    return cell
+
+def geo_cell(latitude: float, longitude: float) -> int:
+    return interleave(*cell_coordinates(latitude, longitude, CELL_BITS), CELL_BITS)
+
+def listing_location(user: User) -> dict:
+    # The location columns of the user's listings
+    position = postal_code_table.locate(user.postal_code, user.city)
+    if position is None:
+        return {"latitude": None, "longitude": None, "geo_cell": None}
+    return {"latitude": position[0], "longitude": position[1], "geo_cell": geo_cell(*position)}
+
+def covering_cell_ranges(latitude: float, longitude: float, radius_km: float) -> list[tuple[int, int]] | None:
+    """
+    Half-open geo_cell ranges covering the circle: the cell containing the center and its 8 neighbours, at the
+    finest precision whose cells are still at least radius_km wide and high. None if that's the whole world.
+    """
+    # Cells get narrower towards the poles, so their width is taken at the circle's edge closest to a pole
+    widest_latitude = min(90.0, abs(latitude) + radius_km / KM_PER_DEGREE)
+    cell_width_factor = math.cos(math.radians(widest_latitude))
+
+    bits = CELL_BITS
+    while bits > 0:
+        cell_height_km = 180 / (1 << bits) * KM_PER_DEGREE
+        cell_width_km = 360 / (1 << bits) * KM_PER_DEGREE * cell_width_factor
+        if cell_height_km >= radius_km and cell_width_km >= radius_km:
+            break
+        bits -= 1
+    if bits < 2:
+        return None
+
+    size = 1 << bits
+    column, row = cell_coordinates(latitude, longitude, bits)
+    shift = 2 * (CELL_BITS - bits)
+    ranges = []
+    for neighbour_row in (row - 1, row, row + 1):
+        if not 0 <= neighbour_row < size:
+            continue
+        for neighbour_column in (column - 1, column, column + 1):
+            prefix = interleave(neighbour_column % size, neighbour_row, bits)  # Longitude wraps around
+            ranges.append((prefix << shift, (prefix + 1) << shift))
+
+    # Neighbouring cells are often consecutive prefixes, fewer ranges means fewer index scans
+    merged = []
+    for start, end in sorted(set(ranges)):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def near_filters(latitude: float, longitude: float, radius_km: float) -> list:
+    """
+    Filters on Listing for the listings within radius_km of the position. The cell ranges narrow the rows down
+    through the index, the distance is then checked exactly enough for local distances with plain arithmetic
+    (an equirectangular projection around the center), which every DB can evaluate.
+    """
+    filters = []
+    ranges = covering_cell_ranges(latitude, longitude, radius_km)
+    if ranges is not None:
+        filters.append(or_(*(and_(Listing.geo_cell >= start, Listing.geo_cell < end) for start, end in ranges)))
+
+    longitude_scale = math.cos(math.radians(latitude))
+    latitude_difference = Listing.latitude - latitude
+    longitude_difference = (Listing.longitude - longitude) * longitude_scale
+    filters.append(
+        latitude_difference * latitude_difference + longitude_difference * longitude_difference
+        <= (radius_km / KM_PER_DEGREE) ** 2
+    )
+    return filters
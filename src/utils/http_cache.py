@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+
+from fastapi import Request, Response
+
+# Responses that carry validators must still be revalidated on every use, so a changed listing is never served stale
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+def as_utc(timestamp: datetime) -> datetime:
+    # Timestamps read back from the DB are naive, they were stored as UTC
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+def fingerprint_part(value) -> str:
+    if isinstance(value, datetime):
+        return as_utc(value).isoformat()
+    return str(value)
+
+def make_etag(*parts) -> str:
+    # A strong ETag, parts must together identify the exact version of everything in the response body
+    digest = hashlib.sha256("\x1f".join(fingerprint_part(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None = None) -> bool:
+    # If-None-Match wins over If-Modified-Since when a client sends both (RFC 9110, 13.2.2)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        client_etags = [client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")]
+        return "*" in client_etags or etag in client_etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        modified_since = as_utc(parsedate_to_datetime(if_modified_since))
+    except (TypeError, ValueError):
+        return False  # An invalid date is ignored
+    # HTTP dates only have a resolution of seconds
+    return as_utc(last_modified).replace(microsecond=0) <= modified_since
+
+def conditional_response(
+    request: Request, response: Response, etag: str, last_modified: datetime | None = None, vary: str | None = None
+) -> Response | None:
+    """
+    Sets the validators on the response of a GET endpoint. Returns an empty 304 response that the endpoint should
+    return instead of its body when the client's copy is still current, None otherwise. vary names the request
+    headers the body depends on, e.g. "Authorization".
+    """
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    if vary is not None:
+        headers["Vary"] = vary
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(as_utc(last_modified).replace(microsecond=0), usegmt=True)
+
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,102 @@
+from abc import ABC, abstractmethod
+import os
+import re
+import shutil
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+from ..app_config import IMAGES_ENDPOINT, IMAGES_FOLDER_PATH
+from .image_variants import delete_image_variants
+
+CONTENT_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ImageStorage(ABC):
+    """
+    Where image files live. Images are addressed by key, the SHA-256 of their content, so identical uploads
+    end up as one file. How many users/listings reference each key is tracked in the DB (StoredImage), not here.
+    """
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def put(self, key: str, source_path: str, keep_source: bool = False) -> None:
+        # Takes ownership of the file at source_path, unless keep_source is set. Replaces an existing file of the key
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        # Also deletes the image's variants
+        ...
+
+    @abstractmethod
+    def link(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def local_path(self, key: str) -> str:
+        # A local file the image can be served from
+        ...
+
+    def key_from_link(self, link: str) -> str | None:
+        # None for links that don't point to a content addressed image (i.e. images uploaded before they were)
+        key = link.split('/')[-1]
+        return key if CONTENT_HASH_PATTERN.match(key) else None
+
+
+class ShardedFileStorage(ImageStorage):
+    """
+    Stores images on the local filesystem under nested directories named after the leading characters of their key
+    (e.g. ab/cd/abcd...), so that no single directory grows past a few thousand entries.
+    """
+
+    def __init__(self, root: str, endpoint: str, shard_depth: int = 2, shard_width: int = 2):
+        self.root = root
+        self.endpoint = endpoint
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+
+    def relative_path(self, key: str) -> str:
+        shards = [key[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return "/".join(shards + [key])
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, *self.relative_path(key).split("/"))
+
+    async def exists(self, key: str) -> bool:
+        return await run_in_threadpool(os.path.isfile, self.local_path(key))
+
+    async def put(self, key: str, source_path: str, keep_source: bool = False) -> None:
+        def move_into_place():
+            destination_path = self.local_path(key)
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            moved_path = source_path
+            if keep_source:
+                # A second link to the same file is moved instead, so readers still never see a partial file
+                moved_path = f"{destination_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    os.link(source_path, moved_path)
+                except OSError:
+                    shutil.copyfile(source_path, moved_path)
+            os.replace(moved_path, destination_path)  # Atomic, the source is on the same filesystem
+
+        await run_in_threadpool(move_into_place)
+
+    async def delete(self, key: str) -> None:
+        def remove():
+            try:
+                os.remove(self.local_path(key))
+            except FileNotFoundError:
+                pass
+            delete_image_variants(self.relative_path(key))
+
+        await run_in_threadpool(remove)
+
+    def link(self, key: str) -> str:
+        return f"{self.endpoint}/{self.relative_path(key)}"
+
+
+image_storage = ShardedFileStorage(IMAGES_FOLDER_PATH, IMAGES_ENDPOINT)
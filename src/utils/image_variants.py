@@ -0,0 +1,124 @@
+import asyncio
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException
+
+from ..app_config import IMAGES_FOLDER_PATH, IMAGE_VARIANTS
+from ..logging_config import logger
+from .workers import image_processing_pool
+
+# Every uploaded image gets resized copies in each of these formats, stored next to it as
+# "<image name>_<variant>.<extension>". They are re-encoded from the pixels only, so EXIF data is dropped
+IMAGE_VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+# Image files are never modified once written (their names are content hashes or unique), so caches may keep them for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def image_variant_name(image_name: str, variant: str, extension: str) -> str:
+    return f"{image_name}_{variant}.{extension}"
+
+def image_variant_links(image_link: str | None) -> dict[str, dict[str, str]] | None:
+    # {variant: {extension: link}}, the variants sit next to the image so their links share its path
+    if image_link is None:
+        return None
+    return {
+        variant: {extension: image_variant_name(image_link, variant, extension) for extension in IMAGE_VARIANT_FORMATS}
+        for variant in IMAGE_VARIANTS
+    }
+
+def parse_image_variant_name(file_name: str) -> tuple[str, str, str] | None:
+    # Inverse of image_variant_name, None if file_name isn't a variant name
+    stem, _, extension = file_name.rpartition(".")
+    image_name, _, variant = stem.rpartition("_")
+    if not image_name or variant not in IMAGE_VARIANTS or extension not in IMAGE_VARIANT_FORMATS:
+        return None
+    return image_name, variant, extension
+
+def _save_variant(image: Image.Image, variant_path: str, extension: str):
+    if extension == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")  # JPEG has no alpha channel
+    # Written to a temp file first so that a half written variant is never served
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(variant_path), prefix=".variant_")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            image.save(temp_file, IMAGE_VARIANT_FORMATS[extension], quality=85)
+        os.replace(temp_path, variant_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def _generate_image_variants(image_path: str, variants: list[tuple[str, str]]):
+    # Runs in a worker process, variants are (variant, extension) pairs
+    with Image.open(image_path) as original:
+        original = ImageOps.exif_transpose(original)  # Bake the EXIF orientation into the pixels before it's dropped
+        if original.mode not in {"RGB", "RGBA"}:
+            original = original.convert("RGBA" if "A" in original.getbands() else "RGB")
+
+        image_name = os.path.basename(image_path)
+        for variant, extension in variants:
+            resized = original.copy()
+            resized.thumbnail((IMAGE_VARIANTS[variant], IMAGE_VARIANTS[variant]))  # Only ever scales down
+            _save_variant(resized, os.path.join(os.path.dirname(image_path), image_variant_name(image_name, variant, extension)), extension)
+
+async def generate_image_variants(image_name: str):
+    # Meant to run as a background task after an upload, a failure is only logged since the variants
+    # are generated again on the first request if missing
+    all_variants = [(variant, extension) for variant in IMAGE_VARIANTS for extension in IMAGE_VARIANT_FORMATS]
+    try:
+        await image_processing_pool.run(_generate_image_variants, os.path.join(IMAGES_FOLDER_PATH, image_name), all_variants)
+    except Exception as e:
+        logger.warning("Generating the variants of image %s failed: %s", image_name, e)
+
+async def generate_variants_of_images(image_names: list[str]):
+    # For a batch of uploads, the images are spread over the image processing workers instead of one after another
+    await asyncio.gather(*(generate_image_variants(image_name) for image_name in dict.fromkeys(image_names)))
+
+def delete_image_variants(image_name: str):
+    for variant in IMAGE_VARIANTS:
+        for extension in IMAGE_VARIANT_FORMATS:
+            try:
+                os.remove(os.path.join(IMAGES_FOLDER_PATH, image_variant_name(image_name, variant, extension)))
+            except FileNotFoundError:
+                pass
+
+
+class ImageFiles(StaticFiles):
+    """Serves the images folder with immutable caching, generating a missing image variant on its first request"""
+
+    async def get_response(self, path: str, scope):
+        response = await self.get_or_generate_response(path, scope)
+        if response.status_code in {200, 304}:
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    async def get_or_generate_response(self, path: str, scope):
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+
+            folder, file_name = os.path.split(path)
+            parsed_name = parse_image_variant_name(file_name)
+            if parsed_name is None:
+                raise
+            image_name, variant, extension = parsed_name
+
+            image_path = os.path.realpath(os.path.join(IMAGES_FOLDER_PATH, folder, image_name))
+            if os.path.commonpath([image_path, os.path.realpath(IMAGES_FOLDER_PATH)]) != os.path.realpath(IMAGES_FOLDER_PATH):
+                raise  # Outside of the images folder
+            if not os.path.isfile(image_path):
+                raise
+
+            try:
+                await image_processing_pool.run(_generate_image_variants, image_path, [(variant, extension)])
+            except HTTPException:
+                raise
+            except Exception as generation_error:
+                logger.warning("Generating variant %s of image %s failed: %s", path, image_name, generation_error)
+                raise e
+            return await super().get_response(path, scope)
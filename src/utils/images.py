@@ -1,24 +1,116 @@
+import asyncio
 import os
-import uuid
 
-from ..app_config import IMAGES_ENDPOINT, IMAGES_FOLDER_PATH
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import select, update, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from ..app_config import IMAGES_FOLDER_PATH
+from ..database import DB_BACKEND
 from ..logging_config import logger
-from ..models import User
+from ..models import StoredImage
+from .image_store import image_storage
+from .image_variants import delete_image_variants
+from .uploads import UploadedImage
+
+
+async def store_image(session: AsyncSession, upload: UploadedImage) -> tuple[str, bool]:
+    """
+    Puts an uploaded image into the image storage and adds a reference to it, in the session's transaction.
+    Returns the image's key and whether its file is new (False when identical bytes were already stored).
+    The upload is kept, restore_released_images must be called once the transaction is committed and
+    discard_uploaded_images in any case.
+    """
+    key, is_new = await store_image_file(upload)
+    await add_image_reference(session, key, upload.size)
+    return key, is_new
+
+async def store_images(session: AsyncSession, uploads: list[UploadedImage]) -> list[tuple[str, bool]]:
+    # Like store_image for a whole batch. The files are put concurrently, the references are added
+    # one after another since a session can't run statements concurrently
+    stored = await asyncio.gather(*(store_image_file(upload) for upload in uploads))
+    for upload, (key, _) in zip(uploads, stored):
+        await add_image_reference(session, key, upload.size)
+    return stored
+
+async def store_image_file(upload: UploadedImage) -> tuple[str, bool]:
+    key = upload.content_hash.hexdigest()
+
+    # Put even when the file exists: the last reference to it may have just been released, in which case the file
+    # is about to be deleted. Replacing it with identical bytes is atomic and harmless
+    is_new = not await image_storage.exists(key)
+    await image_storage.put(key, upload.temp_path, keep_source=True)
+
+    return key, is_new
+
+async def restore_released_images(uploads: list[UploadedImage]):
+    """
+    Must be called after committing the references added by store_image(s). A concurrent request that released
+    the last earlier reference may have deleted the file before this commit made it referenced again (see
+    delete_unreferenced_image), it's put back from the upload.
+    """
+    for upload in uploads:
+        key = upload.content_hash.hexdigest()
+        if not await image_storage.exists(key):
+            await image_storage.put(key, upload.temp_path)
+            upload.temp_path = None
+
+async def add_image_reference(session: AsyncSession, key: str, size: int):
+    insert = postgresql_insert if DB_BACKEND == "postgresql" else sqlite_insert
+    # A single atomic upsert, so concurrent uploads of the same bytes can't lose a reference
+    await session.exec(
+        insert(StoredImage)
+        .values(content_hash=key, ref_count=1, size=size)
+        .on_conflict_do_update(index_elements=["content_hash"], set_={"ref_count": StoredImage.ref_count + 1})
+    )
+
+async def release_image(session: AsyncSession, image_link: str | None) -> str | None:
+    """
+    Drops a reference to the image behind image_link, in the session's transaction. If that was the last one,
+    the image's key is returned and must be passed to delete_unreferenced_image once the transaction is committed.
+    """
+    if image_link is None:
+        return None
+
+    key = image_storage.key_from_link(image_link)
+    if key is None:
+        await delete_legacy_image(image_link)
+        return None
 
+    remaining_references = (await session.exec(
+        update(StoredImage)
+        .where(StoredImage.content_hash == key)
+        .values(ref_count=StoredImage.ref_count - 1)
+        .returning(StoredImage.ref_count)
+    )).first()
 
-def ensure_unique_image_name(uuidless_image_name: str) -> str:
-    new_image_name = f"{old_image_name}_{uuid.uuid4()}"
+    if remaining_references is None:
+        logger.warning("Released image %s has no reference count", key)
+        return None
+    if remaining_references[0] > 0:
+        return None
 
-    while os.path.exists(os.path.join(IMAGES_FOLDER_PATH, new_image_name)):
-        new_image_name = f"{old_image_name}_{uuid.uuid4()}"
+    await session.exec(delete(StoredImage).where(StoredImage.content_hash == key, StoredImage.ref_count <= 0))
+    return key
 
-    return new_image_name
+async def delete_unreferenced_image(session: AsyncSession, key: str | None):
+    if key is None:
+        return
+    # The same bytes may have been uploaded again since the reference was dropped
+    if (await session.exec(select(StoredImage.content_hash).where(StoredImage.content_hash == key))).first() is not None:
+        return
+    await image_storage.delete(key)
 
-def delete_profile_picture(user: User):
-    if user.profile_picture_link is not None:
-        picture_name = user.profile_picture_link.split('/')[-1]
-        try:
-            os.delete(os.path.join(IMAGES_FOLDER_PATH, picture_name))
-        except Exception as e:
-            logger.exception(f"Unexpected exception when deleting profile picture: {e}")
-            raise
\ No newline at end of file
+async def delete_legacy_image(image_link: str):
+    # Images uploaded before content addressing were stored flat under a unique name and never shared
+    image_name = image_link.split('/')[-1]
+    try:
+        await run_in_threadpool(os.remove, os.path.join(IMAGES_FOLDER_PATH, image_name))
+    except FileNotFoundError:
+        logger.warning("Image %s was already missing", image_name)
+    except Exception as e:
+        logger.exception(f"Unexpected exception when deleting image: {e}")
+        raise
+    await run_in_threadpool(delete_image_variants, image_name)
@@ -1,9 +1,18 @@
+import base64
+from datetime import datetime
+import json
+import math
 import uuid
 
 from fastapi import HTTPException
-from sqlmodel import Session
+from sqlalchemy import Select, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..models import Listing
+from ..models import User, Listing, ListingCategory
+from .response_cache import listing_page_cache
+from .image_variants import image_variant_links
 
 def verify_listing_owner(listing_owner_id: uuid.UUID, user_id: uuid.UUID):
     if listing_owner_id != user_id:
@@ -13,11 +22,154 @@ def verify_listing_owner(listing_owner_id: uuid.UUID, user_id: uuid.UUID):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-def get_listing_by_id(sesison: Session, listing_id: uuid.UUID) -> Listing:
-    listing = session.get(Listing, listing_id)
+async def get_listing_by_id(session: AsyncSession, listing_id: uuid.UUID, load_author: bool = False, load_pictures: bool = False) -> Listing:
+    # The author is joined into the same query when the response needs it, the pictures take one more query
+    options = [joinedload(Listing.author)] if load_author else []
+    if load_pictures:
+        options.append(selectinload(Listing.pictures))
+    listing = await session.get(Listing, listing_id, options=options)
     if listing is None:
         raise HTTPException(
-            status=404,
+            status_code=404,
             detail="Listing not found"
         )
     return listing
+
+def encode_listing_cursor(position: list) -> str:
+    # Opaque to clients, it's just the keyset position ([sort key,] created_at, id) of the last listing on the page
+    raw_cursor = json.dumps(position, default=str)
+    return base64.urlsafe_b64encode(raw_cursor.encode("utf-8")).decode("ascii")
+
+def decode_listing_cursor(cursor: str, position_length: int) -> list:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        # A cursor from a differently sorted query doesn't have the same number of keys
+        if not isinstance(position, list) or len(position) != position_length:
+            raise ValueError("Cursor doesn't match the query")
+        # Every sort key in front of (created_at, id) is a number (price, relevance rank), anything else would
+        # silently compare as a different type in the DB instead of failing
+        for sort_value in position[:-2]:
+            if isinstance(sort_value, bool) or not isinstance(sort_value, (int, float)) or not math.isfinite(sort_value):
+                raise ValueError("Cursor doesn't match the query")
+        return position[:-2] + [datetime.fromisoformat(position[-2]), uuid.UUID(position[-1])]
+    except Exception:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid cursor"
+        )
+
+async def get_listings_page(
+    session: AsyncSession,
+    filters: list,
+    cursor: str | None,
+    limit: int,
+    offset: int | None = None,
+    sort_key = None,
+    descending: bool = True,
+    options: tuple = (),
+    projection: Select | None = None
+) -> tuple[list, str | None]:
+    """
+    Returns a page of Listing instances, or with projection (a select of columns from Listing and anything joined
+    to it, including Listing.created_at and Listing.id) a page of its rows as they are, without ORM instances
+    """
+    # Ordered by sort_key (if any) and then newest first. (created_at, id) is unique,
+    # so the keyset position of the last row on a page is unambiguous
+    keys = [Listing.created_at, Listing.id]
+    if projection is not None:
+        query_statement = projection.add_columns(sort_key) if sort_key is not None else projection
+    elif sort_key is not None:
+        query_statement = select(Listing, sort_key)  # Rows of (listing, sort key value) so the cursor can be built
+    else:
+        query_statement = select(Listing)
+    if sort_key is not None:
+        keys.insert(0, sort_key)
+
+    query_statement = query_statement.where(*filters).options(*options)
+    query_statement = query_statement.order_by(*(key.desc() if descending else key.asc() for key in keys))
+
+    if cursor is not None:
+        position = decode_listing_cursor(cursor, len(keys))
+        if descending:
+            query_statement = query_statement.where(tuple_(*keys) < tuple_(*position))
+        else:
+            query_statement = query_statement.where(tuple_(*keys) > tuple_(*position))
+    elif offset is not None:
+        query_statement = query_statement.offset(offset)
+
+    # Fetch one extra row to know whether there is a next page
+    rows = list((await session.exec(query_statement.limit(limit + 1))).all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if projection is not None:
+            last_listing = rows[-1]
+        else:
+            last_listing = rows[-1][0] if sort_key is not None else rows[-1]
+        position = [last_listing.created_at, last_listing.id]
+        if sort_key is not None:
+            position.insert(0, rows[-1][-1])
+        next_cursor = encode_listing_cursor(position)
+
+    if projection is not None:
+        return rows, next_cursor
+    listings = [row[0] for row in rows] if sort_key is not None else rows
+    return listings, next_cursor
+
+# Projections for get_listings_page on the list endpoints: only the response's columns are selected and the rows are
+# turned into the response's dicts directly, without hydrating Listing instances or validating response models
+LISTING_GET_COLUMNS = (
+    Listing.title, Listing.description, Listing.category, Listing.price, Listing.id, Listing.author_id, Listing.bookmark_count
+)
+# Not in the response, the keyset cursor and the ETag need them
+LISTING_VERSION_COLUMNS = (Listing.created_at, Listing.updated_at)
+
+listing_get_projection = select(*LISTING_GET_COLUMNS, *LISTING_VERSION_COLUMNS)
+listing_with_owner_projection = select(
+    *LISTING_GET_COLUMNS, *LISTING_VERSION_COLUMNS,
+    User.username, User.profile_picture_link, User.updated_at.label("author_updated_at")
+).join(User, User.id == Listing.author_id)
+
+def listing_get_dict(row) -> dict:
+    # A ListingGet, from a row of listing_get_projection or listing_with_owner_projection
+    return {
+        "title": row.title,
+        "description": row.description,
+        "category": row.category,
+        "price": row.price,
+        "id": row.id,
+        "author_id": row.author_id,
+        "bookmark_count": row.bookmark_count,
+    }
+
+def listing_page_entry_dicts(rows: list) -> list[dict]:
+    # ListingPageEntry for each row of listing_with_owner_projection, the same author's owner dict is built once
+    owners = {}
+    entries = []
+    for row in rows:
+        owner = owners.get(row.author_id)
+        if owner is None:
+            owner = owners[row.author_id] = {
+                "username": row.username,
+                "profile_picture_link": row.profile_picture_link,
+                "profile_picture_variants": image_variant_links(row.profile_picture_link),
+            }
+        entry = listing_get_dict(row)
+        entry["owner"] = owner
+        entry["is_bookmarked"] = None
+        entries.append(entry)
+    return entries
+
+async def count_user_listings(session: AsyncSession, user_id: uuid.UUID) -> int:
+    return (await session.exec(select(func.count()).select_from(Listing).where(Listing.author_id == user_id))).one()
+
+def listing_page_cache_tags(categories: list[ListingCategory] | None) -> list[str]:
+    # A page filtered by categories only changes with the listings in them, any other page may change with any listing
+    if categories:
+        return sorted({f"category:{category.value}" for category in categories})
+    return ["all"]
+
+async def invalidate_listing_pages(*categories: ListingCategory):
+    # Must be called after committing a change to listings in these categories
+    await listing_page_cache.invalidate(["all", *(f"category:{ListingCategory(category).value}" for category in categories)])
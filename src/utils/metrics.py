@@ -0,0 +1,226 @@
+from collections import defaultdict
+from contextvars import ContextVar
+import bisect
+import threading
+import time
+
+from ..app_config import SLOW_REQUEST_THRESHOLD, SLOW_REQUEST_MAX_STATEMENTS
+from ..logging_config import logger
+
+# A minimal registry rendering the Prometheus text exposition format (version 0.0.4), enough for
+# counters, gauges and histograms with labels without pulling in a client library
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()  # Engine events of the sync fallback fire on threadpool threads
+        registry.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+
+
+class Counter(Metric):
+    """Either incremented directly or, with a callback, read from an existing running total when scraped"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), callback=None):
+        super().__init__(name, description, label_names)
+        self.values = defaultdict(float)
+        self.callback = callback  # Returns {label values tuple: value}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] += amount
+
+    def collect(self) -> list[str]:
+        if self.callback is not None:
+            values = list(self.callback().items())
+        else:
+            with self._lock:
+                values = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(self.label_names, labels)} {format_number(value)}" for labels, value in values
+        ]
+
+
+class Gauge(Metric):
+    """Either set directly or, with a callback, read when the metrics are scraped"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), callback=None):
+        super().__init__(name, description, label_names)
+        self.values = defaultdict(float)
+        self.callback = callback  # Returns {label values tuple: value}
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] += amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def collect(self) -> list[str]:
+        if self.callback is not None:
+            values = list(self.callback().items())
+        else:
+            with self._lock:
+                values = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(self.label_names, labels)} {format_number(value)}" for labels, value in values
+        ]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # label values -> [per bucket counts (+Inf last), sum, count]
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list[str]:
+        lines = self.header()
+        with self._lock:
+            series_items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self.series.items()]
+        for labels, (counts, total, count) in series_items:
+            cumulative = 0
+            for upper_bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                bucket_label = f'le="{format_number(upper_bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {format_number(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+registry: list[Metric] = []
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in registry for line in metric.collect()) + "\n"
+
+
+http_requests = Counter("http_requests_total", "Requests handled", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "Time to handle a request", ("method", "route"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "Requests currently being handled")
+db_queries = Counter("db_queries_total", "SQL statements executed")
+db_query_duration = Counter("db_query_duration_seconds_total", "Time spent executing SQL statements")
+db_queries_per_request = Histogram(
+    "db_queries_per_request", "SQL statements executed per request", ("method", "route"), buckets=QUERY_COUNT_BUCKETS
+)
+db_time_per_request = Histogram("db_time_per_request_seconds", "Time spent in SQL statements per request", ("method", "route"))
+db_pool_checkout_wait = Histogram(
+    "db_pool_checkout_wait_seconds", "Time waited for a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+
+
+class RequestStats:
+    """SQL activity of one request, collected by the engine events in database.py"""
+
+    def __init__(self, keep_statements: bool):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.statements = [] if keep_statements else None
+
+# Shared by reference with the threadpool (run_in_threadpool copies the context), so the sync engine's events count too
+request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+def record_query(statement: str, duration: float):
+    db_queries.inc()
+    db_query_duration.inc(amount=duration)
+
+    stats = request_stats.get()
+    if stats is None:
+        return
+    stats.query_count += 1
+    stats.db_time += duration
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append(f"{duration * 1000:.1f}ms {statement}")
+
+def record_pool_checkout_wait(duration: float):
+    db_pool_checkout_wait.observe(duration)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, status and SQL activity of every request, labelled by route template (e.g.
+    /listings/{listing_id}) so that ids don't create a series each. Requests slower than the configured
+    threshold are logged with the SQL they issued.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500  # If the app fails before sending a response
+        async def send_recording_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats(keep_statements=SLOW_REQUEST_THRESHOLD is not None)
+        token = request_stats.set(stats)
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_recording_status)
+        finally:
+            duration = time.perf_counter() - started
+            http_requests_in_flight.dec()
+            request_stats.reset(token)
+
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method, route, status)
+            http_request_duration.observe(duration, method, route)
+            db_queries_per_request.observe(stats.query_count, method, route)
+            db_time_per_request.observe(stats.db_time, method, route)
+
+            if SLOW_REQUEST_THRESHOLD is not None and duration * 1000 >= SLOW_REQUEST_THRESHOLD:
+                logger.warning(
+                    "Slow request %s %s took %.1fms (%d SQL statements, %.1fms in the DB):\n%s",
+                    method, scope["path"], duration * 1000, stats.query_count, stats.db_time * 1000,
+                    "\n".join(stats.statements) or "(no SQL)",
+                )
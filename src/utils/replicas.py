@@ -0,0 +1,41 @@
+from http.cookies import SimpleCookie
+
+from fastapi import Request
+
+from ..app_config import DB_READ_YOUR_WRITES_WINDOW
+
+# Set on responses to writes, while it hasn't expired the client's reads go to the primary
+READ_PRIMARY_COOKIE = "read_primary"
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def reads_from_primary(request: Request) -> bool:
+    return READ_PRIMARY_COOKIE in request.cookies
+
+
+class ReadYourWritesMiddleware:
+    """
+    Marks clients whose write succeeded with a short-lived cookie, so that their following reads aren't sent
+    to a replica that hasn't caught up with it yet. Only added when replicas are configured.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and 200 <= message["status"] < 400:
+                cookie = SimpleCookie()
+                cookie[READ_PRIMARY_COOKIE] = "1"
+                cookie[READ_PRIMARY_COOKIE]["max-age"] = DB_READ_YOUR_WRITES_WINDOW
+                cookie[READ_PRIMARY_COOKIE]["path"] = "/"
+                cookie[READ_PRIMARY_COOKIE]["httponly"] = True
+                cookie[READ_PRIMARY_COOKIE]["samesite"] = "lax"
+                set_cookie = cookie.output(header="").strip()
+                message["headers"] = [*message.get("headers", []), (b"set-cookie", set_cookie.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -0,0 +1,37 @@
+import re
+import uuid
+
+from ..logging_config import request_id
+
+REQUEST_ID_HEADER = "x-request-id"
+# An incoming id (e.g. from a proxy) is only reused if it can't be used to forge log lines
+VALID_REQUEST_ID = re.compile(r"^[\w.-]{1,128}$")
+
+
+class RequestIdMiddleware:
+    """
+    Gives every request an id, taken from its X-Request-ID header or generated, that is attached to all records
+    logged while handling it and returned in the X-Request-ID response header. A plain ASGI middleware so
+    that streamed responses aren't buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        incoming_id = dict(scope["headers"]).get(REQUEST_ID_HEADER.encode(), b"").decode("latin-1")
+        current_id = incoming_id if VALID_REQUEST_ID.match(incoming_id) else uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (REQUEST_ID_HEADER.encode(), current_id.encode())]
+            await send(message)
+
+        token = request_id.set(current_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id.reset(token)
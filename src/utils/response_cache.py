@@ -0,0 +1,230 @@
+from abc import ABC, abstractmethod
+import asyncio
+import threading
+import time
+
+from ..app_config import LISTING_PAGE_CACHE_BACKEND, LISTING_PAGE_CACHE_REDIS_URL
+from ..app_config import LISTING_PAGE_CACHE_MAX_SIZE, LISTING_PAGE_CACHE_TTL
+from ..logging_config import logger
+from .cache import LRUCache
+
+
+class ResponseCacheBackend(ABC):
+    """Stores rendered responses (bytes) and the invalidation counters they depend on"""
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def get_counters(self, keys: list[str]) -> list[int]:
+        # Counters that were never incremented are 0
+        ...
+
+    @abstractmethod
+    async def increment(self, key: str) -> None:
+        ...
+
+
+class MemoryBackend(ResponseCacheBackend):
+    """
+    In-process LRU. Only suitable for a single worker process, with several of them each one has its own
+    counters, so a write only invalidates the cache of the process that handled it (the others serve stale pages
+    until the TTL runs out).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.entries = LRUCache(max_size, ttl)
+        self.counters: dict[str, int] = {}  # Never evicted, there's one per invalidation tag (e.g. per category)
+
+    async def get(self, key: str) -> bytes | None:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self.entries.set(key, value)  # The LRU's own TTL applies
+
+    async def get_counters(self, keys: list[str]) -> list[int]:
+        return [self.counters.get(key, 0) for key in keys]
+
+    async def increment(self, key: str) -> None:
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+
+class RedisBackend(ResponseCacheBackend):
+    """
+    Shared between all worker processes through a Redis-compatible server (Redis, Valkey, KeyDB, ...).
+    client is a redis.asyncio.Redis or anything with the same get/set/mget/incr coroutines, e.g. LocalRedis.
+    """
+
+    def __init__(self, client, prefix: str = "response_cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    async def get_counters(self, keys: list[str]) -> list[int]:
+        if not keys:
+            return []
+        values = await self.client.mget([self.prefix + key for key in keys])
+        return [int(value) if value is not None else 0 for value in values]
+
+    async def increment(self, key: str) -> None:
+        await self.client.incr(self.prefix + key)
+
+
+class LocalRedis:
+    """
+    In-process stand-in for a Redis server, implementing only the commands RedisBackend uses.
+    Lets the Redis code path run in development and tests without a server, it's not shared between processes.
+    """
+
+    def __init__(self):
+        self._values: dict[str, tuple[float | None, bytes]] = {}  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> bytes | None:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.monotonic():
+            del self._values[key]
+            return None
+        return entry[1]
+
+    async def get(self, key: str) -> bytes | None:
+        with self._lock:
+            return self._get(key)
+
+    async def mget(self, keys: list[str]) -> list[bytes | None]:
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, ex: int | None = None) -> bool:
+        with self._lock:
+            self._values[key] = (time.monotonic() + ex if ex is not None else None, value)
+        return True
+
+    async def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._get(key) or 0) + 1
+            self._values[key] = (None, str(value).encode())
+        return value
+
+
+class ResponseCache:
+    """
+    Caches rendered responses under a normalized request key.
+
+    Every entry depends on a few invalidation tags (e.g. "category:books"). Each tag has a counter and the
+    current counters are part of the entry's key, so invalidating a tag is a single increment: entries built
+    before it can't be found anymore and age out, and a page rendered from data read before a write can't be
+    stored under the new key either.
+
+    Concurrent misses for the same key in this process are coalesced, only the first one renders the response
+    and the rest wait for its result (single-flight), so an expired hot page doesn't hit the DB once per request.
+    """
+
+    def __init__(self, name: str, backend: ResponseCacheBackend, ttl: float):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # Misses that waited for another request's render instead of rendering
+        self.invalidations = 0
+        self.errors = 0
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    async def _versioned_key(self, key: str, tags: list[str]) -> str:
+        counters = await self.backend.get_counters([f"tag:{tag}" for tag in tags])
+        return key + "|" + ",".join(f"{tag}={counter}" for tag, counter in zip(tags, counters))
+
+    async def get_or_render(self, key: str, tags: list[str], render) -> bytes:
+        """Returns the cached response for key, or awaits render() (returning bytes) and caches its result"""
+        try:
+            versioned_key = await self._versioned_key(key, tags)
+            cached = await self.backend.get(versioned_key)
+        except Exception as e:
+            # The cache is only an optimization, an unreachable backend mustn't fail the request
+            self.errors += 1
+            logger.warning("%s cache unavailable: %s", self.name, e)
+            return await render()
+
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        in_flight = self._in_flight.get(versioned_key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)  # A cancelled waiter mustn't cancel the render for the others
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[versioned_key] = future
+        try:
+            rendered = await render()
+        except Exception as e:
+            future.set_exception(e)  # The waiters fail the same way, e.g. with the same 400 for an invalid cursor
+            future.exception()  # Marks it retrieved, there may be no waiters
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._in_flight[versioned_key]
+
+        future.set_result(rendered)
+        try:
+            await self.backend.set(versioned_key, rendered, self.ttl)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("%s cache unavailable: %s", self.name, e)
+        return rendered
+
+    async def invalidate(self, tags: list[str]):
+        # Must be called after the write is committed
+        for tag in dict.fromkeys(tags):
+            try:
+                await self.backend.increment(f"tag:{tag}")
+                self.invalidations += 1
+            except Exception as e:
+                self.errors += 1
+                logger.warning("%s cache invalidation of %s failed: %s", self.name, tag, e)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            # Coalesced misses didn't hit the DB either
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+        }
+
+
+def create_backend(backend: str) -> ResponseCacheBackend:
+    if backend == "memory":
+        return MemoryBackend(LISTING_PAGE_CACHE_MAX_SIZE, LISTING_PAGE_CACHE_TTL)
+    if backend == "local_redis":
+        return RedisBackend(LocalRedis())
+    if backend == "redis":
+        try:
+            import redis.asyncio as redis  # Optional, only needed for this backend
+        except ImportError:
+            raise RuntimeError("The redis response cache backend requires the redis package (pip install redis)")
+        return RedisBackend(redis.Redis.from_url(LISTING_PAGE_CACHE_REDIS_URL))
+    raise ValueError(f"Unknown response cache backend: {backend}")
+
+# Pages of GET /listings, invalidated per category by the listing writes
+listing_page_cache = ResponseCache("listing_page", create_backend(LISTING_PAGE_CACHE_BACKEND), LISTING_PAGE_CACHE_TTL)
@@ -0,0 +1,422 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import functools
+import gc
+import math
+from operator import attrgetter
+import re
+import time
+import uuid
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..app_config import SAVED_SEARCHES_REFRESH_INTERVAL, SAVED_SEARCHES_QUEUE_SIZE
+from ..database import DB_BACKEND
+from ..dependencies import open_db_session
+from ..logging_config import logger
+from ..models import Listing, ListingCategory, SavedSearch, SavedSearchMatch
+from .listings import encode_listing_cursor, decode_listing_cursor
+
+WORD = re.compile(r"\w+")
+# Each refresh also reloads the searches saved this long before the previous one, in case they were committed
+# late or by a worker whose clock is behind. Searches already in the index are skipped.
+REFRESH_OVERLAP = timedelta(seconds=60)
+# Rows per round trip when loading the searches. Each batch is turned into rows on the event loop, so it stays short
+LOAD_BATCH_SIZE = 1000
+# Search ids checked or alerts inserted per statement, popular listings match tens of thousands of searches. At 4
+# columns per alert this stays well under PostgreSQL's limit of 32767 bind parameters per statement
+MATCH_BATCH_SIZE = 5000
+# Recently added searches are kept in a list that is scanned linearly, until it's this long or a quarter of the tree
+REBUILD_MIN_PENDING = 64
+# Endpoints sampled to pick the center of an interval tree node
+CENTER_SAMPLE_SIZE = 64
+
+
+def tokenize(text: str) -> set[str]:
+    return set(WORD.findall(text.lower()))
+
+def normalize_keywords(keywords: str | None) -> str | None:
+    # Stored as the sorted, lowercased words, which is also how the matcher compares them
+    if keywords is None:
+        return None
+    return " ".join(sorted(tokenize(keywords))) or None
+
+
+@dataclass(slots=True, frozen=True)
+class SavedSearchEntry:
+    """The criteria of a saved search, as held in memory by the matcher. Open price bounds are infinite."""
+
+    id: uuid.UUID
+    user_id: uuid.UUID
+    category: ListingCategory | None
+    min_price: float
+    max_price: float
+    keywords: tuple[str, ...]
+    # The search is indexed under this keyword, the longest one as it's likely the rarest
+    anchor: str | None
+    city: str | None  # Lowercased
+
+    @classmethod
+    def from_row(cls, id, user_id, category, min_price, max_price, keywords, city) -> "SavedSearchEntry":
+        words = tuple(keywords.split()) if keywords else ()
+        return cls(
+            id=id,
+            user_id=user_id,
+            category=ListingCategory(category) if category is not None else None,
+            min_price=min_price if min_price is not None else -math.inf,
+            max_price=max_price if max_price is not None else math.inf,
+            keywords=words,
+            anchor=max(words, key=lambda word: (len(word), word)) if words else None,
+            city=city.lower() if city else None,
+        )
+
+    @classmethod
+    def from_search(cls, search: SavedSearch) -> "SavedSearchEntry":
+        return cls.from_row(
+            search.id, search.user_id, search.category, search.min_price, search.max_price, search.keywords, search.city
+        )
+
+
+def build_interval_tree(entries: list[SavedSearchEntry]):
+    """
+    A centered interval tree over the entries' price ranges, as nested tuples of (center, entries containing the
+    center by ascending min_price, the same by descending max_price, left subtree, right subtree)
+    """
+    if not entries:
+        return None
+    # The median of a sample of endpoints. The entry the center comes from always contains it, so both subtrees
+    # are smaller than the node
+    step = max(1, len(entries) // CENTER_SAMPLE_SIZE)
+    sample = sorted(endpoint for entry in entries[::step] for endpoint in (entry.min_price, entry.max_price))
+    center = sample[len(sample) // 2]
+
+    left, containing, right = [], [], []
+    for entry in entries:
+        if entry.max_price < center:
+            left.append(entry)
+        elif entry.min_price > center:
+            right.append(entry)
+        else:
+            containing.append(entry)
+
+    return (
+        center,
+        sorted(containing, key=attrgetter("min_price")),
+        sorted(containing, key=attrgetter("max_price"), reverse=True),
+        build_interval_tree(left),
+        build_interval_tree(right),
+    )
+
+def stab_interval_tree(node, price: float, found: list):
+    # Appends the entries whose range contains price, in O(log n + matches)
+    while node is not None:
+        center, by_min_price, by_max_price, left, right = node
+        if price < center:
+            for entry in by_min_price:
+                if entry.min_price > price:
+                    break
+                found.append(entry)
+            node = left
+        elif price > center:
+            for entry in by_max_price:
+                if entry.max_price < price:
+                    break
+                found.append(entry)
+            node = right
+        else:
+            found.extend(by_min_price)
+            return
+
+
+class PriceIntervalIndex:
+    """
+    Finds the entries whose price range contains a price. The tree is static, additions are buffered and removals
+    remembered until the next rebuild, which happens once either has grown relative to the tree.
+    """
+
+    def __init__(self):
+        self.tree = None
+        self.tree_entries: list[SavedSearchEntry] = []
+        self.pending: list[SavedSearchEntry] = []
+        self.removed: set[uuid.UUID] = set()
+
+    def add(self, entry: SavedSearchEntry):
+        self.pending.append(entry)
+
+    def remove(self, entry: SavedSearchEntry):
+        if entry in self.pending:
+            self.pending.remove(entry)
+        else:
+            self.removed.add(entry.id)
+
+    def rebuild(self):
+        self.tree_entries = [entry for entry in self.tree_entries if entry.id not in self.removed] + self.pending
+        self.pending = []
+        self.removed = set()
+        self.tree = build_interval_tree(self.tree_entries)
+
+    def stab(self, price: float, found: list):
+        if len(self.pending) > max(REBUILD_MIN_PENDING, len(self.tree_entries) // 4) or len(self.removed) > len(self.tree_entries) // 2:
+            self.rebuild()
+
+        matches = []
+        stab_interval_tree(self.tree, price, matches)
+        if self.removed:
+            matches = [entry for entry in matches if entry.id not in self.removed]
+        matches += [entry for entry in self.pending if entry.min_price <= price <= entry.max_price]
+        found.extend(matches)
+
+
+class SavedSearchIndex:
+    """
+    All saved searches, grouped by (category, anchor keyword) with None for searches without either. A listing
+    can only match the groups of its own category or None and of one of its words or None, so only those
+    groups' price indexes are searched and only the candidates they return are checked in full.
+    """
+
+    def __init__(self):
+        self.groups: dict[tuple, PriceIntervalIndex] = {}
+        self.entries: dict[uuid.UUID, SavedSearchEntry] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry: SavedSearchEntry):
+        if entry.id in self.entries:
+            return
+        self.entries[entry.id] = entry
+        self.groups.setdefault((entry.category, entry.anchor), PriceIntervalIndex()).add(entry)
+
+    def remove(self, search_id: uuid.UUID):
+        entry = self.entries.pop(search_id, None)
+        if entry is not None:
+            self.groups[(entry.category, entry.anchor)].remove(entry)
+
+    def rebuild(self):
+        for group in self.groups.values():
+            group.rebuild()
+
+    def match(self, category: ListingCategory, price: float, words: set[str], city: str | None) -> list[SavedSearchEntry]:
+        candidates = []
+        for group_category in (category, None):
+            for anchor in (None, *words):
+                group = self.groups.get((group_category, anchor))
+                if group is not None:
+                    group.stab(price, candidates)
+
+        city = city.lower() if city else None
+        return [
+            entry for entry in candidates
+            if (entry.city is None or entry.city == city) and words.issuperset(entry.keywords)
+        ]
+
+
+def freeze_loaded_objects():
+    # The initially loaded index lives as long as the process. Every full garbage collection would go through all
+    # of its objects again, stopping every thread including the event loop's for longer the larger the index gets,
+    # so they're moved out of the collector's reach. Only on the initial load, as whatever else happens to be
+    # alive at that moment is frozen too
+    gc.freeze()
+
+def rebuild_loaded_index(index: SavedSearchIndex):
+    # The initial rebuild allocates the price trees of every group at once, so the collector is paused meanwhile
+    # instead of going through everything built so far over and over
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        index.rebuild()
+    finally:
+        if collecting:
+            gc.enable()
+    freeze_loaded_objects()
+
+
+class SavedSearchMatcher:
+    """
+    Matches new listings against the saved searches in a background task, so creating a listing only queues it.
+    Every worker keeps all saved searches in a SavedSearchIndex: those saved through it are added right away,
+    the others by a refresh before matching. Searches deleted through other workers are dropped once they match.
+
+    Building the index and matching against it is CPU work (seconds for the initial load of a large table), so
+    while the matcher runs, the index belongs to a thread of its own that does all of it. Every change goes
+    through that thread too, in order, so the event loop never sees the index halfway through a rebuild.
+    """
+
+    def __init__(self, refresh_interval: float, queue_size: int):
+        self.index = SavedSearchIndex()
+        self.refresh_interval = refresh_interval
+        self.queue_size = queue_size
+        self.queue: asyncio.Queue | None = None
+        self.loaded_until: datetime | None = None
+        self.last_refresh = 0.0
+        self._task: asyncio.Task | None = None
+        self._executor: ThreadPoolExecutor | None = None
+
+    def submit(self, listing: Listing, author_city: str | None):
+        # Must be called after the listing is committed, never waits
+        if self.queue is None:
+            return
+        try:
+            self.queue.put_nowait((
+                listing.id, listing.author_id, listing.category, listing.price,
+                f"{listing.title} {listing.description}", author_city,
+            ))
+        except asyncio.QueueFull:
+            logger.warning("Saved search matcher is behind, listing %s won't be matched", listing.id)
+
+    async def _on_index_thread(self, func, *args):
+        # Runs func on the index's thread, or right away while the matcher isn't running and nothing else uses it
+        if self._executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    def add(self, search: SavedSearch):
+        # Never waits, the search is added before any listing queued after it is matched
+        entry = SavedSearchEntry.from_search(search)
+        if self._executor is None:
+            self.index.add(entry)
+        else:
+            self._executor.submit(self.index.add, entry)
+
+    def remove(self, search_id: uuid.UUID):
+        if self._executor is None:
+            self.index.remove(search_id)
+        else:
+            self._executor.submit(self.index.remove, search_id)
+
+    def _add_rows(self, rows):
+        for row in rows:
+            self.index.add(SavedSearchEntry.from_row(*row))
+
+    def _find_matches(self, author_id, category, price, text, author_city) -> list[SavedSearchEntry]:
+        # May rebuild some of the index's price trees first
+        return [
+            entry for entry in self.index.match(category, price, tokenize(text), author_city) if entry.user_id != author_id
+        ]
+
+    async def load(self):
+        # Everything on the first load, then the searches saved since the previous one
+        started = datetime.now(timezone.utc)
+        first_load = self.loaded_until is None
+        query_statement = select(
+            SavedSearch.id, SavedSearch.user_id, SavedSearch.category, SavedSearch.min_price,
+            SavedSearch.max_price, SavedSearch.keywords, SavedSearch.city,
+        ).execution_options(yield_per=LOAD_BATCH_SIZE)
+        if self.loaded_until is not None:
+            query_statement = query_statement.where(SavedSearch.created_at > self.loaded_until - REFRESH_OVERLAP)
+
+        async with open_db_session() as session:
+            result = await session.stream(query_statement)
+            async for rows in result.partitions(LOAD_BATCH_SIZE):
+                await self._on_index_thread(self._add_rows, rows)
+                if first_load:
+                    freeze_loaded_objects()
+
+        self.loaded_until = started
+        self.last_refresh = time.monotonic()
+
+    async def match_listing(self, listing_id, author_id, category, price, text, author_city):
+        matches = await self._on_index_thread(self._find_matches, author_id, category, price, text, author_city)
+        if not matches:
+            return
+
+        async with open_db_session() as session:
+            existing_ids = set()
+            for start in range(0, len(matches), MATCH_BATCH_SIZE):
+                existing_ids.update((await session.exec(
+                    select(SavedSearch.id).where(SavedSearch.id.in_([entry.id for entry in matches[start:start + MATCH_BATCH_SIZE]]))
+                )).all())
+
+            # One alert per user, for the first of their matching searches
+            alerts = {}
+            for entry in matches:
+                if entry.id in existing_ids:
+                    alerts.setdefault(entry.user_id, entry.id)
+                else:
+                    self.index.remove(entry.id)
+            if not alerts:
+                return
+
+            insert = postgresql_insert if DB_BACKEND == "postgresql" else sqlite_insert
+            matched_at = datetime.now(timezone.utc)
+            alert_rows = [
+                {"user_id": user_id, "listing_id": listing_id, "saved_search_id": search_id, "created_at": matched_at}
+                for user_id, search_id in alerts.items()
+            ]
+            for start in range(0, len(alert_rows), MATCH_BATCH_SIZE):
+                await session.exec(
+                    insert(SavedSearchMatch)
+                    .values(alert_rows[start:start + MATCH_BATCH_SIZE])
+                    .on_conflict_do_nothing(index_elements=["user_id", "listing_id"])
+                )
+            await session.commit()
+
+    async def _run(self):
+        try:
+            await self.load()
+            await self._on_index_thread(rebuild_loaded_index, self.index)
+            logger.info("Saved search matcher loaded %d searches", len(self.index))
+        except Exception as e:
+            # The next refresh loads everything again
+            logger.exception("Unexpected exception when loading saved searches: %s", e)
+
+        while True:
+            listing = await self.queue.get()
+            try:
+                if time.monotonic() - self.last_refresh >= self.refresh_interval:
+                    await self.load()
+                await self.match_listing(*listing)
+            except Exception as e:
+                logger.exception("Unexpected exception when matching listing %s against saved searches: %s", listing[0], e)
+
+    def start(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="saved_search_matcher")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Listings still queued aren't matched, like those skipped when the queue is full
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.queue = None
+        if self._executor is not None:
+            # Doesn't wait for a rebuild or match that's already running, its result is just dropped
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+saved_search_matcher = SavedSearchMatcher(SAVED_SEARCHES_REFRESH_INTERVAL, SAVED_SEARCHES_QUEUE_SIZE)
+
+
+async def get_matches_page(session: AsyncSession, user_id: uuid.UUID, cursor: str | None, limit: int) -> tuple[list[SavedSearchMatch], str | None]:
+    # Newest alerts first, with the same keyset cursors as the listing pages
+    keys = [SavedSearchMatch.created_at, SavedSearchMatch.listing_id]
+    query_statement = (
+        select(SavedSearchMatch)
+        .where(SavedSearchMatch.user_id == user_id)
+        .options(selectinload(SavedSearchMatch.listing).selectinload(Listing.author))
+        .order_by(*(key.desc() for key in keys))
+    )
+    if cursor is not None:
+        query_statement = query_statement.where(tuple_(*keys) < tuple_(*decode_listing_cursor(cursor, len(keys))))
+
+    # Fetch one extra row to know whether there is a next page
+    matches = list((await session.exec(query_statement.limit(limit + 1))).all())
+
+    next_cursor = None
+    if len(matches) > limit:
+        matches = matches[:limit]
+        next_cursor = encode_listing_cursor([matches[-1].created_at, matches[-1].listing_id])
+
+    return matches, next_cursor
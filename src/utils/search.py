@@ -0,0 +1,72 @@
+from sqlalchemy import DDL, event, func, literal_column, select, table, column
+
+from ..database import DB_BACKEND
+from ..models import Listing
+
+# Full-text search over Listing.title and Listing.description.
+# On PostgreSQL a generated tsvector column (kept up to date by the DB itself on every insert and update)
+# is matched through a GIN index. SQLite, used for tests, gets an FTS5 index kept in sync by triggers instead.
+# Both are created together with the listing table, existing databases need them added by hand.
+
+SEARCH_LANGUAGE = "english"
+
+postgres_search_ddl = [
+    DDL(
+        "ALTER TABLE listing ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        f"setweight(to_tsvector('{SEARCH_LANGUAGE}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_LANGUAGE}', coalesce(description, '')), 'B')"
+        ") STORED"
+    ),
+    DDL("CREATE INDEX ix_listing_search_vector ON listing USING GIN (search_vector)"),
+]
+
+sqlite_search_ddl = [
+    DDL("CREATE VIRTUAL TABLE listing_fts USING fts5(title, description, content='listing', content_rowid='rowid')"),
+    DDL(
+        "CREATE TRIGGER listing_fts_insert AFTER INSERT ON listing BEGIN "
+        "INSERT INTO listing_fts(rowid, title, description) VALUES (new.rowid, new.title, new.description); "
+        "END"
+    ),
+    DDL(
+        "CREATE TRIGGER listing_fts_delete AFTER DELETE ON listing BEGIN "
+        "INSERT INTO listing_fts(listing_fts, rowid, title, description) VALUES ('delete', old.rowid, old.title, old.description); "
+        "END"
+    ),
+    DDL(
+        "CREATE TRIGGER listing_fts_update AFTER UPDATE ON listing BEGIN "
+        "INSERT INTO listing_fts(listing_fts, rowid, title, description) VALUES ('delete', old.rowid, old.title, old.description); "
+        "INSERT INTO listing_fts(rowid, title, description) VALUES (new.rowid, new.title, new.description); "
+        "END"
+    ),
+]
+
+for ddl in postgres_search_ddl:
+    event.listen(Listing.__table__, "after_create", ddl.execute_if(dialect="postgresql"))
+for ddl in sqlite_search_ddl:
+    event.listen(Listing.__table__, "after_create", ddl.execute_if(dialect="sqlite"))
+
+listing_fts = table("listing_fts", column("rowid"))
+
+def to_fts5_query(search_query: str) -> str:
+    # Quote every word so that user input can't use (or break on) the FTS5 query syntax, all words must match
+    return " ".join('"' + word.replace('"', '""') + '"' for word in search_query.split())
+
+def listing_search_filter(search_query: str):
+    if DB_BACKEND == "postgresql":
+        return literal_column("listing.search_vector").op("@@")(func.websearch_to_tsquery(SEARCH_LANGUAGE, search_query))
+
+    fts_match = literal_column("listing_fts").op("MATCH")(to_fts5_query(search_query))
+    return literal_column("listing.rowid").in_(select(listing_fts.c.rowid).where(fts_match))
+
+def listing_search_rank(search_query: str):
+    # Higher is more relevant on both backends
+    if DB_BACKEND == "postgresql":
+        return func.ts_rank_cd(literal_column("listing.search_vector"), func.websearch_to_tsquery(SEARCH_LANGUAGE, search_query))
+
+    fts_match = literal_column("listing_fts").op("MATCH")(to_fts5_query(search_query))
+    return (
+        select(-func.bm25(literal_column("listing_fts")))
+        .select_from(listing_fts)
+        .where(fts_match, listing_fts.c.rowid == literal_column("listing.rowid"))
+        .scalar_subquery()
+    )
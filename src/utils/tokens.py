@@ -2,27 +2,29 @@ import secrets
 
 import bcrypt
 from fastapi import HTTPException
-from sqlmodel import Session
+from sqlmodel import select, or_
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..models import User
+from .workers import password_hashing_pool
 
-def generate_unique_session_token(session: Session) -> str:
-    while True:
-        new_token = secrets.token_urlsafe(32)
-        user_with_matching_token = session.exec(Select(User).where(User.session_token == new_token))
-        if not user_with_matching_token:
-            return new_token
+def generate_session_token() -> str:
+    # 256 random bits, uniqueness is still guaranteed by the unique index on User.session_token
+    return secrets.token_urlsafe(32)
 
-def validate_password(password: str, stored_password: str) -> bool:
+def _validate_password(password: str, stored_password: str) -> bool:
     return bcrypt.checkpw(password.encode("utf-8"), stored_password.encode("utf-8"))
 
-def authenticate_user(session: Session, username: str, password: str) -> User:
+async def validate_password(password: str, stored_password: str) -> bool:
+    return await password_hashing_pool.run(_validate_password, password, stored_password)
+
+async def authenticate_user(session: AsyncSession, username: str, password: str) -> User:
     # "username" can be either the user's username or email
-    user: User = session.exec(select(User).where(or_(User.username == username, User.email == username))).first()
-    if not user or not validate_password(password, user.hashed_password):
+    user: User = (await session.exec(select(User).where(or_(User.username == username, User.email == username)))).first()
+    if not user or not await validate_password(password, user.hashed_password):
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return user
\ No newline at end of file
+    return user
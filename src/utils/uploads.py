@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+from PIL import Image
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from ..app_config import IMAGES_FOLDER_PATH
+from .workers import image_processing_pool
+
+# The image type is taken from the file's leading bytes, never from the client supplied content type
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "jpeg",
+    b"\x89PNG\r\n\x1a\n": "png",
+}
+SIGNATURE_LENGTH = max(len(signature) for signature in IMAGE_SIGNATURES)
+
+# Allowance for the multipart boundaries and part headers on top of the files themselves
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadedImage:
+    """A file part of a multipart request, streamed into a temp file next to its final location"""
+
+    def __init__(self, field_name: str, filename: str):
+        self.field_name = field_name
+        self.filename = filename
+        self.size = 0
+        self.image_type = None
+        self.temp_path = None
+        self.file = None
+        self.head = b""  # Leading bytes, kept until the image type is known
+        self.content_hash = hashlib.sha256()  # Computed while streaming so the file never has to be read back
+
+def detect_image_type(head: bytes) -> str | None:
+    for signature, image_type in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return image_type
+    return None
+
+def _open_temp_file():
+    # Created in the images folder itself so that moving it into place is an atomic rename
+    file_descriptor, temp_path = tempfile.mkstemp(dir=IMAGES_FOLDER_PATH, prefix=".upload_")
+    return os.fdopen(file_descriptor, "wb"), temp_path
+
+def _write_chunks(upload: UploadedImage, chunks: list[bytes]):
+    if upload.file is None:
+        upload.file, upload.temp_path = _open_temp_file()
+    for chunk in chunks:
+        upload.file.write(chunk)
+        upload.content_hash.update(chunk)
+
+def _verify_image(temp_path: str) -> bool:
+    # Runs in a worker process, decoding untrusted files is kept out of the API process
+    try:
+        with Image.open(temp_path) as image:
+            image.verify()
+        return True
+    except Exception:
+        return False
+
+def _discard(upload: UploadedImage):
+    if upload.file is not None:
+        upload.file.close()
+    if upload.temp_path is not None:
+        try:
+            os.remove(upload.temp_path)
+        except FileNotFoundError:
+            pass
+
+async def receive_image_uploads(request: Request, field_name: str, max_file_size: int, max_files: int = 1) -> list[UploadedImage]:
+    """
+    Parses a multipart/form-data body as it arrives and streams every file sent as field_name into its own
+    temp file, so memory use doesn't depend on the upload size. The size and count limits are enforced on the
+    bytes actually received. Other fields are ignored. The returned images must be either moved into the
+    image storage (see utils.images.store_image) or removed with discard_uploaded_images.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Request must be multipart/form-data")
+
+    max_file_size_mb = max_file_size // (1024 * 1024)
+    uploads: list[UploadedImage] = []
+    current_part = {}
+    pending_chunks: list[tuple[UploadedImage, bytes]] = []  # Parsed but not yet written, at most one request chunk
+
+    def on_part_begin():
+        current_part.clear()
+        current_part["headers"] = {}
+        current_part["header_field"] = b""
+        current_part["header_value"] = b""
+        current_part["upload"] = None
+
+    def on_header_field(data: bytes, start: int, end: int):
+        current_part["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        current_part["header_value"] += data[start:end]
+
+    def on_header_end():
+        current_part["headers"][current_part["header_field"].lower()] = current_part["header_value"]
+        current_part["header_field"] = b""
+        current_part["header_value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(current_part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name", b"").decode("utf-8", "replace") != field_name or b"filename" not in disposition:
+            return
+
+        if len(uploads) >= max_files:
+            raise HTTPException(status_code=400, detail=f"At most {max_files} file(s) can be uploaded at once")
+
+        upload = UploadedImage(field_name, disposition[b"filename"].decode("utf-8", "replace"))
+        uploads.append(upload)
+        current_part["upload"] = upload
+
+    def on_part_data(data: bytes, start: int, end: int):
+        upload = current_part["upload"]
+        if upload is None:
+            return
+
+        upload.size += end - start
+        if upload.size > max_file_size:
+            raise HTTPException(status_code=400, detail=f"File size must not exceed {max_file_size_mb}MB")
+
+        pending_chunks.append((upload, data[start:end]))
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+
+    max_body_size = max_files * max_file_size + MULTIPART_OVERHEAD
+    received = 0
+
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_body_size:
+                raise HTTPException(status_code=400, detail=f"File size must not exceed {max_file_size_mb}MB")
+
+            parser.write(chunk)
+            await flush_pending_chunks(pending_chunks)
+
+        parser.finalize()
+        await flush_pending_chunks(pending_chunks)
+
+        if not uploads:
+            raise HTTPException(status_code=400, detail=f"No file was uploaded as {field_name}")
+
+        for upload in uploads:
+            if upload.image_type is None:
+                raise HTTPException(status_code=400, detail="File type must be either JPEG or PNG")
+            await run_in_threadpool(upload.file.close)
+
+    except Exception:
+        await discard_uploaded_images(uploads)
+        raise
+
+    return uploads
+
+async def flush_pending_chunks(pending_chunks: list[tuple[UploadedImage, bytes]]):
+    chunks_by_upload: dict[UploadedImage, list[bytes]] = {}
+    for upload, data in pending_chunks:
+        if upload.image_type is None:
+            upload.head += data[:SIGNATURE_LENGTH - len(upload.head)]
+            upload.image_type = detect_image_type(upload.head)
+            if upload.image_type is None and len(upload.head) >= SIGNATURE_LENGTH:
+                raise HTTPException(status_code=400, detail="File type must be either JPEG or PNG")
+        chunks_by_upload.setdefault(upload, []).append(data)
+    pending_chunks.clear()
+
+    for upload, chunks in chunks_by_upload.items():
+        await run_in_threadpool(_write_chunks, upload, chunks)
+
+async def discard_uploaded_images(uploads: list[UploadedImage]):
+    for upload in uploads:
+        await run_in_threadpool(_discard, upload)
+
+async def verify_uploaded_images(uploads: list[UploadedImage]):
+    """
+    Checks that the uploaded files actually decode as images (the signature check only looks at their first
+    bytes). The files are checked concurrently, on failure all of them are discarded.
+    """
+    try:
+        results = await asyncio.gather(*(image_processing_pool.run(_verify_image, upload.temp_path) for upload in uploads))
+    except Exception:
+        await discard_uploaded_images(uploads)
+        raise
+
+    if not all(results):
+        await discard_uploaded_images(uploads)
+        raise HTTPException(status_code=400, detail="File is not a valid JPEG or PNG image")
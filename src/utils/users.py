@@ -2,41 +2,33 @@ import uuid
 
 import bcrypt
 from fastapi import HTTPException
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..app_config import BCRYPT_ROUNDS
 from ..models import User
+from .constraints import USER_EMAIL_KEY, USER_USERNAME_KEY
+from .workers import password_hashing_pool
 
-def check_unique_new_user(session: Session, new_user: User) -> None:
-    existing_user = session.exec(select(User).where(or_(User.username == new_user.username, User.email == new_user.email))).first()
+# The unique columns a user sets themselves -> the response detail when they're already taken
+USER_UNIQUE_VIOLATIONS = {
+    USER_USERNAME_KEY: "Username already exists",
+    USER_EMAIL_KEY: "Email already exists",
+}
 
-    if existing_user is None:
-        return
-    if existing_user.username == new_user.username:
-        raise HTTPException(
-            status=409,
-            detail="Username already exists"
-        )
-    raise HTTPException(
-        status=409,
-        detail="Email already exists"
-    )
-
-def ensure_unique_user_id(session: Session, user: User) -> User:
-    while session.get(User, user.id) is not None:
-        user.id = uuid.uuid4()
-    return user
-
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
+def _hash_password(password: str) -> str:
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
 
     hashed_password = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed_password.decode("utf-8")
 
-def get_user_by_id(sesison: Session, user_id: uuid.UUID) -> User:
-    user = session.get(User, user_id)
+async def hash_password(password: str) -> str:
+    return await password_hashing_pool.run(_hash_password, password)
+
+async def get_user_by_id(session: AsyncSession, user_id: uuid.UUID) -> User:
+    user = await session.get(User, user_id)
     if user is None:
         raise HTTPException(
-            status=404,
+            status_code=404,
             detail="User not found"
         )
     return user
@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import multiprocessing
+
+from fastapi import HTTPException
+
+from ..app_config import PASSWORD_HASHING_WORKERS, PASSWORD_HASHING_MAX_QUEUED, PASSWORD_HASHING_USE_PROCESSES
+from ..app_config import IMAGE_PROCESSING_WORKERS, IMAGE_PROCESSING_MAX_QUEUED
+from ..logging_config import logger
+
+
+class BoundedPool:
+    """
+    Runs blocking, CPU heavy calls outside the event loop. At most max_workers calls run at once and at most
+    max_queued more may wait for a worker, anything beyond that is rejected with a 503 instead of piling up.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queued: int, use_processes: bool = False):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.use_processes = use_processes
+        self.pending = 0  # Calls currently running or waiting for a worker
+        self._executor = None
+
+    def _get_executor(self):
+        # Created on first use so that importing the module doesn't spawn workers
+        if self._executor is None:
+            if self.use_processes:
+                # Spawned rather than forked, forking a process that runs an event loop and threads isn't safe
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        # With process workers func and its arguments must be picklable (i.e. module level functions)
+        if self.pending >= self.max_workers + self.max_queued:
+            logger.warning("%s pool saturated, rejecting call to %s", self.name, func.__name__)
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please try again later",
+                headers={"Retry-After": "1"},
+            )
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for using too much memory), start a fresh pool for the next calls
+            logger.exception("%s pool broke, replacing its workers", self.name)
+            self._executor = None
+            raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+password_hashing_pool = BoundedPool(
+    "password_hashing",
+    PASSWORD_HASHING_WORKERS,
+    PASSWORD_HASHING_MAX_QUEUED,
+    PASSWORD_HASHING_USE_PROCESSES,
+)
+
+image_processing_pool = BoundedPool(
+    "image_processing",
+    IMAGE_PROCESSING_WORKERS,
+    IMAGE_PROCESSING_MAX_QUEUED,
+    use_processes=True,
+)
@@ -0,0 +1,69 @@
+import atexit
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+# The app reads ./config.json when it's imported, so the tests run it from a directory of their own.
+# On SQLite by default, TEST_DATABASE_URL can point them at an empty PostgreSQL database instead
+TEST_DIR = tempfile.mkdtemp(prefix="marketplace_tests_")
+TEST_CONFIG = {
+    "database": {"url": os.environ.get("TEST_DATABASE_URL", "sqlite:///./test.db"), "use_async": True},
+    "log_file_directory_path": ".",
+    "images_folder_path": "./images",
+    "password_hashing": {"bcrypt_rounds": 4},
+    "geocoding": {"postal_codes_path": "./postal_codes.txt"},
+}
+# A few rows in the GeoNames format, for the near= queries
+TEST_POSTAL_CODES = [
+    ("CZ", "110 00", "Praha", 50.0833, 14.4167),
+    ("CZ", "272 01", "Kladno", 50.1473, 14.1029),
+    ("CZ", "602 00", "Brno", 49.1952, 16.6080),
+]
+os.makedirs(os.path.join(TEST_DIR, "images"))
+with open(os.path.join(TEST_DIR, "config.json"), "w") as config_file:
+    json.dump(TEST_CONFIG, config_file)
+with open(os.path.join(TEST_DIR, "postal_codes.txt"), "w") as postal_codes_file:
+    for country, postal_code, city, latitude, longitude in TEST_POSTAL_CODES:
+        postal_codes_file.write("\t".join([country, postal_code, city, "", "", "", "", "", "", str(latitude), str(longitude), "4"]) + "\n")
+os.chdir(TEST_DIR)
+atexit.register(shutil.rmtree, TEST_DIR, ignore_errors=True)
+
+TEST_PASSWORD = "Passw0rd!"
+user_numbers = itertools.count()
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+@pytest.fixture(scope="session")
+def create_user(client):
+    # Registers and logs in a new user, returns (user id, authorization headers)
+    def create(**fields):
+        username = f"test_user_{next(user_numbers)}"
+        user_data = {
+            "email": f"{username}@example.com",
+            "username": username,
+            "birth_date": "1990-01-01",
+            "postal_code": "11000",
+            "city": "Praha",
+            "password": TEST_PASSWORD,
+            **fields,
+        }
+        response = client.post("/users/", json=user_data)
+        assert response.status_code == 201, response.text
+        token = client.post("/tokens/", data={"username": username, "password": TEST_PASSWORD}).json()["access_token"]
+        return response.json()["id"], {"Authorization": f"Bearer {token}"}
+    return create
@@ -0,0 +1,36 @@
+def find_listing(client, listing_id: str, **params) -> dict:
+    page = client.get("/listings/", params={"limit": 100, **params}).json()
+    return next(entry for entry in page["listings"] if entry["id"] == listing_id)
+
+def test_flushed_bookmark_counts_reach_cached_pages(client, create_user):
+    from src.utils.bookmarks import bookmark_counter
+
+    _, headers = create_user()
+    listing_id = client.post("/listings/", json={"title": "bookmarked", "category": "books", "price": 1}, headers=headers).json()["id"]
+
+    # Both pages are cached before the count changes
+    assert find_listing(client, listing_id)["bookmark_count"] == 0
+    assert find_listing(client, listing_id, category="books")["bookmark_count"] == 0
+
+    _, bookmarker_headers = create_user()
+    assert client.put(f"/bookmarks/{listing_id}", headers=bookmarker_headers).status_code == 204
+    client.portal.call(bookmark_counter.flush)
+
+    assert find_listing(client, listing_id)["bookmark_count"] == 1
+    assert find_listing(client, listing_id, category="books")["bookmark_count"] == 1
+
+def test_listing_revalidation_sees_flushed_bookmark_counts(client, create_user):
+    from src.utils.bookmarks import bookmark_counter
+
+    _, headers = create_user()
+    listing_id = client.post("/listings/", json={"title": "revalidated", "category": "books", "price": 1}, headers=headers).json()["id"]
+    response = client.get(f"/listings/{listing_id}")
+    assert response.json()["bookmark_count"] == 0
+
+    _, bookmarker_headers = create_user()
+    assert client.put(f"/bookmarks/{listing_id}", headers=bookmarker_headers).status_code == 204
+    client.portal.call(bookmark_counter.flush)
+
+    # The count isn't reflected in any timestamp, so a date alone must not validate the old copy
+    assert "Last-Modified" not in response.headers
+    assert client.get(f"/listings/{listing_id}", headers={"If-None-Match": response.headers["ETag"]}).json()["bookmark_count"] == 1
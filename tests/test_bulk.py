@@ -0,0 +1,29 @@
+def create_listings(client, headers, count: int) -> list[str]:
+    return [
+        client.post("/listings/", json={"title": f"listing {index}", "category": "books", "price": index}, headers=headers).json()["id"]
+        for index in range(count)
+    ]
+
+def test_bulk_update_rejects_nulls_per_row(client, create_user):
+    _, headers = create_user()
+    first_id, second_id = create_listings(client, headers, 2)
+
+    response = client.patch("/listings/bulk", json=[
+        {"id": first_id, "title": None},
+        {"id": second_id, "title": "renamed"},
+    ], headers=headers)
+    assert response.status_code == 200, response.text
+    assert [result["status"] for result in response.json()["results"]] == ["invalid", "updated"]
+
+    assert client.get(f"/listings/{first_id}").json()["title"] == "listing 0"
+    assert client.get(f"/listings/{second_id}").json()["title"] == "renamed"
+
+def test_bulk_delete_reports_repeated_ids(client, create_user):
+    _, headers = create_user()
+    listing_id, = create_listings(client, headers, 1)
+
+    response = client.request("DELETE", "/listings/bulk", json=[listing_id, listing_id], headers=headers)
+    assert response.status_code == 200, response.text
+    assert [result["status"] for result in response.json()["results"]] == ["deleted", "duplicate"]
+    assert response.json()["succeeded"] == 1
+    assert response.json()["failed"] == 1
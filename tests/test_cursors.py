@@ -0,0 +1,33 @@
+import base64
+import json
+
+import pytest
+
+
+def cursor_of(position: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode("ascii")
+
+VALID_CREATED_AT = "2024-01-01 00:00:00+00:00"
+VALID_ID = "00000000-0000-4000-8000-000000000000"
+
+@pytest.mark.parametrize("sort, position", [
+    ("price_asc", ["x", VALID_CREATED_AT, VALID_ID]),
+    ("price_desc", [None, VALID_CREATED_AT, VALID_ID]),
+    ("price_asc", [True, VALID_CREATED_AT, VALID_ID]),
+    ("price_asc", [10, 5, VALID_ID]),
+    ("price_asc", [10, VALID_CREATED_AT, 7]),
+    ("newest", [VALID_CREATED_AT, "not a uuid"]),
+    ("newest", {"created_at": VALID_CREATED_AT, "id": VALID_ID}),
+    ("newest", [10, VALID_CREATED_AT, VALID_ID]),
+])
+def test_mistyped_cursors_are_rejected(client, sort, position):
+    response = client.get("/listings/", params={"sort": sort, "cursor": cursor_of(position)})
+    assert response.status_code == 400, response.text
+
+def test_relevance_cursor_needs_a_number(client):
+    response = client.get("/listings/", params={"q": "vintage", "cursor": cursor_of(["x", VALID_CREATED_AT, VALID_ID])})
+    assert response.status_code == 400, response.text
+
+def test_wellformed_cursor_is_accepted(client):
+    response = client.get("/listings/", params={"sort": "price_asc", "cursor": cursor_of([10.5, VALID_CREATED_AT, VALID_ID])})
+    assert response.status_code == 200, response.text
@@ -0,0 +1,37 @@
+import io
+
+from PIL import Image
+
+
+def png_bytes(color: tuple[int, int, int]) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+def upload_profile_picture(client, headers, picture: bytes):
+    response = client.post("/users/me/picture", files={"uploaded_file": ("picture.png", picture, "image/png")}, headers=headers)
+    assert response.status_code == 201, response.text
+    return response.headers["Location"]
+
+def test_reuploaded_image_survives_concurrent_deletion(client, create_user, monkeypatch):
+    import src.routes.users
+    from src.utils.image_store import image_storage
+
+    picture = png_bytes((200, 30, 30))
+    _, first_headers = create_user()
+    link = upload_profile_picture(client, first_headers, picture)
+    key = image_storage.key_from_link(link)
+
+    # The second upload finds the file, then the first user's release of their last reference deletes it before
+    # the second upload's reference is committed
+    original_release_image = src.routes.users.release_image
+
+    async def release_image_while_deleted(session, image_link):
+        await image_storage.delete(key)
+        return await original_release_image(session, image_link)
+
+    monkeypatch.setattr(src.routes.users, "release_image", release_image_while_deleted)
+    _, second_headers = create_user()
+    assert upload_profile_picture(client, second_headers, picture) == link
+
+    assert client.get(link).status_code == 200
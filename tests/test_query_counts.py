@@ -0,0 +1,122 @@
+from collections import defaultdict
+import itertools
+
+import pytest
+from sqlalchemy import event
+
+# The number of SQL statements each read endpoint runs, so that an N+1 query (e.g. a lazy load per listing on a page)
+# fails here instead of showing up as a slow endpoint. Statements are attributed to requests by their request id,
+# so the background tasks querying the same DB meanwhile aren't counted.
+
+request_numbers = itertools.count()
+
+
+@pytest.fixture
+def statements():
+    from src.database import sync_engine
+    from src.logging_config import request_id
+
+    statements_by_request = defaultdict(list)
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements_by_request[request_id.get()].append(statement)
+
+    event.listen(sync_engine, "before_cursor_execute", record)
+    yield statements_by_request
+    event.remove(sync_engine, "before_cursor_execute", record)
+
+@pytest.fixture
+def checkouts():
+    from src.database import sync_engine
+    from src.logging_config import request_id
+
+    checkouts_by_request = defaultdict(int)
+
+    def record(dbapi_connection, connection_record, connection_proxy):
+        checkouts_by_request[request_id.get()] += 1
+
+    event.listen(sync_engine, "checkout", record)
+    yield checkouts_by_request
+    event.remove(sync_engine, "checkout", record)
+
+@pytest.fixture
+def get_counted(client, statements):
+    # GET returning the response and the statements run while handling it
+    def get(path, **kwargs):
+        current_id = f"query-count-{next(request_numbers)}"
+        headers = {**kwargs.pop("headers", {}), "X-Request-ID": current_id}
+        response = client.get(path, headers=headers, **kwargs)
+        assert response.status_code == 200, response.text
+        return response, statements[current_id]
+    return get
+
+@pytest.fixture
+def listings_of_several_authors(client, create_user):
+    # A page long enough to expose a query per listing or per author
+    listing_ids = []
+    for _ in range(3):
+        _, headers = create_user()
+        for index in range(4):
+            response = client.post("/listings/", json={"title": f"listing {index}", "category": "books", "price": index}, headers=headers)
+            listing_ids.append(response.json()["id"])
+    return listing_ids
+
+
+def test_listing_page_queries(get_counted, listings_of_several_authors, create_user):
+    from src.dependencies import session_token_cache
+
+    # One query for the page with its authors joined in, none when the page comes from the cache
+    response, page_statements = get_counted("/listings/", params={"limit": 12})
+    assert len(response.json()["listings"]) == 12
+    assert len(page_statements) == 1
+
+    _, cached_statements = get_counted("/listings/", params={"limit": 12})
+    assert len(cached_statements) == 0
+
+    # A logged-in user's bookmark flags take one query for the whole page, plus the token lookup while it isn't cached
+    _, headers = create_user()
+    session_token_cache.clear()
+    _, user_statements = get_counted("/listings/", params={"limit": 12}, headers=headers)
+    assert len(user_statements) == 2
+
+    _, cached_user_statements = get_counted("/listings/", params={"limit": 12}, headers=headers)
+    assert len(cached_user_statements) == 1
+
+def test_listing_queries(get_counted, listings_of_several_authors):
+    # The author is joined in, the pictures take one more query
+    response, listing_statements = get_counted(f"/listings/{listings_of_several_authors[0]}")
+    assert response.json()["owner"]["username"]
+    assert len(listing_statements) == 2
+
+def test_public_user_queries(client, get_counted, create_user):
+    user_id, headers = create_user()
+    for index in range(20):
+        client.post("/listings/", json={"title": f"listing {index}", "category": "books", "price": index}, headers=headers)
+
+    # The user, a page of their listings and their total
+    response, user_statements = get_counted(f"/users/{user_id}")
+    assert response.json()["listings_total"] == 20
+    assert len(user_statements) == 3
+
+def test_current_user_queries(get_counted, create_user):
+    from src.dependencies import session_token_cache
+
+    _, headers = create_user()
+    session_token_cache.clear()
+
+    # The token lookup, then nothing while the user stays in the session token cache
+    _, first_statements = get_counted("/users/me", headers=headers)
+    assert len(first_statements) == 1
+
+    _, cached_statements = get_counted("/users/me", headers=headers)
+    assert len(cached_statements) == 0
+
+def test_logged_in_read_uses_one_connection(get_counted, checkouts, listings_of_several_authors, create_user):
+    from src.dependencies import session_token_cache
+
+    # Without replicas the token lookup and the page query share the request's primary session
+    _, headers = create_user()
+    session_token_cache.clear()
+    _, page_statements = get_counted("/listings/", params={"limit": 12, "category": "books"}, headers=headers)
+    assert len(page_statements) >= 2
+    assert sum(count for current_id, count in checkouts.items() if current_id.startswith("query-count-")) == 1
@@ -0,0 +1,118 @@
+import itertools
+import re
+
+import pytest
+from sqlalchemy import event
+
+# Every supported filter/sort combination of GET /listings/ must read listing through an index: the plan of each
+# statement a request runs on listing is taken with EXPLAIN on the same connection, right before it's executed.
+# On PostgreSQL sequential scans are disabled while explaining, so that the tiny test table can't make one look
+# cheaper than an index and any Seq Scan left means no index could be used at all.
+
+# SQLite: "SCAN listing" reads the whole table. "SCAN listing USING [COVERING] INDEX ..." walks a whole index, which
+# only stops early if the index is in the requested order, i.e. the rows don't go through a temp B-tree to be sorted
+SQLITE_TABLE_SCAN = re.compile(r"\bSCAN listing\b(?! USING (COVERING )?INDEX)")
+SQLITE_INDEX_SCAN = re.compile(r"\bSCAN listing USING (COVERING )?INDEX\b")
+SQLITE_SORT = "USE TEMP B-TREE FOR ORDER BY"
+POSTGRES_TABLE_SCAN = re.compile(r"\bSeq Scan on listing\b")
+
+request_numbers = itertools.count()
+
+
+def explain(dbapi_connection, dialect_name: str, statement: str, parameters) -> list[str]:
+    cursor = dbapi_connection.cursor()
+    try:
+        if dialect_name == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute("SET enable_seqscan = off")
+        try:
+            cursor.execute("EXPLAIN " + statement, parameters)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.execute("RESET enable_seqscan")
+    finally:
+        cursor.close()
+
+@pytest.fixture(scope="module")
+def query_plans(client):
+    from src.database import sync_engine
+    from src.logging_config import request_id
+
+    plans_by_request = {}
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if not request_id.get().startswith("query-plan-") or not re.search(r"\bFROM listing\b", statement):
+            return
+        plan = explain(connection.connection, connection.dialect.name, statement, parameters)
+        plans_by_request.setdefault(request_id.get(), []).append((statement, plan))
+
+    event.listen(sync_engine, "before_cursor_execute", record)
+    yield plans_by_request
+    event.remove(sync_engine, "before_cursor_execute", record)
+
+@pytest.fixture(scope="module")
+def author_id(client, create_user):
+    # Enough listings that most combinations have a second page, so the keyset condition is explained too
+    author_id, headers = create_user(postal_code="110 00")
+    for index in range(6):
+        for category in ("books", "laptops"):
+            client.post(
+                "/listings/",
+                json={"title": f"vintage item {index}", "description": "in good shape", "category": category, "price": index * 10},
+                headers=headers,
+            )
+    return author_id
+
+def table_scans(plans: list[tuple[str, list[str]]]) -> list[str]:
+    from src.database import DB_BACKEND
+
+    scans = []
+    for statement, plan in plans:
+        if DB_BACKEND == "sqlite":
+            sorted_afterwards = SQLITE_SORT in plan
+            scans += [
+                line for line in plan
+                if SQLITE_TABLE_SCAN.search(line) or (sorted_afterwards and SQLITE_INDEX_SCAN.search(line))
+            ]
+        else:
+            scans += [line for line in plan if POSTGRES_TABLE_SCAN.search(line)]
+        if scans:
+            return [*scans, f"in: {statement}"]
+    return scans
+
+def get_explained(client, query_plans, params: dict) -> tuple[dict, list]:
+    current_id = f"query-plan-{next(request_numbers)}"
+    response = client.get("/listings/", params=params, headers={"X-Request-ID": current_id})
+    assert response.status_code == 200, response.text
+    return response.json(), query_plans.get(current_id, [])
+
+CATEGORIES = [None, ["books"], ["books", "laptops"]]
+PRICE_FILTERS = [{}, {"min_price": 15}, {"max_price": 35}, {"min_price": 15, "max_price": 35}]
+SORTS = ["newest", "price_asc", "price_desc"]
+
+COMBINATIONS = [
+    {"category": category, **price_filter, "by_author": by_author, "sort": sort}
+    for category, price_filter, by_author, sort in itertools.product(CATEGORIES, PRICE_FILTERS, (False, True), SORTS)
+]
+COMBINATIONS += [
+    {"category": category, "q": "vintage", "sort": sort}
+    for category, sort in itertools.product(CATEGORIES, [*SORTS, "relevance"])
+]
+COMBINATIONS += [{"category": category, "near": "11000", "sort": sort} for category, sort in itertools.product(CATEGORIES, SORTS)]
+
+@pytest.mark.parametrize("combination", COMBINATIONS, ids=lambda combination: "-".join(
+    f"{key}={value}" for key, value in combination.items() if value not in (None, False)
+))
+def test_listing_queries_use_indexes(client, query_plans, author_id, combination):
+    params = {key: value for key, value in combination.items() if key != "by_author" and value is not None}
+    if combination.get("by_author"):
+        params["author_id"] = author_id
+
+    page, plans = get_explained(client, query_plans, {**params, "limit": 1})
+    assert plans, "No statement on listing was run, the page may have come from the cache"
+    assert not table_scans(plans), "\n".join(table_scans(plans))
+
+    if page["next_cursor"] is not None:
+        _, next_page_plans = get_explained(client, query_plans, {**params, "limit": 1, "cursor": page["next_cursor"]})
+        assert not table_scans(next_page_plans), "\n".join(table_scans(next_page_plans))
@@ -0,0 +1,64 @@
+import threading
+import time
+import uuid
+
+
+def wait_for_matches(client, headers, expected: int, timeout: float = 5) -> list:
+    # Matching runs in the background after the listing is created
+    deadline = time.monotonic() + timeout
+    while True:
+        matches = client.get("/saved-searches/matches", headers=headers).json()["matches"]
+        if len(matches) >= expected or time.monotonic() > deadline:
+            return matches
+        time.sleep(0.02)
+
+async def delete_saved_search(search_id: str):
+    from sqlmodel import delete
+    from src.dependencies import open_db_session
+    from src.models import SavedSearch
+
+    async with open_db_session() as session:
+        await session.exec(delete(SavedSearch).where(SavedSearch.id == uuid.UUID(search_id)))
+        await session.commit()
+
+def test_matches_are_checked_and_inserted_in_batches(client, create_user, monkeypatch):
+    from src.utils import saved_searches
+
+    monkeypatch.setattr(saved_searches, "MATCH_BATCH_SIZE", 2)
+
+    searchers = []
+    for _ in range(5):
+        _, headers = create_user()
+        search = client.post("/saved-searches/", json={"keywords": "batched", "category": "books"}, headers=headers).json()
+        searchers.append((headers, search["id"]))
+    # Deleted through another worker, so this one's matcher still has it and only finds out in the batch it lands in
+    deleted_headers, deleted_search_id = searchers.pop(2)
+    client.portal.call(delete_saved_search, deleted_search_id)
+
+    _, seller_headers = create_user()
+    listing_id = client.post("/listings/", json={"title": "batched", "category": "books", "price": 1}, headers=seller_headers).json()["id"]
+
+    for headers, search_id in searchers:
+        matches = wait_for_matches(client, headers, 1)
+        assert [(match["listing"]["id"], match["saved_search_id"]) for match in matches] == [(listing_id, search_id)]
+    assert wait_for_matches(client, deleted_headers, 1, timeout=0.2) == []
+
+def test_matching_runs_off_the_event_loop(client, create_user, monkeypatch):
+    from src.utils.saved_searches import SavedSearchIndex
+
+    threads = []
+    original_match = SavedSearchIndex.match
+
+    def recording_match(self, *args):
+        threads.append(threading.current_thread().name)
+        return original_match(self, *args)
+
+    monkeypatch.setattr(SavedSearchIndex, "match", recording_match)
+
+    _, headers = create_user()
+    client.post("/saved-searches/", json={"keywords": "threaded"}, headers=headers)
+    _, seller_headers = create_user()
+    client.post("/listings/", json={"title": "threaded", "category": "books", "price": 1}, headers=seller_headers)
+
+    assert len(wait_for_matches(client, headers, 1)) == 1
+    assert threads and all(name.startswith("saved_search_matcher") for name in threads)
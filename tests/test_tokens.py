@@ -0,0 +1,19 @@
+from conftest import TEST_PASSWORD
+
+
+def login(client, username: str):
+    response = client.post("/tokens/", data={"username": username, "password": TEST_PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_login_rotates_the_token(client, create_user):
+    _, headers = create_user()
+    username = client.get("/users/me", headers=headers).json()["username"]  # Also puts the token in the cache
+
+    body = login(client, username)
+    assert body["token_type"] == "bearer"
+    assert f"Bearer {body['access_token']}" != headers["Authorization"]
+
+    # The previous token is revoked, even though it was cached
+    assert client.get("/users/me", headers=headers).status_code == 401
+    assert client.get("/users/me", headers={"Authorization": f"Bearer {body['access_token']}"}).status_code == 200
@@ -0,0 +1,11 @@
+def test_update_rejects_taken_username_when_moving(client, create_user):
+    taken_user_id, _ = create_user()
+    taken_username = client.get(f"/users/{taken_user_id}").json()["username"]
+    _, headers = create_user()
+
+    response = client.patch("/users/me", json={"username": taken_username, "city": "Brno"}, headers=headers)
+    assert response.status_code == 400, response.text
+
+    me = client.get("/users/me", headers=headers).json()
+    assert me["username"] != taken_username
+    assert me["city"] == "Praha"